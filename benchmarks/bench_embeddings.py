@@ -0,0 +1,111 @@
+""" Benchmark of the analyser embedding backends.
+
+    python -m src.models.embeddings --out models/all-MiniLM-L6-v2-onnx
+    python -m benchmarks.bench_embeddings --backends torch onnx
+
+Each backend runs in a fresh interpreter so its peak memory is measured on
+its own. Reports load time, encode latency and peak RSS per backend, then
+how closely every other backend agrees with the first: cosine between the
+embeddings of each sentence, and how many sentence pairs land on the same
+side of the 0.85 duplicate threshold.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from src.server.openai_stand_in import make_sentence
+
+DUPLICATE_THRESHOLD = 0.85
+
+
+def make_corpus(num_sentences: int, seed: int):
+    rng = random.Random(seed)
+    sentences = [make_sentence(rng, rng.randint(4, 14)) for _ in range(num_sentences)]
+    # near duplicates, so the threshold comparison has pairs on both sides
+    return sentences + [sentence.replace(".", " now.") for sentence in sentences[:num_sentences // 4]]
+
+
+def child(backend_name: str, args) -> None:
+    start = time.perf_counter()
+    from src.models.embeddings import make_embedding_backend
+    backend = make_embedding_backend(backend_name)
+    load_secs = time.perf_counter() - start
+
+    sentences = make_corpus(args.sentences, args.seed)
+    backend.encode(sentences[:args.batch_size])
+
+    latencies = []
+    batches = []
+    for i in range(0, len(sentences), args.batch_size):
+        start = time.perf_counter()
+        batches.append(backend.encode(sentences[i:i + args.batch_size]))
+        latencies.append(time.perf_counter() - start)
+
+    np.save(args.out, np.concatenate(batches))
+    print(json.dumps({
+        "loadSecs": load_secs,
+        "batchMillis": 1000 * float(np.median(latencies)),
+        "sentencesPerSec": len(sentences) / sum(latencies),
+        # ru_maxrss is in kilobytes on linux
+        "peakRssMb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }))
+
+
+def normalise_rows(embeddings: np.ndarray) -> np.ndarray:
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def main(args) -> None:
+    embeddings = {}
+    with tempfile.TemporaryDirectory() as out_dir:
+        for backend_name in args.backends:
+            out = os.path.join(out_dir, f"{backend_name}.npy")
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.bench_embeddings", "--child", backend_name, "--out", out,
+                    "--sentences", str(args.sentences), "--batch-size", str(args.batch_size),
+                    "--seed", str(args.seed)],
+                check=True, capture_output=True, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            embeddings[backend_name] = normalise_rows(np.load(out))
+
+            print(f"{backend_name:>6}: load {result['loadSecs']:6.2f}s  "
+                f"batch of {args.batch_size} {result['batchMillis']:7.2f}ms  "
+                f"{result['sentencesPerSec']:8.1f} sentences/s  peak RSS {result['peakRssMb']:7.1f}MB")
+
+    reference_name = args.backends[0]
+    reference = embeddings[reference_name]
+    upper = np.triu_indices(len(reference), k=1)
+    reference_duplicates = (reference @ reference.T)[upper] >= DUPLICATE_THRESHOLD
+
+    for backend_name in args.backends[1:]:
+        other = embeddings[backend_name]
+        cosines = (reference * other).sum(axis=1)
+        duplicates = (other @ other.T)[upper] >= DUPLICATE_THRESHOLD
+        print(f"{backend_name} against {reference_name}: cosine mean {cosines.mean():.4f} "
+            f"min {cosines.min():.4f}  duplicate decisions agree on "
+            f"{100 * (duplicates == reference_duplicates).mean():.2f}% of pairs "
+            f"({reference_duplicates.sum()} duplicates by {reference_name}, {duplicates.sum()} by {backend_name})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="+", default=["torch", "onnx"], choices=["torch", "onnx"])
+    parser.add_argument("--sentences", type=int, default=400)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--child", choices=["torch", "onnx"])
+    parser.add_argument("--out")
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args)
+    else:
+        main(args)
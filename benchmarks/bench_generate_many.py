@@ -0,0 +1,86 @@
+""" Benchmark of generateMany against the local OpenAI stand-in.
+
+    python -m benchmarks.bench_generate_many --depth 3 --latency typical
+
+Runs every generation mode on the same starting story and reports wall time,
+nodes generated and the requests the stand-in served, including injected
+rate limits and retries.
+"""
+import argparse
+import asyncio
+import logging
+import time
+
+import openai
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+
+from src.gamebook_generator import GamebookGenerator, GenerationProgressFeedback
+from src.graph import GamebookGraph, NarrativeNodeData
+from src.models.gpt3 import GPT3Model
+from src.models.key_scheduler import APIKeyScheduler
+from src.server.openai_stand_in import make_app
+from src.text_generator import TextGenerator
+
+# (GamebookGenerator options, agenerate_many options) per mode
+MODES = {
+    "sequential": ({}, {}),
+    "batch": ({}, {"batch": True}),
+    "fused": ({"fuse_action_rewrite": True}, {}),
+    "fused-batch": ({"fuse_action_rewrite": True}, {"batch": True}),
+    "concurrent": ({}, {"concurrency": 4}),
+    "fused-concurrent": ({"fuse_action_rewrite": True}, {"concurrency": 4}),
+    "pipelined": ({}, {"concurrency": 4, "pipelined": True}),
+    "fused-pipelined": ({"fuse_action_rewrite": True}, {"concurrency": 4, "pipelined": True}),
+}
+
+
+def make_graph() -> GamebookGraph:
+    return GamebookGraph([NarrativeNodeData(node_id=0, data="You wake up in a cold, dark forest.")])
+
+
+async def run_mode(name: str, generator_options: dict, options: dict, args, stats) -> None:
+    requests_before = stats.requests
+    rate_limited_before = stats.rate_limited
+
+    model = GPT3Model(key_scheduler=APIKeyScheduler([f"stand-in-{i}" for i in range(args.keys)]))
+    generator = GamebookGenerator(TextGenerator(model), **generator_options)
+    graph = make_graph()
+
+    start = time.perf_counter()
+    await generator.agenerate_many(graph, 0, args.depth, GenerationProgressFeedback(),
+        ending_chance_per_node=0, **options)
+    elapsed = time.perf_counter() - start
+
+    print(f"{name:>12}: {elapsed:7.2f}s  {len(graph.node_lookup):4d} nodes  "
+        f"{stats.requests - requests_before:4d} requests  "
+        f"{stats.rate_limited - rate_limited_before:3d} rate limited")
+
+
+async def main(args) -> None:
+    # injected 429s would otherwise flood the output with access log warnings
+    logging.getLogger("tornado.access").setLevel(logging.ERROR)
+
+    sock, port = bind_unused_port()
+    app = make_app(args.latency, args.rate_limit_rate, 0, args.seed)
+    server = HTTPServer(app)
+    server.add_sockets([sock])
+    openai.api_base = f"http://127.0.0.1:{port}/v1"
+
+    stats = app.settings["stand_in_stats"]
+
+    for name in args.modes:
+        await run_mode(name, *MODES[name], args, stats)
+
+    server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--latency", default="fast")
+    parser.add_argument("--rate-limit-rate", type=float, default=0)
+    parser.add_argument("--keys", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    asyncio.run(main(parser.parse_args()))
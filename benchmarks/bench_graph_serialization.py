@@ -0,0 +1,129 @@
+""" Benchmark of converting story graphs to and from JSON.
+
+    python -m benchmarks.bench_graph_serialization --sizes 1000 10000 100000
+
+Reports the cost per node of decoding a graph message (parsing the JSON and
+building the GamebookGraph) and of encoding it back, with json and, when it
+is installed, orjson parsing. With dataclasses_json installed the node
+classes are also run through its to_dict and from_dict as they were before,
+and their JSON is checked to be byte-identical.
+"""
+import argparse
+import json
+import random
+import time
+from dataclasses import dataclass, field
+from typing import List
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from dataclasses_json import dataclass_json, LetterCase
+except ImportError:
+    dataclass_json = None
+
+from src.graph import GamebookGraph
+from src.server.openai_stand_in import make_sentence
+
+
+if dataclass_json is not None:
+
+    @dataclass_json(letter_case=LetterCase.CAMEL)
+    @dataclass
+    class LegacyNarrativeNodeData:
+
+        node_id: int
+
+        data: str
+
+        children_ids: List[int] = field(default_factory=list)
+
+        is_ending: bool = False
+
+        type: str = "narrative"
+
+    @dataclass_json(letter_case=LetterCase.CAMEL)
+    @dataclass
+    class LegacyActionNodeData:
+
+        node_id: int
+
+        data: str
+
+        children_ids: List[int] = field(default_factory=list)
+
+        type: str = "action"
+
+
+def make_graph_dict(num_nodes: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    graph = GamebookGraph.from_graph_dict({"nodes": [
+        {"type": "narrative", "nodeId": 0, "data": make_sentence(rng, 60), "childrenIds": [], "isEnding": False}
+    ]})
+
+    narrative_ids = [0]
+    while len(graph.node_lookup) < num_nodes:
+        parent_id = rng.choice(narrative_ids)
+        action_id = graph.make_action_node(parent_id, make_sentence(rng, 8))
+        narrative_ids.append(graph.make_narrative_node(action_id, make_sentence(rng, 60),
+            is_ending=rng.random() < 0.1))
+    return graph.to_graph_dict()
+
+
+def legacy_from_graph_dict(graph: dict) -> GamebookGraph:
+    return GamebookGraph(
+        [LegacyNarrativeNodeData.from_dict(node) for node in graph["nodes"] if node["type"] == "narrative"]
+        + [LegacyActionNodeData.from_dict(node) for node in graph["nodes"] if node["type"] == "action"]
+    )
+
+
+def per_node_micros(function, num_nodes: int, repeats: int) -> float:
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return 1e6 * best / num_nodes
+
+
+def main(args) -> None:
+    for num_nodes in args.sizes:
+        message = json.dumps({"graph": make_graph_dict(num_nodes, args.seed)})
+        graph = GamebookGraph.from_graph_dict(json.loads(message)["graph"])
+
+        results = {
+            "decode": per_node_micros(
+                lambda: GamebookGraph.from_graph_dict(json.loads(message)["graph"]), num_nodes, args.repeats),
+            "encode": per_node_micros(
+                lambda: json.dumps({"graph": graph.to_graph_dict()}), num_nodes, args.repeats),
+        }
+        if orjson is not None:
+            results["decode orjson"] = per_node_micros(
+                lambda: GamebookGraph.from_graph_dict(orjson.loads(message)["graph"]), num_nodes, args.repeats)
+
+        if dataclass_json is not None:
+            legacy_graph = legacy_from_graph_dict(json.loads(message)["graph"])
+            results["decode legacy"] = per_node_micros(
+                lambda: legacy_from_graph_dict(json.loads(message)["graph"]), num_nodes, args.repeats)
+            results["encode legacy"] = per_node_micros(
+                lambda: json.dumps({"graph": legacy_graph.to_graph_dict()}), num_nodes, args.repeats)
+
+            identical = json.dumps(legacy_graph.to_graph_dict()) == json.dumps(graph.to_graph_dict())
+            results["identical"] = identical
+
+        print(f"{num_nodes:>7} nodes: " + "  ".join(
+            f"{name} {value:.2f}us/node" if not isinstance(value, bool) else f"{name} {value}"
+            for name, value in results.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1000, 10000, 100000])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    main(args)
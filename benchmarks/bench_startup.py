@@ -0,0 +1,73 @@
+""" Benchmark of server start up costs of the embedding model.
+
+    python -m benchmarks.bench_startup --repeats 3
+
+Each run is a fresh interpreter, so nothing is already imported or loaded.
+Reports how long importing the generation modules takes and the latency of
+the first duplicate and ending check, with the model loaded lazily by that
+first check or by the warm-up thread beforehand.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+ACTIONS = ["You climb the tower.", "You open the gate.", "You climb the old tower."]
+PARAGRAPH = "You reach the top of the tower and look out over the kingdom. The end."
+
+
+def child(mode: str) -> None:
+    start = time.perf_counter()
+    from src import analyser
+    import src.server.generate_handler  # noqa: F401
+    import_secs = time.perf_counter() - start
+
+    warm_up_secs = 0.0
+    if mode == "warm-up":
+        start = time.perf_counter()
+        analyser.warm_up().join()
+        warm_up_secs = time.perf_counter() - start
+
+    start = time.perf_counter()
+    analyser.has_duplicate_pair(ACTIONS)
+    analyser.classify_ending(PARAGRAPH)
+    first_request_secs = time.perf_counter() - start
+
+    start = time.perf_counter()
+    analyser.has_duplicate_pair(ACTIONS[::-1])
+    analyser.classify_ending(PARAGRAPH[::-1])
+    second_request_secs = time.perf_counter() - start
+
+    print(json.dumps({
+        "import": import_secs,
+        "warmUp": warm_up_secs,
+        "firstRequest": first_request_secs,
+        "secondRequest": second_request_secs,
+    }))
+
+
+def main(args) -> None:
+    for mode in ("lazy", "warm-up"):
+        runs = []
+        for _ in range(args.repeats):
+            output = subprocess.run([sys.executable, "-m", "benchmarks.bench_startup", "--child", mode],
+                check=True, capture_output=True, text=True).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+
+        medians = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+        print(f"{mode:>8}: import {medians['import']:6.2f}s  warm up {medians['warmUp']:6.2f}s  "
+            f"first request {medians['firstRequest']:6.3f}s  second request {medians['secondRequest']:6.3f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--child", choices=["lazy", "warm-up"])
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child)
+    else:
+        main(args)
@@ -0,0 +1,55 @@
+""" Benchmark of the story codecs of the stories collection.
+
+    python -m benchmarks.bench_story_storage --sizes 100 1000 10000
+
+For every codec, reports the BSON size of the stored story fields, and the
+time to encode a graph into them and decode it back, BSON included, as the
+server and MongoDB driver would.
+"""
+import argparse
+import time
+
+import bson
+
+from benchmarks.bench_graph_serialization import make_graph_dict
+from src.server.story_codec import (JSON_ZLIB, MSGPACK_ZSTD, RAW, available_codec, load_graph,
+    story_document)
+
+
+def best_millis(function, repeats: int) -> float:
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return 1000 * best
+
+
+def main(args) -> None:
+    codecs = [RAW, JSON_ZLIB] + ([MSGPACK_ZSTD] if available_codec(MSGPACK_ZSTD) == MSGPACK_ZSTD else [])
+
+    for num_nodes in args.sizes:
+        graph = make_graph_dict(num_nodes, args.seed)
+        raw_size = None
+
+        for codec in codecs:
+            stored = bson.encode(story_document(graph, codec))
+            raw_size = raw_size or len(stored)
+
+            encode_millis = best_millis(lambda: bson.encode(story_document(graph, codec)), args.repeats)
+            decode_millis = best_millis(lambda: load_graph(bson.decode(stored)), args.repeats)
+            assert load_graph(bson.decode(stored)) == graph
+
+            print(f"{num_nodes:>6} nodes {codec:>12}: {len(stored) / 1024:9.1f}KB "
+                f"({100 * len(stored) / raw_size:5.1f}%)  encode {encode_millis:8.2f}ms  "
+                f"decode {decode_millis:8.2f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[100, 1000, 10000])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    main(args)
@@ -1,25 +1,207 @@
+import asyncio
+import hashlib
 import re
+import threading
+from itertools import combinations
+from typing import List, Optional, Tuple
 
-from sentence_transformers import SentenceTransformer, util
+import numpy as np
 
-model = SentenceTransformer('all-MiniLM-L6-v2')
+from src.constants import EMBEDDING_CACHE_SIZE
+from src.models.cache import LRUCache
+from src.models.embeddings import make_embedding_backend
+
+# the embedding backend takes seconds to import and load, it is only created
+# once needed so importing this module stays cheap
+_model = None
+_model_lock = threading.Lock()
+model_ready = threading.Event()
+
+
+def get_model():
+    """The sentence embedding backend chosen by EMBEDDING_BACKEND, loaded on
+    first use"""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                _model = make_embedding_backend()
+                model_ready.set()
+    return _model
+
+
+def is_model_ready() -> bool:
+    return model_ready.is_set()
+
+
+def warm_up() -> threading.Thread:
+    """Loads the model and runs a first encode in a background thread, so the
+    first request does not pay for it"""
+    thread = threading.Thread(target=lambda: get_model().encode(["Warm up."]),
+        name="analyser-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+async def await_model() -> None:
+    """Waits for the model without blocking the event loop while it loads"""
+    if not is_model_ready():
+        await asyncio.get_running_loop().run_in_executor(None, get_model)
+
+
+# sentence embeddings keyed by the hash of the sentence, so actions on a
+# story path are only encoded once however many times they are compared
+embedding_cache = LRUCache(EMBEDDING_CACHE_SIZE)
 
 
 def normalise(text: str):
     return re.compile(r"\n\s*").sub("", text)
 
 
+def normalise_rows(embeddings: np.ndarray) -> np.ndarray:
+    return embeddings / np.clip(np.linalg.norm(embeddings, axis=-1, keepdims=True), 1e-12, None)
+
+
+def encode_sentences(sentences: List[str]) -> List[np.ndarray]:
+    """Unit length embedding of each sentence, encoding the ones not cached
+    yet in one call"""
+    keys = [hashlib.sha256(sentence.encode("utf-8")).hexdigest() for sentence in sentences]
+    embeddings = [embedding_cache.get(key) for key in keys]
+
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if missing:
+        encoded = normalise_rows(get_model().encode([sentences[i] for i in missing]))
+        for i, embedding in zip(missing, encoded):
+            embedding_cache.set(keys[i], embedding)
+            embeddings[i] = embedding
+
+    return embeddings
+
+
+class SentenceSimilarities:
+    """Cosine similarities between every sentence of a set of texts, from one
+    batched encode of the uncached sentences and one matrix multiply"""
+
+    def __init__(self, texts: List[str]) -> None:
+        self.sentence_lists: List[List[str]] = [normalise(text).split(".") for text in texts]
+        self.offsets: List[int] = []
+
+        sentences = []
+        for sentence_list in self.sentence_lists:
+            self.offsets.append(len(sentences))
+            sentences.extend(sentence_list)
+
+        embeddings = np.stack(encode_sentences(sentences))
+        self.matrix = embeddings @ embeddings.T
+
+    def is_duplicate(self, i: int, j: int) -> bool:
+        """Compares the sentences of texts i and j position by position"""
+        num_sentences = min(len(self.sentence_lists[i]), len(self.sentence_lists[j]))
+        rows = slice(self.offsets[i], self.offsets[i] + num_sentences)
+        columns = slice(self.offsets[j], self.offsets[j] + num_sentences)
+        similarities = self.matrix[rows, columns].diagonal()
+
+        # TODO: fiddle with this, see if it is actually the best way to do it
+        if len(self.sentence_lists[i]) == 2 and len(self.sentence_lists[j]) == 2:
+            # it is a sentence and not a paragraph
+            return float(similarities.mean()) >= 0.85
+        # check if number of cases where similarity is >= 0.85 is >= half the length of total
+        return float((similarities >= 0.85).mean()) >= 0.5
+
+
 def is_duplicate(text_one: str, text_two: str) -> bool:
-    sentences_one: list[str] = normalise(text_one).split(".")
-    sentences_two: list[str] = normalise(text_two).split(".")
-    embeddings_one = model.encode(sentences_one, convert_to_tensor=True)
-    embeddings_two = model.encode(sentences_two, convert_to_tensor=True)
-    similarities = []
-    for embedding_one, embedding_two in zip(embeddings_one, embeddings_two):
-        similarities.append(*util.pytorch_cos_sim(embedding_one, embedding_two))
-    # TODO: fiddle with this, see if it is actually the best way to do it
-    if len(sentences_one) == 2 and len(sentences_two) == 2:
-        # it is a sentence and not a paragraph
-        return sum(similarities) / len(similarities) >= 0.85
-    # check if number of cases where similarity is >= 0.85 is >= half the length of total
-    return len([x for x in similarities if x >= 0.85]) / len(similarities) >= 0.5
+    return SentenceSimilarities([text_one, text_two]).is_duplicate(0, 1)
+
+
+def duplicate_pairs(texts: List[str]) -> List[Tuple[int, int]]:
+    """Indices i < j of every pair of texts which are duplicates"""
+    similarities = SentenceSimilarities(texts)
+    return [(i, j) for i, j in combinations(range(len(texts)), 2) if similarities.is_duplicate(i, j)]
+
+
+def have_duplicate_pairs(text_lists: List[List[str]]) -> List[bool]:
+    """Whether each list holds two different texts which are duplicates, e.g.
+    the actions on each path of a frontier. All lists share one similarity
+    matrix, so checking them all costs at most one model call."""
+    texts = list(dict.fromkeys(text for text_list in text_lists for text in text_list))
+    if not texts:
+        return [False] * len(text_lists)
+
+    index = {text: i for i, text in enumerate(texts)}
+    similarities = SentenceSimilarities(texts)
+
+    return [
+        any(x != y and similarities.is_duplicate(index[x], index[y]) for x, y in combinations(text_list, 2))
+        for text_list in text_lists
+    ]
+
+
+def has_duplicate_pair(texts: List[str]) -> bool:
+    """Whether any two different texts are duplicates of each other"""
+    return have_duplicate_pairs([texts])[0]
+
+
+# sentences typical of the last lines of a finished story, and of a story
+# waiting on the reader's next choice
+ENDING_EXEMPLARS = [
+    "The end.",
+    "And they lived happily ever after.",
+    "Your adventure is over.",
+    "This is where your story ends.",
+    "You close your eyes for the last time.",
+    "Everything fades to black.",
+    "With your quest complete, you finally return home.",
+    "You have died.",
+]
+CONTINUING_EXEMPLARS = [
+    "What will you do?",
+    "You must decide quickly.",
+    "There are two paths ahead of you.",
+    "You wonder what to do next.",
+    "You hear footsteps approaching from behind.",
+    "The door creaks open, revealing a dark corridor.",
+    "Something moves in the shadows.",
+]
+# how much closer to one set of exemplars than to the other a text must be
+# for the classifier to be confident
+ENDING_MARGIN = 0.1
+
+_exemplar_embeddings = None
+
+
+def _get_exemplar_embeddings():
+    global _exemplar_embeddings
+    if _exemplar_embeddings is None:
+        _exemplar_embeddings = (
+            normalise_rows(get_model().encode(ENDING_EXEMPLARS)),
+            normalise_rows(get_model().encode(CONTINUING_EXEMPLARS)),
+        )
+    return _exemplar_embeddings
+
+
+def last_sentences(text: str, num_sentences: int=2) -> List[str]:
+    sentences = [sentence.strip() for sentence in re.split(r"(?<=[.!?])", text)]
+    return [sentence for sentence in sentences if sentence][-num_sentences:]
+
+
+def ending_score(text: str) -> float:
+    """Similarity of the last sentences of the text to the closest ending
+    exemplar minus that to the closest continuing one"""
+    sentences = last_sentences(text)
+    if not sentences:
+        return 0.0
+
+    ending_embeddings, continuing_embeddings = _get_exemplar_embeddings()
+    embeddings = np.stack(encode_sentences(sentences))
+    return float((embeddings @ ending_embeddings.T).max() - (embeddings @ continuing_embeddings.T).max())
+
+
+def classify_ending(text: str) -> Optional[bool]:
+    """Whether the story ends with the text, or None if the embeddings are not
+    conclusive either way"""
+    score = ending_score(text)
+    if score >= ENDING_MARGIN:
+        return True
+    if score <= -ENDING_MARGIN:
+        return False
+    return None
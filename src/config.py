@@ -1,4 +1,5 @@
 import os
+from typing import List
 
 
 def get_db_url():
@@ -16,3 +17,27 @@ def get_app_url() -> str:
     if os.getenv("STAGING"):
         return "https://cyoa-app-int-stable.herokuapp.com"
     return "http://localhost:3000"
+
+
+def get_completion_cache_path():
+    # optional on-disk tier for the completion cache, disabled when unset
+    return os.getenv("COMPLETION_CACHE_PATH")
+
+
+def get_embedding_backend() -> str:
+    # "torch" or "onnx", see src/models/embeddings.py
+    return os.getenv("EMBEDDING_BACKEND", "torch")
+
+
+def get_embedding_onnx_path() -> str:
+    return os.getenv("EMBEDDING_ONNX_PATH", "models/all-MiniLM-L6-v2-onnx")
+
+
+def get_story_codec() -> str:
+    # "raw", "json-zlib" or "msgpack-zstd", see src/server/story_codec.py
+    return os.getenv("STORY_CODEC", "raw")
+
+
+def get_status_admins() -> List[str]:
+    # comma separated emails of the users allowed to read /status
+    return [email.strip() for email in os.getenv("STATUS_ADMIN_EMAILS", "").split(",") if email.strip()]
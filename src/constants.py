@@ -1,3 +1,75 @@
 REQ_FAILURE_TIMEOUT_SECS = 3
+REQ_BACKOFF_MAX_SECS = 30
 MAX_RATE_LIMIT_ERRORS = 10
-NUM_GENERATION_ATTEMPTS = 3
\ No newline at end of file
+NUM_GENERATION_ATTEMPTS = 3
+COMPLETION_CACHE_SIZE = 2048
+COMPLETION_CACHE_TTL_SECS = 24 * 60 * 60
+
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+# longest input of the model, longer sentences are truncated
+EMBEDDING_MAX_SEQ_LENGTH = 256
+# sentence embeddings kept for duplicate detection
+EMBEDDING_CACHE_SIZE = 8192
+
+API_KEY_REQUESTS_PER_MIN = 3000
+API_KEY_TOKENS_PER_MIN = 250000
+API_KEY_COOLDOWN_SECS = 20
+
+# the completions endpoint accepts at most 20 prompts per request
+BATCH_MAX_PROMPTS = 20
+
+TOKENIZER_ENCODING = "p50k_base"
+# story text budget per operation, leaving room in the 4097 token context of
+# text-davinci-003 for the instructions and the 256 generated tokens
+PROMPT_TOKEN_BUDGETS = {
+    "narrative": 3200,
+    "actions": 3400,
+    "addActions": 3200,
+}
+# paragraphs whose token counts are remembered, ancestors are counted again
+# for every node below them otherwise
+PROMPT_TOKEN_COUNT_CACHE_SIZE = 4096
+
+# generate the second person action and the narrative after it in one call
+FUSE_ACTION_REWRITE = True
+
+# model calls in flight at once when generateMany expands a depth level
+GENERATE_MANY_CONCURRENCY = 4
+# most nodes a pipelined generateMany adds
+GENERATE_MANY_NODE_BUDGET = 200
+# actions generateMany asks for below each narrative
+GENERATE_MANY_ACTIONS_PER_NODE = 2
+
+# detect story endings locally with sentence embeddings, asking the model only
+# when they are inconclusive if the fallback is on
+LOCAL_ENDING_CHECK = True
+LLM_ENDING_FALLBACK = False
+
+# how often a running generateMany job is saved to its story, and how long a
+# finished job is kept for clients reconnecting to it
+JOB_CHECKPOINT_INTERVAL_SECS = 5
+JOB_RETENTION_SECS = 15 * 60
+
+# model calls in flight at once across all users, per user and per user
+# supplied API key, and how long a queued call waits before moving up a
+# priority level
+GENERATION_MAX_CONCURRENCY = 32
+GENERATION_PER_USER_CONCURRENCY = 6
+GENERATION_PER_KEY_CONCURRENCY = 8
+GENERATION_PRIORITY_AGING_SECS = 10
+
+# narratives generated ahead of time for freshly created actions, kept per
+# connection, and the prompt tokens one connection may spend on them
+SPECULATIVE_MAX_PENDING = 8
+SPECULATIVE_TOKEN_BUDGET = 20000
+
+# graph messages to clients using delta sync carry only the changed nodes,
+# unless more than this fraction of the graph changed
+GRAPH_DELTA_MAX_FRACTION = 0.5
+
+# live story graphs kept in memory across all connections
+GRAPH_STORE_MAX_GRAPHS = 256
+
+# compression levels of stories stored by the binary story codecs
+STORY_ZSTD_LEVEL = 3
+STORY_ZLIB_LEVEL = 6
@@ -1,34 +1,197 @@
 """Module for the gamebook generator.
 """
 
+import asyncio
 import math
 import random
-from typing import List
-
-from src.analyser import is_duplicate
-from src.text_generator import TextGenerator
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from src.analyser import await_model, classify_ending, have_duplicate_pairs
+from src.constants import GENERATE_MANY_ACTIONS_PER_NODE
+from src.prompt_builder import PromptBuilder
+from src.text_generator import GenerationError, TextGenerator
+from src.tree_scheduler import TaskGraphScheduler
 from src.graph import GamebookGraph, NarrativeNodeData, ActionNodeData
 
 
+async def gather_or_cancel(*aws):
+    """asyncio.gather which cancels the remaining awaitables when one fails,
+    rather than leaving them to keep writing into the graph"""
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
 class GenerationProgressFeedback:
     def send_generation_update(
         self,
+        graph: GamebookGraph,
         num_nodes_generated: int,
         percentage: float,
     ):
         pass
 
 
+class GenerationProgress:
+    """Counts generated nodes and reports them as a percentage of the
+    expected total"""
+
+    def __init__(self, graph, progress_feedback: GenerationProgressFeedback, exp_num_nodes: float):
+        self.graph = graph
+        self.progress_feedback = progress_feedback
+        self.exp_num_nodes = exp_num_nodes
+        self.num_nodes_generated = 0
+
+    def add(self, num_nodes: int) -> None:
+        self.num_nodes_generated += num_nodes
+        percentage = min(100, 100 * self.num_nodes_generated / self.exp_num_nodes)
+        self.progress_feedback.send_generation_update(
+            self.graph, self.num_nodes_generated, percentage)
+
+
 class GamebookGenerator:
     """Class for modifying gamebook graph, and generating new text using a model"""
 
 
-    def __init__(self, text_generator: TextGenerator) -> None:
+    def __init__(self, text_generator: TextGenerator, prompt_builder: PromptBuilder=None,
+            fuse_action_rewrite: bool=False, local_ending_check: bool=False,
+            llm_ending_fallback: bool=True) -> None:
         self.text_generator = text_generator
+        # rewrite the chosen action and continue the story in one model call
+        self.fuse_action_rewrite = fuse_action_rewrite
+        # detect endings with sentence embeddings instead of a model call, and
+        # ask the model only when the embeddings are inconclusive
+        self.local_ending_check = local_ending_check
+        self.llm_ending_fallback = llm_ending_fallback
+        self.prompt_builder = prompt_builder if prompt_builder is not None else PromptBuilder()
+
+        # tokens of every story prompt built, for reporting prompt sizes
+        self.prompt_tokens = 0
+
+
+    def _paragraphs_to_prompt(self, paragraph_list: List[str], operation: str) -> str:
+        prompt = self.prompt_builder.build(paragraph_list, operation)
+        self.prompt_tokens += prompt.num_tokens
+        return prompt.text
+
+    def _has_story_ended(self, text: str) -> bool:
+        if self.local_ending_check:
+            story_ended = classify_ending(text)
+            if story_ended is not None or not self.llm_ending_fallback:
+                return bool(story_ended)
+        return self.text_generator.has_story_ended(text)
+
+    @staticmethod
+    async def _aanalyse(function: Callable, *args):
+        # embedding inference is CPU bound, so like the model calls it runs in
+        # the default executor and the event loop keeps serving other clients
+        await await_model()
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    async def _ahas_story_ended(self, text: str) -> bool:
+        if self.local_ending_check:
+            story_ended = await self._aanalyse(classify_ending, text)
+            if story_ended is not None or not self.llm_ending_fallback:
+                return bool(story_ended)
+        return await self.text_generator.ahas_story_ended(text)
+
+
+    def _narrative_for_action(self,
+        graph: GamebookGraph,
+        from_node_id: int,
+        is_ending: bool=False,
+        descriptor: str=None,
+        details: str=None,
+        style: str=None
+    ) -> str:
+        paragraph_list = graph.get_paragraph_list(from_node_id)
+        previous_text = self._paragraphs_to_prompt(paragraph_list, "narrative")
 
+        action = graph.get_data(from_node_id)
+
+        if self.fuse_action_rewrite:
+            try:
+                edited_action, narrative = self.text_generator.generate_narrative_with_action(
+                    previous_text, action, is_ending, descriptor, details, style)
+                return edited_action + " " + narrative
+            except GenerationError:
+                # fall back to a separate rewrite and continuation
+                pass
 
-    def _paragraphs_to_prompt(self, paragraph_list: str):
-        return " ".join(paragraph_list)
+        edited_action = self.text_generator.action_to_second_person(action) + " "
+
+        prompt = previous_text + " " + edited_action
+
+        return edited_action + self.text_generator.generate_narrative(
+            prompt, 
+            is_ending=is_ending,
+            descriptor=descriptor,
+            details=details,
+            style=style
+        )
+
+    async def _anarrative_for_action(self,
+        graph: GamebookGraph,
+        from_node_id: int,
+        is_ending: bool=False,
+        descriptor: str=None,
+        details: str=None,
+        style: str=None,
+        on_chunk: Callable[[str], None]=None
+    ) -> str:
+        paragraph_list = graph.get_paragraph_list(from_node_id)
+        previous_text = self._paragraphs_to_prompt(paragraph_list, "narrative")
+
+        action = graph.get_data(from_node_id)
+
+        if self.fuse_action_rewrite:
+            try:
+                if on_chunk is None:
+                    edited_action, narrative = await self.text_generator.agenerate_narrative_with_action(
+                        previous_text, action, is_ending, descriptor, details, style)
+                    return edited_action + " " + narrative
+
+                chunks = []
+                async for chunk in self.text_generator.agenerate_narrative_with_action_stream(
+                        previous_text, action, is_ending, descriptor, details, style):
+                    on_chunk(chunk)
+                    chunks.append(chunk)
+                return "".join(chunks)
+            except GenerationError:
+                # nothing has been streamed yet when the response can't be
+                # split, so falling back is safe
+                pass
+
+        edited_action = await self.text_generator.aaction_to_second_person(action) + " "
+
+        prompt = previous_text + " " + edited_action
+
+        if on_chunk is None:
+            return edited_action + await self.text_generator.agenerate_narrative(
+                prompt,
+                is_ending=is_ending,
+                descriptor=descriptor,
+                details=details,
+                style=style
+            )
+
+        on_chunk(edited_action)
+        chunks = [edited_action]
+        async for chunk in self.text_generator.agenerate_narrative_stream(
+            prompt,
+            is_ending=is_ending,
+            descriptor=descriptor,
+            details=details,
+            style=style
+        ):
+            on_chunk(chunk)
+            chunks.append(chunk)
+        return "".join(chunks)
 
 
     def generate_narrative_from_action(self, 
@@ -43,26 +206,52 @@ class GamebookGenerator:
         if graph.is_narrative(from_node_id):
             raise TypeError
 
-        paragraph_list = graph.get_paragraph_list(from_node_id)
-        previous_text = self._paragraphs_to_prompt(paragraph_list)
+        generated_narrative = self._narrative_for_action(
+            graph, from_node_id, is_ending, descriptor, details, style)
 
-        action = graph.get_data(from_node_id)
-        edited_action = self.text_generator.action_to_second_person(action) + " "
+        return graph.make_narrative_node(
+            parent_id=from_node_id, narrative=generated_narrative, is_ending=is_ending)
 
-        prompt = previous_text + " " + edited_action
 
-        generated_narrative = edited_action + self.text_generator.generate_narrative(
-            prompt, 
-            is_ending=is_ending,
-            descriptor=descriptor,
-            details=details,
-            style=style
-        )
+    async def agenerate_narrative_from_action(self,
+        graph: GamebookGraph,
+        from_node_id: int,
+        is_ending: bool=False,
+        descriptor: str=None,
+        details: str=None,
+        style: str=None,
+        on_chunk: Callable[[str], None]=None
+    ) -> int:
+        """With on_chunk, the narrative is streamed and every piece of text
+        is passed to on_chunk as soon as it is generated"""
+
+        if graph.is_narrative(from_node_id):
+            raise TypeError
+
+        generated_narrative = await self._anarrative_for_action(
+            graph, from_node_id, is_ending, descriptor, details, style, on_chunk)
 
         return graph.make_narrative_node(
             parent_id=from_node_id, narrative=generated_narrative, is_ending=is_ending)
 
 
+    async def aspeculate_narrative(self,
+        graph: GamebookGraph,
+        from_node_id: int,
+        is_ending: bool=False,
+        descriptor: str=None,
+        details: str=None,
+        style: str=None
+    ) -> str:
+        """The narrative agenerate_narrative_from_action would add below the
+        action, without adding it to the graph"""
+
+        if graph.is_narrative(from_node_id):
+            raise TypeError
+
+        return await self._anarrative_for_action(graph, from_node_id, is_ending, descriptor, details, style)
+
+
     def generate_actions_from_narrative(self, 
         graph: GamebookGraph, 
         from_node_id: int, 
@@ -72,7 +261,7 @@ class GamebookGenerator:
             raise TypeError
         
         paragraph_list = graph.get_paragraph_list(from_node_id)
-        previous_text = self._paragraphs_to_prompt(paragraph_list)
+        previous_text = self._paragraphs_to_prompt(paragraph_list, "actions")
 
         actions_ids = []
 
@@ -82,6 +271,23 @@ class GamebookGenerator:
         
         return actions_ids
 
+
+    async def agenerate_actions_from_narrative(self,
+        graph: GamebookGraph,
+        from_node_id: int,
+        num_actions: int=2
+    ) -> List[int]:
+        if not graph.is_narrative(from_node_id):
+            raise TypeError
+
+        paragraph_list = graph.get_paragraph_list(from_node_id)
+        previous_text = self._paragraphs_to_prompt(paragraph_list, "actions")
+
+        generated_actions = await self.text_generator.agenerate_actions(previous_text, num_actions)
+
+        return [graph.make_action_node(parent_id=from_node_id, action=generated_action)
+            for generated_action in generated_actions]
+
     
     def add_actions(self, graph: GamebookGraph, from_node_id: int, num_new_actions: int=1) -> None:
         if not graph.is_narrative(from_node_id):
@@ -94,7 +300,7 @@ class GamebookGenerator:
             return
 
         paragraph_list = graph.get_paragraph_list(from_node_id)
-        previous_text = self._paragraphs_to_prompt(paragraph_list)
+        previous_text = self._paragraphs_to_prompt(paragraph_list, "addActions")
 
         existing_actions = [graph.get_data(node_id) for
             node_id in existing_action_node_ids]
@@ -107,7 +313,32 @@ class GamebookGenerator:
             graph.make_action_node(parent_id=from_node_id, action=action)
 
 
+    async def aadd_actions(self, graph: GamebookGraph, from_node_id: int, num_new_actions: int=1) -> List[int]:
+        if not graph.is_narrative(from_node_id):
+            raise TypeError
+
+        existing_action_node_ids = graph.get_children(from_node_id)
+
+        if len(existing_action_node_ids) == 0:
+            return await self.agenerate_actions_from_narrative(graph, from_node_id, num_new_actions)
+
+        paragraph_list = graph.get_paragraph_list(from_node_id)
+        previous_text = self._paragraphs_to_prompt(paragraph_list, "addActions")
+
+        existing_actions = [graph.get_data(node_id) for
+            node_id in existing_action_node_ids]
+
+        new_actions = await self.text_generator.aadd_actions(previous_text,
+            existing_actions, num_new_actions)
+
+        return [graph.make_action_node(parent_id=from_node_id, action=action) for action in new_actions]
+
+
     def bridge_node(self, graph: GamebookGraph, from_node_id: int, to_node_id: int) -> None:
+        """Raises GraphCycleError, before any text is generated, when the
+        bridge would close a cycle"""
+        graph.check_connectable(from_node_id, to_node_id)
+
         from_ = graph.get_data(from_node_id)
         to = graph.get_data(to_node_id)
 
@@ -116,23 +347,73 @@ class GamebookGenerator:
         
         graph.connect_nodes(bridge_node_id, to_node_id)
 
+
+    async def abridge_node(self, graph: GamebookGraph, from_node_id: int, to_node_id: int) -> None:
+        graph.check_connectable(from_node_id, to_node_id)
+
+        from_ = graph.get_data(from_node_id)
+        to = graph.get_data(to_node_id)
+
+        bridge = await self.text_generator.abridge_content(from_, to)
+        bridge_node_id = graph.make_narrative_node(parent_id=from_node_id, narrative=bridge)
+
+        graph.connect_nodes(bridge_node_id, to_node_id)
+
     
 
-    def generate_initial_story(self, initial_story_prompt) -> GamebookGraph:
-        initial_values = [(elem["attribute"], elem["content"]) for elem in initial_story_prompt]
-        generated_narrative = self.text_generator.new_story(initial_values)
+    @staticmethod
+    def _initial_values(initial_story_prompt):
+        return [(elem["attribute"], elem["content"]) for elem in initial_story_prompt]
 
+    @staticmethod
+    def _root_graph(generated_narrative: str) -> GamebookGraph:
         root = NarrativeNodeData(
             node_id= 0,
             data= generated_narrative,
             is_ending= False
         )
-        graph = GamebookGraph([root])
+        return GamebookGraph([root])
+
+    def generate_initial_story(self, initial_story_prompt) -> GamebookGraph:
+        initial_values = self._initial_values(initial_story_prompt)
+        generated_narrative = self.text_generator.new_story(initial_values)
+
+        graph = self._root_graph(generated_narrative)
 
         self.generate_actions_from_narrative(graph, 0)
 
         return graph
 
+    async def agenerate_initial_story(self, initial_story_prompt) -> GamebookGraph:
+        initial_values = self._initial_values(initial_story_prompt)
+        generated_narrative = await self.text_generator.anew_story(initial_values)
+
+        graph = self._root_graph(generated_narrative)
+
+        await self.agenerate_actions_from_narrative(graph, 0)
+
+        return graph
+
+
+    @staticmethod
+    def _expected_num_nodes(max_depth: int, ending_chance_per_node: float) -> float:
+        def find_exp_num_nodes(depth):
+            if depth == 0:
+                return 0
+
+            val_if_end = 1
+            val_if_no_end = 2+find_exp_num_nodes(depth-1)
+
+            return ending_chance_per_node*val_if_end + 2*(1-ending_chance_per_node)*val_if_no_end
+
+        return 1+find_exp_num_nodes(max_depth)
+
+    @staticmethod
+    def _has_duplicate_actions(graph: GamebookGraph, action_id: int) -> bool:
+        return have_duplicate_pairs([graph.get_actions_list(action_id)])[0]
+
+    async def _ahas_duplicate_actions(self, graph: GamebookGraph, action_id: int) -> bool:
+        return (await self._aanalyse(have_duplicate_pairs, [graph.get_actions_list(action_id)]))[0]
 
     def generate_many(
         self,
@@ -152,16 +433,7 @@ class GamebookGenerator:
         # Current node is always now narrative node
         assert graph.is_narrative(from_node_id)
 
-        def find_exp_num_nodes(depth):
-            if depth == 0:
-                return 0
-
-            val_if_end = 1
-            val_if_no_end = 2+find_exp_num_nodes(depth-1)
-
-            return ending_chance_per_node*val_if_end + 2*(1-ending_chance_per_node)*val_if_no_end
-
-        exp_num_nodes = 1+find_exp_num_nodes(max_depth)
+        exp_num_nodes = self._expected_num_nodes(max_depth, ending_chance_per_node)
 
         num_nodes_generated = [0]
 
@@ -180,7 +452,7 @@ class GamebookGenerator:
             for curr_id in curr_ids:
                 # Do not generate continuation on ending
                 last_paragraph_text = graph.get_data(curr_id)
-                story_ended = self.text_generator.has_story_ended(last_paragraph_text)
+                story_ended = self._has_story_ended(last_paragraph_text)
 
                 if graph.is_ending(curr_id) or story_ended:
                     continue
@@ -196,9 +468,7 @@ class GamebookGenerator:
 
                 # Generate narrative node per generated action
                 for action_id in actions_ids:
-                    actions = graph.get_actions_list(action_id)
-                    duplicates = [is_duplicate(x, y) for x in actions for y in actions if x != y]
-                    if any(duplicates):
+                    if self._has_duplicate_actions(graph, action_id):
                         node_id = self.generate_narrative_from_action(
                             graph,
                             action_id,
@@ -220,3 +490,401 @@ class GamebookGenerator:
             curr_ids = new_ids
 
         return graph
+
+
+    async def _aexpand_level(
+        self,
+        graph: GamebookGraph,
+        curr_ids: List[int],
+        ending_chance_per_node: float,
+        progress: "GenerationProgress"
+    ) -> List[int]:
+        new_ids = []
+
+        for curr_id in curr_ids:
+            # Do not generate continuation on ending
+            last_paragraph_text = graph.get_data(curr_id)
+            story_ended = await self._ahas_story_ended(last_paragraph_text)
+
+            if graph.is_ending(curr_id) or story_ended:
+                continue
+
+            actions_ids = await self.agenerate_actions_from_narrative(
+                graph,
+                curr_id
+            )
+            progress.add(len(actions_ids))
+
+            for action_id in actions_ids:
+                if await self._ahas_duplicate_actions(graph, action_id):
+                    await self.agenerate_narrative_from_action(
+                        graph,
+                        action_id,
+                        is_ending=True
+                    )
+                    continue
+                to_end = random.random() < ending_chance_per_node
+
+                node_id = await self.agenerate_narrative_from_action(
+                    graph,
+                    action_id,
+                    is_ending=to_end
+                )
+                new_ids.append(node_id)
+                progress.add(1)
+
+        return new_ids
+
+    async def _aplan_endings(self,
+        graph: GamebookGraph,
+        actions_ids: List[int],
+        ending_chance_per_node: float
+    ) -> Tuple[List[bool], List[bool]]:
+        """Whether each action leads to an ending, and whether its narrative
+        counts towards progress. Paths repeating an action are ended and not
+        counted."""
+        duplicate_paths = await self._aanalyse(have_duplicate_pairs,
+            [graph.get_actions_list(action_id) for action_id in actions_ids])
+
+        is_endings = []
+        counted = []
+        for is_duplicate_path in duplicate_paths:
+            is_endings.append(is_duplicate_path or random.random() < ending_chance_per_node)
+            counted.append(not is_duplicate_path)
+        return is_endings, counted
+
+    async def _anarratives_for_actions_batched(
+        self,
+        graph: GamebookGraph,
+        actions_ids: List[int],
+        is_endings: List[bool]
+    ) -> List[str]:
+        previous_texts = [
+            self._paragraphs_to_prompt(graph.get_paragraph_list(action_id), "narrative")
+            for action_id in actions_ids
+        ]
+        narratives = [None] * len(actions_ids)
+
+        if self.fuse_action_rewrite:
+            fused = await self.text_generator.agenerate_narrative_with_action_batch(
+                previous_texts, [graph.get_data(action_id) for action_id in actions_ids], is_endings)
+            for i, result in enumerate(fused):
+                if result is not None:
+                    narratives[i] = result[0] + " " + result[1]
+
+        # anything not generated in a single call gets a separate rewrite and
+        # continuation, the edit endpoint takes a single input so rewrites are
+        # sent concurrently
+        remaining = [i for i, narrative in enumerate(narratives) if narrative is None]
+        edited_actions = [edited + " " for edited in await asyncio.gather(*[
+            self.text_generator.aaction_to_second_person(graph.get_data(actions_ids[i]))
+            for i in remaining
+        ])]
+
+        if remaining:
+            continuations = await self.text_generator.agenerate_narrative_batch(
+                [previous_texts[i] + " " + edited_action for i, edited_action in zip(remaining, edited_actions)],
+                [is_endings[i] for i in remaining]
+            )
+            for i, edited_action, continuation in zip(remaining, edited_actions, continuations):
+                narratives[i] = edited_action + continuation
+
+        return narratives
+
+    async def _aexpand_level_batched(
+        self,
+        graph: GamebookGraph,
+        curr_ids: List[int],
+        ending_chance_per_node: float,
+        progress: "GenerationProgress"
+    ) -> List[int]:
+        """Same expansion as _aexpand_level, but all actions of the level are
+        generated in one batched request and so are all narratives"""
+        stories_ended = await asyncio.gather(*[
+            self._ahas_story_ended(graph.get_data(curr_id)) for curr_id in curr_ids
+        ])
+        open_ids = [curr_id for curr_id, story_ended in zip(curr_ids, stories_ended)
+            if not graph.is_ending(curr_id) and not story_ended]
+        if not open_ids:
+            return []
+
+        generated_actions = await self.text_generator.agenerate_actions_batch([
+            self._paragraphs_to_prompt(graph.get_paragraph_list(curr_id), "actions") for curr_id in open_ids
+        ])
+
+        actions_ids = []
+        for curr_id, actions in zip(open_ids, generated_actions):
+            ids = [graph.make_action_node(parent_id=curr_id, action=action) for action in actions]
+            actions_ids.extend(ids)
+            progress.add(len(ids))
+
+        is_endings, counted = await self._aplan_endings(graph, actions_ids, ending_chance_per_node)
+
+        narratives = await self._anarratives_for_actions_batched(graph, actions_ids, is_endings)
+
+        new_ids = []
+        for action_id, narrative, is_ending, is_counted in zip(
+                actions_ids, narratives, is_endings, counted):
+            node_id = graph.make_narrative_node(
+                parent_id=action_id, narrative=narrative, is_ending=is_ending)
+            if is_counted:
+                new_ids.append(node_id)
+                progress.add(1)
+
+        return new_ids
+
+    async def _aexpand_level_concurrent(
+        self,
+        graph: GamebookGraph,
+        curr_ids: List[int],
+        ending_chance_per_node: float,
+        progress: "GenerationProgress",
+        semaphore: asyncio.Semaphore
+    ) -> List[int]:
+        """Same expansion as _aexpand_level, but every node of the level is
+        expanded concurrently, at most as many model calls at once as the
+        semaphore allows. Nodes get the ids they would get sequentially."""
+        async def expand_actions(curr_id):
+            async with semaphore:
+                story_ended = await self._ahas_story_ended(graph.get_data(curr_id))
+                if graph.is_ending(curr_id) or story_ended:
+                    return []
+                return await self.text_generator.agenerate_actions(
+                    self._paragraphs_to_prompt(graph.get_paragraph_list(curr_id), "actions"))
+
+        generated_actions = await gather_or_cancel(*[expand_actions(curr_id) for curr_id in curr_ids])
+
+        # actions are added once all of the level is generated, in frontier
+        # order. Every action gets exactly one narrative, so its id is reserved
+        # right after the actions as in _aexpand_level and narratives can be
+        # added as soon as they are generated.
+        actions_ids = []
+        narrative_ids = []
+        for curr_id, actions in zip(curr_ids, generated_actions):
+            ids = [graph.make_action_node(parent_id=curr_id, action=action) for action in actions]
+            actions_ids.extend(ids)
+            narrative_ids.extend(graph.reserve_node_ids(len(ids)))
+            progress.add(len(ids))
+
+        is_endings, counted = await self._aplan_endings(graph, actions_ids, ending_chance_per_node)
+
+        async def expand_narrative(action_id, node_id, is_ending, is_counted):
+            async with semaphore:
+                narrative = await self._anarrative_for_action(graph, action_id, is_ending)
+            graph.make_narrative_node(
+                parent_id=action_id, narrative=narrative, is_ending=is_ending, node_id=node_id)
+            if is_counted:
+                progress.add(1)
+
+        await gather_or_cancel(*[
+            expand_narrative(*args) for args in zip(actions_ids, narrative_ids, is_endings, counted)
+        ])
+
+        return [node_id for node_id, is_counted in zip(narrative_ids, counted) if is_counted]
+
+    @staticmethod
+    def _pending_nodes(
+        graph: GamebookGraph,
+        from_node_id: int,
+        max_depth: int
+    ) -> Tuple[Dict[int, List[int]], List[Tuple[int, int]]]:
+        """Work left in a partially generated tree below from_node_id: the
+        narrative nodes with no actions yet, by depth, and the actions with no
+        narrative yet, with the depth of the narrative they follow"""
+        levels = defaultdict(list)
+        pending_actions = []
+
+        stack = [(from_node_id, 0)]
+        seen = set()
+        while stack:
+            node_id, depth = stack.pop()
+            if depth >= max_depth or node_id in seen or graph.is_ending(node_id):
+                continue
+            seen.add(node_id)
+
+            actions_ids = graph.get_children(node_id)
+            if not actions_ids:
+                levels[depth].append(node_id)
+
+            for action_id in actions_ids:
+                narrative_ids = graph.get_children(action_id)
+                if not narrative_ids:
+                    pending_actions.append((action_id, depth))
+                stack.extend((narrative_id, depth + 1) for narrative_id in narrative_ids)
+
+        return {depth: sorted(ids) for depth, ids in levels.items()}, sorted(pending_actions)
+
+    async def _anarratives_for_pending_actions(
+        self,
+        graph: GamebookGraph,
+        pending_actions: List[Tuple[int, int]],
+        ending_chance_per_node: float,
+        progress: "GenerationProgress",
+        concurrency: int
+    ) -> Dict[int, List[int]]:
+        """Narratives for actions left without one, by depth of the new
+        narrative nodes which still need expanding"""
+        semaphore = asyncio.Semaphore(concurrency)
+        actions_ids = [action_id for action_id, _ in pending_actions]
+        is_endings, counted = await self._aplan_endings(graph, actions_ids, ending_chance_per_node)
+
+        async def expand_action(action_id, is_ending):
+            async with semaphore:
+                narrative = await self._anarrative_for_action(graph, action_id, is_ending)
+            return graph.make_narrative_node(parent_id=action_id, narrative=narrative, is_ending=is_ending)
+
+        narrative_ids = await gather_or_cancel(*[
+            expand_action(action_id, is_ending) for action_id, is_ending in zip(actions_ids, is_endings)
+        ])
+
+        levels = defaultdict(list)
+        for (_, depth), node_id, is_ending, is_counted in zip(pending_actions, narrative_ids, is_endings, counted):
+            if is_counted:
+                progress.add(1)
+                if not is_ending:
+                    levels[depth + 1].append(node_id)
+        return levels
+
+    async def _agenerate_pipelined(
+        self,
+        graph: GamebookGraph,
+        levels: Dict[int, List[int]],
+        pending_actions: List[Tuple[int, int]],
+        max_depth: int,
+        ending_chance_per_node: float,
+        progress: "GenerationProgress",
+        concurrency: int,
+        node_budget: Optional[int]
+    ) -> None:
+        """Same expansion as _aexpand_level over max_depth levels, but a
+        node's actions are generated as soon as the node exists and an
+        action's narrative as soon as the action exists, so a slow completion
+        only holds back its own subtree. Node ids follow completion order.
+
+        Starts from the narrative nodes in levels, by depth, and the actions
+        in pending_actions. At most node_budget nodes are added, each action
+        being counted together with its narrative."""
+        scheduler = TaskGraphScheduler(concurrency)
+        remaining = math.inf if node_budget is None else node_budget
+
+        async def expand_narrative(node_id, depth):
+            nonlocal remaining
+            if graph.is_ending(node_id) or remaining < 2:
+                return
+            # the budget is reserved before any model call, so nothing is
+            # generated once it is spent, and what goes unused is handed back
+            reserved = 2 * min(GENERATE_MANY_ACTIONS_PER_NODE, remaining // 2)
+            remaining -= reserved
+
+            async with scheduler.slot():
+                story_ended = await self._ahas_story_ended(graph.get_data(node_id))
+                actions = [] if story_ended else await self.text_generator.agenerate_actions(
+                    self._paragraphs_to_prompt(graph.get_paragraph_list(node_id), "actions"), reserved // 2)
+
+            num_actions = min(len(actions), reserved // 2)
+            remaining += reserved - 2 * num_actions
+            actions_ids = [
+                graph.make_action_node(parent_id=node_id, action=action) for action in actions[:num_actions]
+            ]
+            progress.add(len(actions_ids))
+
+            is_endings, counted = await self._aplan_endings(graph, actions_ids, ending_chance_per_node)
+            for args in zip(actions_ids, is_endings, counted):
+                scheduler.spawn(expand_action(*args, depth))
+
+        async def expand_action(action_id, is_ending, is_counted, depth):
+            async with scheduler.slot():
+                narrative = await self._anarrative_for_action(graph, action_id, is_ending)
+
+            node_id = graph.make_narrative_node(parent_id=action_id, narrative=narrative, is_ending=is_ending)
+            if not is_counted:
+                return
+            progress.add(1)
+
+            if depth + 1 < max_depth and remaining >= 2:
+                scheduler.spawn(expand_narrative(node_id, depth + 1))
+
+        for depth, node_ids in levels.items():
+            for node_id in node_ids:
+                scheduler.spawn(expand_narrative(node_id, depth))
+
+        if len(pending_actions) > remaining:
+            pending_actions = pending_actions[:remaining]
+        remaining -= len(pending_actions)
+        actions_ids = [action_id for action_id, _ in pending_actions]
+        is_endings, counted = await self._aplan_endings(graph, actions_ids, ending_chance_per_node)
+        for (action_id, depth), is_ending, is_counted in zip(pending_actions, is_endings, counted):
+            scheduler.spawn(expand_action(action_id, is_ending, is_counted, depth))
+
+        await scheduler.join()
+
+    async def agenerate_many(
+        self,
+        graph: GamebookGraph,
+        from_node_id: int,
+        max_depth: int,
+        progress_feedback: GenerationProgressFeedback,
+        ending_chance_per_node: float=0.25,
+        batch: bool=False,
+        concurrency: int=1,
+        pipelined: bool=False,
+        node_budget: Optional[int]=None,
+        resume: bool=False
+    ):
+        """Async counterpart of generate_many, the event loop stays free to
+        serve other clients while waiting on the model. With batch, each depth
+        level is expanded with batched completion requests. With pipelined,
+        the tree is expanded without waiting for levels to finish, adding at
+        most node_budget nodes. Otherwise with concurrency above 1 the nodes of
+        a level are expanded concurrently.
+
+        With resume, the tree below from_node_id is taken to be partially
+        generated already and only the missing nodes are generated."""
+        # A resumed job already generated the narrative after the action
+        if resume and not graph.is_narrative(from_node_id) and graph.get_children(from_node_id):
+            from_node_id = graph.get_children(from_node_id)[0]
+
+        # Add a narrative node if current node is an action node
+        if not graph.is_narrative(from_node_id):
+            from_node_id = await self.agenerate_narrative_from_action(
+                graph,
+                from_node_id
+            )
+
+        # Current node is always now narrative node
+        assert graph.is_narrative(from_node_id)
+
+        exp_num_nodes = self._expected_num_nodes(max_depth, ending_chance_per_node)
+        if pipelined and node_budget is not None:
+            exp_num_nodes = min(exp_num_nodes, node_budget)
+        progress = GenerationProgress(graph, progress_feedback, exp_num_nodes)
+
+        if resume:
+            levels, pending_actions = self._pending_nodes(graph, from_node_id, max_depth)
+        else:
+            levels, pending_actions = {0: [from_node_id]}, []
+
+        if pipelined:
+            await self._agenerate_pipelined(graph, levels, pending_actions, max_depth, ending_chance_per_node,
+                progress, concurrency, node_budget)
+            return graph
+
+        if pending_actions:
+            for depth, node_ids in (await self._anarratives_for_pending_actions(
+                    graph, pending_actions, ending_chance_per_node, progress, concurrency)).items():
+                levels[depth] = sorted(levels.get(depth, []) + node_ids)
+
+        if batch:
+            expand_level = self._aexpand_level_batched
+        elif concurrency > 1:
+            semaphore = asyncio.Semaphore(concurrency)
+            expand_level = lambda *args: self._aexpand_level_concurrent(*args, semaphore)
+        else:
+            expand_level = self._aexpand_level
+
+        curr_ids = []
+
+        for i in range(max_depth):
+            curr_ids = await expand_level(graph, levels.get(i, []) + curr_ids, ending_chance_per_node, progress)
+
+        return graph
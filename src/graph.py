@@ -1,14 +1,11 @@
 """ Module for the tree representation of the gamebook.
 """
-from collections import defaultdict
-from typing import List, Union
+from collections import OrderedDict, defaultdict
+from typing import Dict, List, Optional, Set, Tuple, Union
 from dataclasses import dataclass, field
 
-from dataclasses_json import dataclass_json, LetterCase
 
-
-@dataclass_json(letter_case=LetterCase.CAMEL)
-@dataclass
+@dataclass(slots=True)
 class NarrativeNodeData:
     """Dataclass which can be converted to and from json-style camelCase using
     to_dict and from_dict"""
@@ -22,10 +19,28 @@ class NarrativeNodeData:
     is_ending: bool = False
 
     type: str = "narrative"
+
+    def to_dict(self) -> dict:
+        return {
+            "nodeId": self.node_id,
+            "data": self.data,
+            "childrenIds": list(self.children_ids),
+            "isEnding": self.is_ending,
+            "type": self.type,
+        }
+
+    @staticmethod
+    def from_dict(node_data: dict) -> "NarrativeNodeData":
+        return NarrativeNodeData(
+            node_data["nodeId"],
+            node_data["data"],
+            list(node_data.get("childrenIds", ())),
+            node_data.get("isEnding", False),
+            node_data.get("type", "narrative"),
+        )
     
 
-@dataclass_json(letter_case=LetterCase.CAMEL)
-@dataclass
+@dataclass(slots=True)
 class ActionNodeData:
     """Dataclass which can be converted to and from json-style camelCase using
     to_dict and from_dict"""
@@ -37,8 +52,29 @@ class ActionNodeData:
     children_ids: List[int] = field(default_factory=list)
 
     type: str = "action"
+
+    def to_dict(self) -> dict:
+        return {
+            "nodeId": self.node_id,
+            "data": self.data,
+            "childrenIds": list(self.children_ids),
+            "type": self.type,
+        }
+
+    @staticmethod
+    def from_dict(node_data: dict) -> "ActionNodeData":
+        return ActionNodeData(
+            node_data["nodeId"],
+            node_data["data"],
+            list(node_data.get("childrenIds", ())),
+            node_data.get("type", "action"),
+        )
     
 
+class GraphCycleError(Exception):
+    pass
+
+
 class GamebookGraph:
     """Class for representing the graph for a gamebook"""
 
@@ -54,6 +90,25 @@ class GamebookGraph:
 
         self.next_node_id = max(node_data.node_id for node_data in node_data_list) + 1
 
+        # paragraphs and actions from the root to each node along first
+        # parents, derived from the path of the parent as they are needed
+        self._paths: Dict[int, Tuple[Tuple[str, ...], Tuple[str, ...]]] = {}
+
+        # every change bumps the version, and changed nodes are kept in the
+        # order they last changed, so a delta only visits the nodes changed
+        # since the version it starts from
+        self.version = 0
+        self._changed_at: "OrderedDict[int, int]" = OrderedDict()
+
+        # structure of the tree of first parents, kept up to date by every
+        # change: the depth of each node, the nodes without children and
+        # those of them which are not endings, and the endings below each node
+        self._depth: Dict[int, int] = {}
+        self._leaves: Set[int] = set()
+        self._open_leaves: Set[int] = set()
+        self._endings_below: Dict[int, int] = {}
+        self._build_index()
+
 
     @staticmethod
     def from_graph_dict(graph):
@@ -78,16 +133,104 @@ class GamebookGraph:
     def _get_node(self, node_id):
         return self.node_lookup[node_id]
 
-    def make_action_node(self, parent_id, action) -> int:
+    def _check_acyclic(self) -> None:
+        visiting, done = set(), set()
+        for start_id in self.node_lookup:
+            if start_id in done:
+                continue
+            visiting.add(start_id)
+            stack = [(start_id, iter(self.node_lookup[start_id].children_ids))]
+            while stack:
+                node_id, children_ids = stack[-1]
+                child_id = next(children_ids, None)
+                if child_id is None:
+                    visiting.discard(node_id)
+                    done.add(node_id)
+                    stack.pop()
+                elif child_id in visiting:
+                    raise GraphCycleError(f"Node {child_id} is its own descendant")
+                elif child_id not in done and child_id in self.node_lookup:
+                    visiting.add(child_id)
+                    stack.append((child_id, iter(self.node_lookup[child_id].children_ids)))
+
+    def _build_index(self) -> None:
+        self._check_acyclic()
+
+        for node_id, node in self.node_lookup.items():
+            self._endings_below[node_id] = 0
+            if not node.children_ids:
+                self._leaves.add(node_id)
+                if not self.is_ending(node_id):
+                    self._open_leaves.add(node_id)
+
+        # parents come before their children in this order
+        order = []
+        stack = [(node_id, 0) for node_id in self.node_lookup if not self.parent_lookup.get(node_id)]
+        while stack:
+            node_id, depth = stack.pop()
+            if node_id in self._depth:
+                continue
+            self._depth[node_id] = depth
+            order.append(node_id)
+            stack.extend((child_id, depth + 1) for child_id in self.node_lookup[node_id].children_ids
+                if child_id in self.node_lookup and self._first_parent(child_id) == node_id)
+
+        for node_id in reversed(order):
+            if self.is_ending(node_id):
+                self._endings_below[node_id] += 1
+            parent_id = self._first_parent(node_id)
+            if parent_id is not None:
+                self._endings_below[parent_id] += self._endings_below[node_id]
+
+    def _add_endings_below(self, node_id, num_endings: int) -> None:
+        while node_id is not None:
+            self._endings_below[node_id] += num_endings
+            node_id = self._first_parent(node_id)
+
+    def _set_depths(self, node_id, depth: int) -> None:
+        stack = [(node_id, depth)]
+        while stack:
+            node_id, depth = stack.pop()
+            self._depth[node_id] = depth
+            stack.extend((child_id, depth + 1) for child_id in self.node_lookup[node_id].children_ids
+                if self._first_parent(child_id) == node_id)
+
+    def _reaches(self, from_node_id, to_node_id) -> bool:
+        stack = [from_node_id]
+        seen = set()
+        while stack:
+            node_id = stack.pop()
+            if node_id == to_node_id:
+                return True
+            if node_id in seen:
+                continue
+            seen.add(node_id)
+            stack.extend(self.node_lookup[node_id].children_ids)
+        return False
+
+    def reserve_node_ids(self, num_ids: int) -> List[int]:
+        """Allocates ids up front, so that nodes generated concurrently get
+        the same ids whatever order they finish in"""
+        node_ids = list(range(self.next_node_id, self.next_node_id + num_ids))
+        self.next_node_id += num_ids
+        return node_ids
+
+    def _allocate_node_id(self, node_id=None) -> int:
+        if node_id is None:
+            node_id = self.next_node_id
+            self.next_node_id += 1
+        return node_id
+
+    def make_action_node(self, parent_id, action, node_id=None) -> int:
         new_node = ActionNodeData(
-            node_id=self.next_node_id,
+            node_id=self._allocate_node_id(node_id),
             data=action
         )
         return self._add_node(parent_id, new_node)
 
-    def make_narrative_node(self, parent_id, narrative, is_ending=False) -> int:
+    def make_narrative_node(self, parent_id, narrative, is_ending=False, node_id=None) -> int:
         new_node = NarrativeNodeData(
-            node_id=self.next_node_id,
+            node_id=self._allocate_node_id(node_id),
             data=narrative,
             is_ending=is_ending
         )
@@ -95,31 +238,97 @@ class GamebookGraph:
 
     def _add_node(self, parent_id, new_node) -> int:
         """Allow editing action and paragraph"""
-        node_id = self.next_node_id
-        self.next_node_id += 1
+        node_id = new_node.node_id
 
         self.node_lookup[node_id] = new_node
 
         parent = self.node_lookup[parent_id]
         parent.children_ids.append(node_id)
         self.parent_lookup[node_id].append(parent_id)
-        
+        self._touch(node_id)
+        self._touch(parent_id)
+
+        if parent_id in self._paths:
+            self._paths[node_id] = self._extend_path(node_id, self._paths[parent_id])
+
+        self._depth[node_id] = self._depth[parent_id] + 1
+        self._endings_below[node_id] = 0
+        self._leaves.discard(parent_id)
+        self._open_leaves.discard(parent_id)
+        self._leaves.add(node_id)
+        if self.is_ending(node_id):
+            self._add_endings_below(node_id, 1)
+        else:
+            self._open_leaves.add(node_id)
+
         return new_node.node_id
     
+    def check_connectable(self, parent_id: int, child_id: int) -> None:
+        """Raises GraphCycleError when the parent is the child or below it,
+        or below a new node made under it"""
+        if self._reaches(child_id, parent_id):
+            raise GraphCycleError(f"Node {parent_id} is below node {child_id}")
+
     def connect_nodes(self, parent_id: int, child_id: int) -> None:
+        """Raises GraphCycleError, leaving the graph unchanged, when the
+        parent is the child or below it"""
+        self.check_connectable(parent_id, child_id)
+
         parent = self.node_lookup[parent_id]
         parent.children_ids.append(child_id)
 
         self.parent_lookup[child_id].append(parent_id)
+        self._touch(parent_id)
+        self._leaves.discard(parent_id)
+        self._open_leaves.discard(parent_id)
+        if self.parent_lookup[child_id] == [parent_id]:
+            # paths and the tree of first parents only change for a child
+            # which had no parent
+            self._invalidate_paths(child_id)
+            self._set_depths(child_id, self._depth[parent_id] + 1)
+            self._add_endings_below(parent_id, self._endings_below[child_id])
 
     def set_ending_narrative(self, node_id, is_ending):
         node = self.node_lookup[node_id]
-        if self.is_narrative(node_id):
+        if self.is_narrative(node_id) and node.is_ending != is_ending:
             node.is_ending = is_ending
+            self._touch(node_id)
+            self._add_endings_below(node_id, 1 if is_ending else -1)
+            if node_id in self._leaves:
+                if is_ending:
+                    self._open_leaves.discard(node_id)
+                else:
+                    self._open_leaves.add(node_id)
 
     def set_data(self, node_id, new_data):
         """Allow editing action and paragraph"""
         self.node_lookup[node_id].data = new_data
+        self._invalidate_paths(node_id)
+        self._touch(node_id)
+
+    def _touch(self, node_id) -> None:
+        self.version += 1
+        self._changed_at[node_id] = self.version
+        self._changed_at.move_to_end(node_id)
+
+    def delta_since(self, version: int) -> Optional[dict]:
+        """Json-style dictionary of the nodes added or changed after the
+        version, whole with their children ids. None when the graph never
+        had that version."""
+        if not 0 <= version <= self.version:
+            return None
+
+        nodes = []
+        for node_id in reversed(self._changed_at):
+            if self._changed_at[node_id] <= version:
+                break
+            nodes.append(self.node_lookup[node_id].to_dict())
+
+        return {
+            "fromVersion": version,
+            "version": self.version,
+            "nodes": nodes[::-1],
+        }
 
     def get_data(self, node_id):
         """Get the data at node with the node_id."""
@@ -141,36 +350,75 @@ class GamebookGraph:
 
         return node.is_ending
     
+    def _first_parent(self, node_id) -> Optional[int]:
+        parents = self.parent_lookup.get(node_id)
+        return parents[0] if parents else None
+
+    def _extend_path(self, node_id, parent_path):
+        paragraphs, actions = parent_path
+        node = self.node_lookup[node_id]
+        if node.data is None:
+            return parent_path
+        if node.type == "narrative":
+            return paragraphs + (node.data,), actions
+        return paragraphs, actions + (node.data,)
+
+    def _path(self, end_node_id):
+        # here we need to walk up the tree using the parent_id field until a
+        # node with a known path, then extend that path back down
+        uncached = []
+        node_id = end_node_id
+        while node_id is not None and node_id not in self._paths:
+            uncached.append(node_id)
+            node_id = self._first_parent(node_id)
+
+        path = self._paths[node_id] if node_id is not None else ((), ())
+        for node_id in reversed(uncached):
+            path = self._extend_path(node_id, path)
+            self._paths[node_id] = path
+        return path
+
+    def _invalidate_paths(self, node_id) -> None:
+        """Forgets the paths through the node"""
+        stack = [node_id]
+        seen = set()
+        while stack:
+            node_id = stack.pop()
+            if node_id in seen:
+                continue
+            seen.add(node_id)
+            self._paths.pop(node_id, None)
+            stack.extend(self.node_lookup[node_id].children_ids)
+
     def get_paragraph_list(self, end_node_id):
         """Generates a list of paragraph from the root node to end node
         inclusively."""
-        rev_paragraphs = []
+        return list(self._path(end_node_id)[0])
 
-        # here we need to build the text list in reverse, since we need to
-        # traverse the tree using the parent_id field
-        node_id = end_node_id
+    def get_actions_list(self, end_node_id):
+        """Actions from the end node back to the root node"""
+        return list(reversed(self._path(end_node_id)[1]))
+        
+    def get_parent(self, node_id: int) -> Optional[int]:
+        """First parent of the node, the one its paths go through"""
+        return self._first_parent(node_id)
 
-        while node_id is not None:
-            node = self.node_lookup[node_id]
-            if self.is_narrative(node_id) and node.data is not None:
-                rev_paragraphs.append(node.data)
-            node_id = self.parent_lookup[node_id][0] if self.parent_lookup[node_id] != [] else None
+    def get_depth(self, node_id: int) -> int:
+        """Number of nodes above the node on its path from the root"""
+        return self._depth[node_id]
 
-        return list(reversed(rev_paragraphs))
+    def get_leaves(self) -> Set[int]:
+        return set(self._leaves)
 
-    def get_actions_list(self, end_node_id):
-        actions = []
+    def get_open_leaves(self) -> Set[int]:
+        """Nodes without children which are not endings, the ones left to expand"""
+        return set(self._open_leaves)
 
-        node_id = end_node_id
-
-        while node_id is not None:
-            node = self.node_lookup[node_id]
-            if self.is_action(node_id) and node.data is not None:
-                actions.append(node.data)
-            node_id = self.parent_lookup[node_id][0] if self.parent_lookup[node_id] != [] else None
+    def count_endings_below(self, node_id: int) -> int:
+        """Endings in the tree of first parents from the node down, the node
+        included"""
+        return self._endings_below[node_id]
 
-        return actions
-        
     def get_children(self, node_id: int) -> List[int]:
         node = self.node_lookup[node_id]
         return node.children_ids
@@ -0,0 +1,135 @@
+""" Module for caching model responses keyed on the full request parameters.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+def request_key(endpoint: str, params: dict) -> str:
+    """Stable hash of everything that determines a model response. The api key
+    is deliberately left out, it does not change the generated text."""
+    payload = json.dumps({"endpoint": endpoint, **params}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    """In-process cache evicting the least recently used entry once max_size
+    is reached. Entries older than ttl_secs are treated as missing."""
+
+    def __init__(self, max_size: int=1024, ttl_secs: Optional[float]=None) -> None:
+        self.max_size = max_size
+        self.ttl_secs = ttl_secs
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            value, stored_at = entry
+            if self.ttl_secs is not None and time.monotonic() - stored_at > self.ttl_secs:
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteCache:
+    """On-disk cache so responses survive restarts and repeated test runs"""
+
+    def __init__(self, path: str, ttl_secs: Optional[float]=None) -> None:
+        self.ttl_secs = ttl_secs
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, stored_at REAL NOT NULL)"
+        )
+        self._connection.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, stored_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            value, stored_at = row
+            if self.ttl_secs is not None and time.time() - stored_at > self.ttl_secs:
+                self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._connection.commit()
+                return None
+
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, value, stored_at) VALUES (?, ?, ?)",
+                (key, value, time.time()),
+            )
+            self._connection.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+class CompletionCache:
+    """Two tier cache: lookups try memory first, then disk, and disk hits are
+    promoted into memory"""
+
+    def __init__(self, memory: LRUCache=None, disk: SQLiteCache=None) -> None:
+        self.memory = memory if memory is not None else LRUCache()
+        self.disk = disk
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[str]:
+        value = self.memory.get(key)
+        if value is not None:
+            self.memory_hits += 1
+            return value
+
+        if self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.disk_hits += 1
+                self.memory.set(key, value)
+                return value
+
+        self.misses += 1
+        return None
+
+    def set(self, key: str, value: str) -> None:
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def stats(self) -> dict:
+        return {
+            "memoryHits": self.memory_hits,
+            "diskHits": self.disk_hits,
+            "misses": self.misses,
+            "memorySize": len(self.memory),
+        }
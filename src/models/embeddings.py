@@ -0,0 +1,149 @@
+""" Module for the sentence embedding backends used by the analyser.
+
+The torch backend runs all-MiniLM-L6-v2 through sentence_transformers. The
+ONNX backend runs an int8 quantized export of the same model with ONNX
+Runtime, which needs neither torch nor sentence_transformers at run time.
+Export it once with
+    python -m src.models.embeddings --out models/all-MiniLM-L6-v2-onnx
+"""
+import argparse
+import os
+from typing import List
+
+import numpy as np
+
+from src.config import get_embedding_backend, get_embedding_onnx_path
+from src.constants import EMBEDDING_MAX_SEQ_LENGTH, EMBEDDING_MODEL_NAME
+
+ONNX_MODEL_FILE = "model.onnx"
+ONNX_QUANTIZED_MODEL_FILE = "model.int8.onnx"
+TOKENIZER_FILE = "tokenizer.json"
+
+
+class EmbeddingBackendError(Exception):
+    pass
+
+
+class TorchEmbeddingBackend:
+    """Full precision model run by sentence_transformers"""
+
+    name = "torch"
+
+    def __init__(self, model_name: str=EMBEDDING_MODEL_NAME) -> None:
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name)
+
+    def encode(self, sentences: List[str]) -> np.ndarray:
+        return np.asarray(self.model.encode(sentences), dtype=np.float32)
+
+
+class OnnxEmbeddingBackend:
+    """Exported model run by ONNX Runtime, mean pooled over the tokens as
+    sentence_transformers does for all-MiniLM-L6-v2"""
+
+    name = "onnx"
+
+    def __init__(self, model_dir: str, quantized: bool=True) -> None:
+        # imported here so that processes on the torch backend never load it
+        try:
+            import onnxruntime
+        except ImportError:
+            raise EmbeddingBackendError("onnxruntime is not installed")
+
+        from tokenizers import Tokenizer
+
+        model_path = os.path.join(model_dir, ONNX_QUANTIZED_MODEL_FILE if quantized else ONNX_MODEL_FILE)
+        if not os.path.exists(model_path):
+            raise EmbeddingBackendError(f"No exported model at {model_path}")
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, TOKENIZER_FILE))
+        self.tokenizer.enable_padding()
+        self.tokenizer.enable_truncation(EMBEDDING_MAX_SEQ_LENGTH)
+
+    def encode(self, sentences: List[str]) -> np.ndarray:
+        encodings = self.tokenizer.encode_batch(sentences)
+        attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+        inputs = {
+            "input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+            "attention_mask": attention_mask,
+            "token_type_ids": np.array([encoding.type_ids for encoding in encodings], dtype=np.int64),
+        }
+
+        token_embeddings = self.session.run(
+            None, {name: value for name, value in inputs.items() if name in self.input_names})[0]
+        return mean_pool(token_embeddings, attention_mask)
+
+
+def mean_pool(token_embeddings: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+    mask = attention_mask[..., np.newaxis].astype(np.float32)
+    summed = (token_embeddings * mask).sum(axis=1)
+    return (summed / np.clip(mask.sum(axis=1), 1e-9, None)).astype(np.float32)
+
+
+def make_embedding_backend(name: str=None):
+    """Backend named by EMBEDDING_BACKEND, torch unless set to onnx"""
+    name = name or get_embedding_backend()
+    if name == "torch":
+        return TorchEmbeddingBackend()
+    if name == "onnx":
+        return OnnxEmbeddingBackend(get_embedding_onnx_path())
+    raise EmbeddingBackendError(f"Unknown embedding backend {name}")
+
+
+def export_onnx(out_dir: str, model_name: str=EMBEDDING_MODEL_NAME, quantize: bool=True) -> None:
+    """Exports the transformer of the sentence_transformers model and its
+    tokenizer, with an int8 dynamically quantized copy of the model"""
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_name, device="cpu")
+    export_transformer(model[0].auto_model, model.tokenizer, out_dir, quantize)
+
+
+def export_transformer(transformer, tokenizer, out_dir: str, quantize: bool=True) -> None:
+    import torch
+
+    os.makedirs(out_dir, exist_ok=True)
+    model_path = os.path.join(out_dir, ONNX_MODEL_FILE)
+
+    sample = tokenizer(["Export the model.", "Two sentences."], padding=True, return_tensors="pt")
+    input_names = ["input_ids", "attention_mask", "token_type_ids"]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["token_embeddings"] = {0: "batch", 1: "sequence"}
+
+    transformer.eval()
+    with torch.no_grad():
+        torch.onnx.export(
+            transformer,
+            tuple(sample[name] for name in input_names),
+            model_path,
+            input_names=input_names,
+            output_names=["token_embeddings"],
+            dynamic_axes=dynamic_axes,
+            opset_version=14,
+        )
+    tokenizer.backend_tokenizer.save(os.path.join(out_dir, TOKENIZER_FILE))
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(model_path, os.path.join(out_dir, ONNX_QUANTIZED_MODEL_FILE),
+            weight_type=QuantType.QInt8)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--out", default=get_embedding_onnx_path())
+    parser.add_argument("--model", default=EMBEDDING_MODEL_NAME)
+    parser.add_argument("--no-quantize", action="store_true")
+    args = parser.parse_args()
+
+    export_onnx(args.out, args.model, quantize=not args.no_quantize)
+    print(f"Exported {args.model} to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
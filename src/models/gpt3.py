@@ -1,11 +1,19 @@
-import os
+import asyncio
+import contextlib
+import functools
 import random
 
 import openai
 from dotenv import load_dotenv
 from time import sleep
 
-from src.constants import MAX_RATE_LIMIT_ERRORS, REQ_FAILURE_TIMEOUT_SECS
+from typing import AsyncContextManager, AsyncIterator, Callable, List, Optional, Union
+
+from src.constants import BATCH_MAX_PROMPTS, MAX_RATE_LIMIT_ERRORS, REQ_BACKOFF_MAX_SECS, \
+    REQ_FAILURE_TIMEOUT_SECS
+from src.models.cache import CompletionCache, request_key
+from src.models.key_scheduler import APIKeyScheduler, default_key_scheduler
+from src.models.single_flight import SingleFlight
 
 load_dotenv()
 
@@ -18,26 +26,11 @@ class OpenAIRateLimitError(Exception):
 
     pass
 
-class APIKeyRoundRobinSelector:
-    def __init__(self, user_api_key=None):
-        self.curr_index: int = 0
-        self.user_api_key = user_api_key
-        self.keys: list[str] = [x.strip() for x in os.getenv("OPENAI_API_KEY").split(",")]
-
-    def update_round_robin_index(self):
-        if self.curr_index == len(self.keys) - 1:
-            self.curr_index = 0
-            return
-        self.curr_index += 1
+def backoff_delay(attempt: int) -> float:
+    """Exponential backoff with full jitter for the given retry attempt"""
+    cap = min(REQ_BACKOFF_MAX_SECS, REQ_FAILURE_TIMEOUT_SECS * 2 ** attempt)
+    return random.uniform(0, cap)
 
-    def get_api_key(self) -> str:
-        # roundrobin scheduler
-        if self.user_api_key:
-            return self.user_api_key
-        next_key = self.keys[self.curr_index]
-        self.update_round_robin_index()
-        return next_key
-        
 
 def error_handling(func):
     def wrapper(self, *args, unavailable_count=0, rate_limit_count=0, **kwargs):
@@ -47,16 +40,18 @@ def error_handling(func):
             return func(self, *args, **kwargs)
 
         except openai.error.RateLimitError:
-            # key didn't work - sleep and try a different one from round robin
+            # key didn't work - try a different one from the pool, sleeping
+            # only when every pooled key is cooling down
             print("timeout error")
 
             if rate_limit_count >= MAX_RATE_LIMIT_ERRORS:
                 raise OpenAIRateLimitError
 
             self.rate_limited = True
-            sleep(REQ_FAILURE_TIMEOUT_SECS)
+            if self.key_scheduler.seconds_until_available() > 0:
+                sleep(REQ_FAILURE_TIMEOUT_SECS)
 
-            return wrapper(self, *args, **kwargs, 
+            return wrapper(self, *args, **kwargs,
                 unavailable_count=unavailable_count, rate_limit_count=rate_limit_count+1)
 
         except (openai.error.ServiceUnavailableError, openai.error.APIConnectionError):
@@ -67,63 +62,301 @@ def error_handling(func):
     return wrapper
 
 
+def async_error_handling(func):
+    """Same contract as error_handling, but waits between retries with
+    asyncio.sleep so that other coroutines on the event loop keep running"""
+
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        rate_limit_count = 0
+
+        while True:
+            try:
+                result = await func(self, *args, **kwargs)
+
+            except openai.error.RateLimitError:
+                print("timeout error")
+
+                if rate_limit_count >= MAX_RATE_LIMIT_ERRORS:
+                    raise OpenAIRateLimitError
+
+                self.rate_limited = True
+                await asyncio.sleep(self.retry_delay(rate_limit_count))
+                rate_limit_count += 1
+
+            except (openai.error.ServiceUnavailableError, openai.error.APIConnectionError):
+                raise OpenAIUnavailableError
+
+            else:
+                # the key of the model is tried again by the next call
+                self.rate_limited = False
+                return result
+
+    return wrapper
+
+
 class GPT3Model:
 
     def __init__(self, api_key=None, temperature=0.5, max_tokens=256, presence_penalty=2,
-            frequency_penalty = 2) -> None:
+            frequency_penalty = 2, cache: CompletionCache=None, use_cache=True,
+            single_flight: SingleFlight=None, key_scheduler: APIKeyScheduler=None,
+            gate: Callable[[], AsyncContextManager]=None) -> None:
 
         self.api_key = api_key
         self.rate_limited = False
 
-        self.round_robin_scheduler = APIKeyRoundRobinSelector()
+        # use_cache=False skips lookups for a fresh sample, the new response
+        # still replaces the cached one
+        self.cache = cache
+        self.use_cache = use_cache
+
+        # shared between models so that identical concurrent async requests
+        # are sent once, fresh samples are never coalesced
+        self.single_flight = single_flight
+
+        self.key_scheduler = key_scheduler if key_scheduler is not None else default_key_scheduler()
+
+        # async calls to the API each hold a slot from the gate, e.g. of the
+        # server wide generation scheduler, while they run
+        self.gate = gate
 
         self.temperature = temperature
         self.max_tokens = max_tokens
         self.presence_penalty = presence_penalty
         self.frequency_penalty = frequency_penalty
 
+    def _completion_params(self, prompt: Union[str, List[str]], suffix: str=None) -> dict:
+        params = {
+            "model": "text-davinci-003",
+            "prompt": prompt,
+            "temperature": self.temperature,
+            "max_tokens": self.max_tokens,
+            "presence_penalty": self.presence_penalty,
+            "frequency_penalty": self.frequency_penalty,
+        }
+        if suffix is not None:
+            params["suffix"] = suffix
+        return params
 
-    @error_handling
-    def complete(self, prompt: str) -> str:
-        response = openai.Completion.create(
-            model="text-davinci-003",
-            prompt=prompt,
-            temperature=self.temperature,
-            max_tokens=self.max_tokens,
-            presence_penalty=self.presence_penalty,
-            frequency_penalty=self.frequency_penalty,
-            api_key=self.next_api_key,
-        )
-        return response.choices[0].text
+    def _edit_params(self, text_to_edit: str, instruction: str) -> dict:
+        return {
+            "model": "text-davinci-edit-001",
+            "input": text_to_edit,
+            "instruction": instruction,
+            "temperature": self.temperature,
+        }
+
+    @staticmethod
+    def _cacheable(text: str, accept: Optional[Callable[[str], bool]]) -> bool:
+        # empty completions and ones the caller cannot parse are never kept,
+        # so that asking again samples the model instead of the cache
+        return bool(text.strip()) and (accept is None or accept(text))
+
+    def _cache_lookup(self, key: str, accept: Optional[Callable[[str], bool]]=None):
+        if self.cache is None or not self.use_cache:
+            return None
+        text = self.cache.get(key)
+        if text is not None and not self._cacheable(text, accept):
+            return None
+        return text
+
+    def _cache_store(self, key: str, text: str, accept: Optional[Callable[[str], bool]]=None) -> None:
+        if self.cache is not None and self._cacheable(text, accept):
+            self.cache.set(key, text)
+
+    def _estimate_tokens(self, params: dict) -> int:
+        # rough count of ~4 characters per token, the scheduler only needs
+        # an estimate of how much of a key's budget a request uses
+        text = params.get("prompt", params.get("input", ""))
+        if isinstance(text, list):
+            return sum(len(prompt) // 4 + params["max_tokens"] for prompt in text)
+        return len(text) // 4 + params.get("max_tokens", len(text) // 4)
+
+    def _select_api_key(self, params: dict) -> str:
+        if self.api_key is None or self.rate_limited:
+            return self.key_scheduler.acquire(self._estimate_tokens(params))
+        return self.api_key
+
+    def _send(self, resource, params: dict, **kwargs):
+        api_key = self._select_api_key(params)
+        try:
+            response = resource.create(**params, **kwargs, api_key=api_key)
+        except openai.error.RateLimitError:
+            self.key_scheduler.report_rate_limited(api_key)
+            raise
+
+        self.key_scheduler.report_success(api_key)
+        return response
+
+    def _create(self, resource, params: dict) -> List[str]:
+        """Returns the text of every choice, in the order of the prompts"""
+        response = self._send(resource, params)
+        return [choice.text for choice in sorted(response.choices, key=lambda choice: choice.index)]
+
+    def retry_delay(self, attempt: int) -> float:
+        """Retry straight away on another pooled key when one is healthy,
+        otherwise back off at least until the first key leaves its cooldown"""
+        wait = self.key_scheduler.seconds_until_available()
+        if wait == 0:
+            return 0
+        return max(wait, backoff_delay(attempt))
+
+    def _slot(self) -> AsyncContextManager:
+        return self.gate() if self.gate is not None else contextlib.nullcontext()
 
     @error_handling
+    def _request(self, resource, params: dict) -> List[str]:
+        return self._create(resource, params)
+
+    @async_error_handling
+    async def _arequest(self, resource, params: dict) -> List[str]:
+        # openai has no native async client in this version, so the blocking
+        # request is moved off the event loop into the default executor
+        loop = asyncio.get_running_loop()
+        async with self._slot():
+            return await loop.run_in_executor(
+                None, functools.partial(self._create, resource, params))
+
+    @async_error_handling
+    async def _aopen_stream(self, resource, params: dict):
+        # errors such as rate limits are raised when the stream is opened,
+        # before any text arrives, so this is the part that gets retried
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(self._send, resource, params, stream=True))
+
+    async def _astream(self, resource, params: dict) -> AsyncIterator[str]:
+        # the slot is held until the whole stream has been read
+        async with self._slot():
+            async for chunk in self._astream_unguarded(resource, params):
+                yield chunk
+
+    async def _astream_unguarded(self, resource, params: dict) -> AsyncIterator[str]:
+        stream = await self._aopen_stream(resource, params)
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        done = object()
+
+        def pump():
+            # reads the blocking event stream on a worker thread and hands
+            # every chunk over to the event loop
+            try:
+                for part in stream:
+                    loop.call_soon_threadsafe(queue.put_nowait, part.choices[0].text)
+                loop.call_soon_threadsafe(queue.put_nowait, done)
+            except Exception as error:
+                loop.call_soon_threadsafe(queue.put_nowait, error)
+
+        loop.run_in_executor(None, pump)
+
+        while True:
+            item = await queue.get()
+            if item is done:
+                return
+            if isinstance(item, openai.error.OpenAIError):
+                raise OpenAIUnavailableError from item
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def _call(self, resource, params: dict, accept: Optional[Callable[[str], bool]]=None) -> str:
+        key = request_key(resource.__name__, params)
+        text = self._cache_lookup(key, accept)
+        if text is None:
+            text = self._request(resource, params)[0]
+            self._cache_store(key, text, accept)
+        return text
+
+    async def _acall(self, resource, params: dict, accept: Optional[Callable[[str], bool]]=None) -> str:
+        key = request_key(resource.__name__, params)
+        text = self._cache_lookup(key, accept)
+        if text is not None:
+            return text
+
+        async def fetch():
+            fetched = (await self._arequest(resource, params))[0]
+            self._cache_store(key, fetched, accept)
+            return fetched
+
+        if self.single_flight is None or not self.use_cache:
+            return await fetch()
+        return await self.single_flight.do(key, fetch)
+
+
+    def complete(self, prompt: str, accept: Optional[Callable[[str], bool]]=None) -> str:
+        """Completes the prompt. When given, accept tells whether a completion
+        can be used, only accepted completions are cached."""
+        return self._call(openai.Completion, self._completion_params(prompt), accept)
+
     def insert(self, prompt: str, suffix: str) -> str:
-        response = openai.Completion.create(
-            model="text-davinci-003",
-            prompt=prompt,
-            suffix=suffix,
-            temperature=self.temperature,
-            max_tokens=self.max_tokens,
-            presence_penalty=self.presence_penalty,
-            frequency_penalty=self.frequency_penalty,
-            api_key=self.next_api_key,
-        )
-        return response.choices[0].text
+        return self._call(openai.Completion, self._completion_params(prompt, suffix))
 
-    @error_handling
     def edit(self, text_to_edit: str, instruction: str) -> str:
-        response = openai.Edit.create(
-            model="text-davinci-edit-001",
-            input=text_to_edit,
-            instruction=instruction,
-            temperature=self.temperature,
-            api_key=self.next_api_key,
-        )
-        return response.choices[0].text
-    
-    @property
-    def next_api_key(self):
-        if self.api_key is None or self.rate_limited:
-            return self.round_robin_scheduler.get_api_key()
-        else:
-            return self.api_key
+        return self._call(openai.Edit, self._edit_params(text_to_edit, instruction))
+
+    async def acomplete(self, prompt: str, accept: Optional[Callable[[str], bool]]=None) -> str:
+        return await self._acall(openai.Completion, self._completion_params(prompt), accept)
+
+    async def acomplete_stream(self, prompt: str,
+            accept: Optional[Callable[[str], bool]]=None) -> AsyncIterator[str]:
+        """Yields the completion in chunks as the model produces them. A
+        cached completion is yielded whole."""
+        params = self._completion_params(prompt)
+        key = request_key(openai.Completion.__name__, params)
+
+        cached = self._cache_lookup(key, accept)
+        if cached is not None:
+            yield cached
+            return
+
+        chunks = []
+        async for chunk in self._astream(openai.Completion, params):
+            chunks.append(chunk)
+            yield chunk
+
+        self._cache_store(key, "".join(chunks), accept)
+
+    async def ainsert(self, prompt: str, suffix: str) -> str:
+        return await self._acall(openai.Completion, self._completion_params(prompt, suffix))
+
+    async def aedit(self, text_to_edit: str, instruction: str) -> str:
+        return await self._acall(openai.Edit, self._edit_params(text_to_edit, instruction))
+
+    def _batch_lookup(self, prompts: List[str], accept: Optional[Callable[[str], bool]]):
+        keys = [request_key(openai.Completion.__name__, self._completion_params(prompt))
+            for prompt in prompts]
+        results = [self._cache_lookup(key, accept) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        chunks = [missing[i:i + BATCH_MAX_PROMPTS] for i in range(0, len(missing), BATCH_MAX_PROMPTS)]
+        return keys, results, chunks
+
+    def _batch_store(self, chunk: List[int], texts: List[str], keys: List[str], results: List[str],
+            accept: Optional[Callable[[str], bool]]) -> None:
+        for i, text in zip(chunk, texts):
+            results[i] = text
+            self._cache_store(keys[i], text, accept)
+
+    def complete_batch(self, prompts: List[str], accept: Optional[Callable[[str], bool]]=None) -> List[str]:
+        """Completes every prompt, sending cache misses together in as few
+        requests as the endpoint allows. Results are in the order of prompts."""
+        keys, results, chunks = self._batch_lookup(prompts, accept)
+
+        for chunk in chunks:
+            params = self._completion_params([prompts[i] for i in chunk])
+            self._batch_store(chunk, self._request(openai.Completion, params), keys, results, accept)
+
+        return results
+
+    async def acomplete_batch(self, prompts: List[str],
+            accept: Optional[Callable[[str], bool]]=None) -> List[str]:
+        keys, results, chunks = self._batch_lookup(prompts, accept)
+
+        responses = await asyncio.gather(*[
+            self._arequest(openai.Completion, self._completion_params([prompts[i] for i in chunk]))
+            for chunk in chunks
+        ])
+        for chunk, texts in zip(chunks, responses):
+            self._batch_store(chunk, texts, keys, results, accept)
+
+        return results
@@ -0,0 +1,148 @@
+""" Module for choosing which OpenAI API key to send a request with.
+"""
+import os
+import threading
+import time
+from typing import Callable, List, Optional
+
+from src.constants import API_KEY_COOLDOWN_SECS, API_KEY_REQUESTS_PER_MIN, API_KEY_TOKENS_PER_MIN
+
+
+class TokenBucket:
+    """Budget which refills continuously up to its capacity. Consuming more
+    than is available leaves the bucket in debt until it refills."""
+
+    def __init__(self, capacity: float, refill_per_sec: float, clock: Callable[[], float]) -> None:
+        self.capacity = capacity
+        self.refill_per_sec = refill_per_sec
+        self.clock = clock
+
+        self.tokens = capacity
+        self.updated_at = clock()
+
+    def _refill(self) -> None:
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_per_sec)
+        self.updated_at = now
+
+    def available(self) -> float:
+        self._refill()
+        return self.tokens
+
+    def consume(self, amount: float) -> None:
+        self._refill()
+        self.tokens -= amount
+
+    def headroom(self) -> float:
+        return self.available() / self.capacity
+
+
+class KeyState:
+
+    def __init__(self, key: str, requests_per_min: float, tokens_per_min: float,
+            clock: Callable[[], float]) -> None:
+        self.key = key
+        self.requests = TokenBucket(requests_per_min, requests_per_min / 60, clock)
+        self.tokens = TokenBucket(tokens_per_min, tokens_per_min / 60, clock)
+
+        self.cooldown_until = 0.0
+        self.consecutive_rate_limits = 0
+
+        self.num_requests = 0
+        self.num_rate_limits = 0
+
+    def headroom(self) -> float:
+        return min(self.requests.headroom(), self.tokens.headroom())
+
+
+class APIKeyScheduler:
+    """Picks the pooled key with the most request and token budget left,
+    skipping keys cooling down after a RateLimitError"""
+
+    def __init__(
+        self,
+        keys: List[str],
+        requests_per_min: float=API_KEY_REQUESTS_PER_MIN,
+        tokens_per_min: float=API_KEY_TOKENS_PER_MIN,
+        cooldown_secs: float=API_KEY_COOLDOWN_SECS,
+        clock: Callable[[], float]=time.monotonic,
+    ) -> None:
+        self.cooldown_secs = cooldown_secs
+        self.clock = clock
+        self._states = {
+            key: KeyState(key, requests_per_min, tokens_per_min, clock) for key in keys
+        }
+        self._lock = threading.Lock()
+
+    def acquire(self, estimated_tokens: int=0) -> str:
+        """Reserves budget for one request on the healthiest key. When every
+        key is cooling down the one that recovers first is returned."""
+        with self._lock:
+            now = self.clock()
+            ready = [state for state in self._states.values() if state.cooldown_until <= now]
+
+            if ready:
+                state = max(ready, key=lambda state: state.headroom())
+            else:
+                state = min(self._states.values(), key=lambda state: state.cooldown_until)
+
+            state.requests.consume(1)
+            state.tokens.consume(estimated_tokens)
+            state.num_requests += 1
+
+            return state.key
+
+    def report_success(self, key: str) -> None:
+        with self._lock:
+            state = self._states.get(key)
+            if state is not None:
+                state.consecutive_rate_limits = 0
+
+    def report_rate_limited(self, key: str) -> None:
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                return
+
+            # repeated 429s on the same key back off exponentially
+            state.cooldown_until = self.clock() + \
+                self.cooldown_secs * 2 ** min(state.consecutive_rate_limits, 4)
+            state.consecutive_rate_limits += 1
+            state.num_rate_limits += 1
+
+    def seconds_until_available(self) -> float:
+        with self._lock:
+            now = self.clock()
+            return max(0.0, min(state.cooldown_until for state in self._states.values()) - now)
+
+    def state(self) -> List[dict]:
+        with self._lock:
+            now = self.clock()
+            return [
+                {
+                    "key": mask_key(state.key),
+                    "requestHeadroom": state.requests.headroom(),
+                    "tokenHeadroom": state.tokens.headroom(),
+                    "cooldownSecs": max(0.0, state.cooldown_until - now),
+                    "numRequests": state.num_requests,
+                    "numRateLimits": state.num_rate_limits,
+                }
+                for state in self._states.values()
+            ]
+
+
+def mask_key(key: str) -> str:
+    return f"...{key[-4:]}"
+
+
+_default_scheduler: Optional[APIKeyScheduler] = None
+
+
+def default_key_scheduler() -> APIKeyScheduler:
+    """Process wide scheduler over the keys in OPENAI_API_KEY, shared so that
+    every request sees the same budgets and cooldowns"""
+    global _default_scheduler
+    if _default_scheduler is None:
+        _default_scheduler = APIKeyScheduler(
+            [x.strip() for x in os.getenv("OPENAI_API_KEY").split(",")])
+    return _default_scheduler
@@ -0,0 +1,46 @@
+""" Module for coalescing concurrent identical model requests.
+"""
+import asyncio
+from typing import Awaitable, Callable, Dict
+
+
+class SingleFlight:
+    """Shares one in-flight call between all concurrent callers using the same
+    key, so identical requests only pay for one round trip.
+
+    The shared call runs as its own task: a caller being cancelled does not
+    cancel the request for everyone else waiting on it."""
+
+    def __init__(self) -> None:
+        self._in_flight: Dict[str, asyncio.Task] = {}
+
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, call: Callable[[], Awaitable]):
+        task = self._in_flight.get(key)
+
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(call())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.coalesced += 1
+
+        return await asyncio.shield(task)
+
+    def _forget(self, key: str, task: asyncio.Task) -> None:
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+
+        # mark the exception as retrieved in case every waiter was cancelled
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "inFlight": len(self._in_flight),
+        }
@@ -0,0 +1,122 @@
+""" Module for building story prompts which fit in the model context.
+"""
+import functools
+import math
+import re
+from dataclasses import dataclass
+from typing import Dict, List
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+from src.constants import PROMPT_TOKEN_BUDGETS, PROMPT_TOKEN_COUNT_CACHE_SIZE, TOKENIZER_ENCODING
+
+
+class ApproximateTokenCounter:
+    """Estimates GPT tokens as ~4 characters each, used when tiktoken or its
+    encoding files are not available"""
+
+    CHARS_PER_TOKEN = 4
+
+    def count(self, text: str) -> int:
+        return math.ceil(len(text) / self.CHARS_PER_TOKEN)
+
+    def tail(self, text: str, num_tokens: int) -> str:
+        return text[len(text) - num_tokens * self.CHARS_PER_TOKEN:] if num_tokens > 0 else ""
+
+
+class TiktokenCounter:
+    """Exact token counts using the encoding of the completion model"""
+
+    def __init__(self, encoding_name: str=TOKENIZER_ENCODING) -> None:
+        self.encoding = tiktoken.get_encoding(encoding_name)
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode(text))
+
+    def tail(self, text: str, num_tokens: int) -> str:
+        if num_tokens <= 0:
+            return ""
+        return self.encoding.decode(self.encoding.encode(text)[-num_tokens:])
+
+
+_default_counter = None
+
+
+def default_token_counter():
+    global _default_counter
+    if _default_counter is None:
+        try:
+            _default_counter = TiktokenCounter()
+        except Exception:
+            # tiktoken missing, or its encoding could not be downloaded
+            _default_counter = ApproximateTokenCounter()
+    return _default_counter
+
+
+@dataclass
+class StoryPrompt:
+
+    text: str
+
+    num_tokens: int
+
+    num_paragraphs: int
+
+    num_dropped: int
+
+
+class PromptBuilder:
+    """Joins the paragraphs of a story into a prompt within the token budget
+    of the operation. The most recent paragraphs are kept verbatim, the oldest
+    one that still partially fits is cut to its last sentences and anything
+    older is dropped."""
+
+    # a trimmed paragraph shorter than this adds noise rather than context
+    MIN_TRIMMED_TOKENS = 32
+
+    def __init__(self, budgets: Dict[str, int]=None, counter=None) -> None:
+        self.budgets = {**PROMPT_TOKEN_BUDGETS, **(budgets or {})}
+        self.counter = counter if counter is not None else default_token_counter()
+        self._count_paragraph = functools.lru_cache(maxsize=PROMPT_TOKEN_COUNT_CACHE_SIZE)(self.counter.count)
+
+    def build(self, paragraph_list: List[str], operation: str) -> StoryPrompt:
+        budget = self.budgets[operation]
+
+        kept = []
+        num_tokens = 0
+        num_dropped = 0
+
+        for paragraph in reversed(paragraph_list):
+            # paragraphs are joined by a single space, roughly one token
+            paragraph_tokens = self._count_paragraph(paragraph) + (1 if kept else 0)
+
+            if num_tokens + paragraph_tokens <= budget:
+                kept.append(paragraph)
+                num_tokens += paragraph_tokens
+                continue
+
+            remaining = budget - num_tokens - 1
+            if remaining >= self.MIN_TRIMMED_TOKENS or not kept:
+                trimmed = self._trim_start(paragraph, remaining)
+                if trimmed:
+                    kept.append(trimmed)
+                    num_tokens += self.counter.count(trimmed) + (1 if len(kept) > 1 else 0)
+
+            num_dropped = len(paragraph_list) - len(kept)
+            break
+
+        return StoryPrompt(
+            text=" ".join(reversed(kept)),
+            num_tokens=num_tokens,
+            num_paragraphs=len(paragraph_list),
+            num_dropped=num_dropped,
+        )
+
+    def _trim_start(self, paragraph: str, num_tokens: int) -> str:
+        tail = self.counter.tail(paragraph, num_tokens)
+        # start at a sentence boundary when there is one
+        match = re.search(r"[.!?]\s+(?=\S)", tail)
+        return tail[match.end():] if match else tail.lstrip()
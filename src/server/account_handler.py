@@ -8,6 +8,7 @@ import tornado.websocket
 from pymongo import ReturnDocument
 
 from src.config import get_app_url
+from src.server.story_codec import decoded_story, load_meta, story_document, story_update
 
 
 class WebBaseHandler(tornado.web.RequestHandler):  # noqa
@@ -172,12 +173,6 @@ class UserStoriesHandler(AuthBaseHandler):  # noqa
     def get(self):
         ...
 
-    def get_total_sections(self, story):
-        # Each section has 1 narrative node so we count number of narrative
-        # nodes
-        return len([node for node in story["story"]["nodes"]
-            if node["type"] == "narrative"])
-
     async def post(self):
         email = await self.get_email_from_session()
         if email is None:
@@ -193,13 +188,14 @@ class UserStoriesHandler(AuthBaseHandler):  # noqa
                     "user_email": email,
                     "_id": story_id,
                     "name": "Story",
-                    "story": {"nodes": []},
+                    **story_document({"nodes": []}),
                 }
             )
             self.write(json.dumps({"storyId": story_id}))
 
         elif req_type == "getStories":
-            stories = self.settings["db"]["stories"].find({"user_email": email})
+            # stories with metadata are listed without reading their graphs
+            stories = self.settings["db"]["stories"].find({"user_email": email}, {"storyData": 0})
             # this is because you can't use an object of type MotorCursor in an 'await' expression, so you have to
             # iterate asynchronously.
             temp_story_list = []
@@ -212,10 +208,13 @@ class UserStoriesHandler(AuthBaseHandler):  # noqa
             for story in temp_story_list:
                 firstParagraph = "ATTENTION: First paragraph of story not yet generated."
 
-                totalSections = self.get_total_sections(story);
+                meta = load_meta(story)
+
+                # Each section has 1 narrative node
+                totalSections = meta["totalSections"]
                 
-                if story["story"]["nodes"]:
-                    firstParagraph = story["story"]["nodes"][0]["data"]
+                if meta["firstParagraph"] is not None:
+                    firstParagraph = meta["firstParagraph"]
 
                 story_list.append({
                     "name": story["name"],
@@ -244,7 +243,7 @@ class UserStoriesHandler(AuthBaseHandler):  # noqa
                 {
                     "_id": story_id,
                 },
-                {"$set": {"story": updated_story}},
+                story_update(updated_story),
                 return_document=ReturnDocument.AFTER,
             )
 
@@ -254,7 +253,7 @@ class UserStoriesHandler(AuthBaseHandler):  # noqa
                 {"_id": story_id}, {"_id": 0, "email": 0}
             )
             if story["user_email"] == email:
-                self.write(json.dumps(story))
+                self.write(json.dumps(decoded_story(story)))
             else:
                 self.set_status(403)
         
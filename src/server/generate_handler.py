@@ -1,13 +1,20 @@
 import json
+from typing import Optional, Tuple
 
 import tornado
 import tornado.web
 import tornado.websocket
 
+from src.constants import (FUSE_ACTION_REWRITE, GENERATE_MANY_CONCURRENCY, GENERATE_MANY_NODE_BUDGET,
+    GRAPH_DELTA_MAX_FRACTION, LLM_ENDING_FALLBACK, LOCAL_ENDING_CHECK)
 from src.models.gpt3 import GPT3Model, OpenAIRateLimitError, OpenAIUnavailableError
-from src.gamebook_generator import GamebookGenerator, GenerationProgressFeedback
+from src.gamebook_generator import GamebookGenerator
+from src.server.generation_jobs import GenerationJob, GenerationJobFeedback
+from src.server.generation_scheduler import GenerationScheduler
+from src.server.speculation import SpeculativeNarratives
+from src.server.story_codec import load_graph
 from src.text_generator import TextGenerator, GenerationError
-from src.graph import GamebookGraph
+from src.graph import GamebookGraph, GraphCycleError
 
 
 class AuthBaseHandler(tornado.websocket.WebSocketHandler):  # noqa
@@ -26,7 +33,7 @@ class AuthBaseHandler(tornado.websocket.WebSocketHandler):  # noqa
             return None
         return user["email"]
 
-class GenerateHandler(AuthBaseHandler, GenerationProgressFeedback):  # noqa
+class GenerateHandler(AuthBaseHandler, GenerationJobFeedback):  # noqa
     """Simple Http handler to serve clients."""
 
     def check_origin(self, origin: str) -> bool:
@@ -40,11 +47,37 @@ class GenerateHandler(AuthBaseHandler, GenerationProgressFeedback):  # noqa
         if user is None:
             self.close()
         else:
+            self.email = email
             self.api_key = user.get("api_key", None)
             if self.api_key == "":
                 self.api_key = None
+            self.speculation = SpeculativeNarratives()
+            self.delta_sync = False
+            # id of the graph of the open story in the graph store
+            self.graph_id: Optional[str] = None
 
-    def on_message(self, json_msg):
+    def make_generator(self, temperature: float, priority: int, use_cache: bool=True) -> GamebookGenerator:
+        scheduler = self.settings.get("generation_scheduler")
+        model = GPT3Model(
+            self.api_key,
+            temperature=temperature,
+            cache=self.settings.get("completion_cache"),
+            use_cache=use_cache,
+            single_flight=self.settings.get("single_flight"),
+            key_scheduler=self.settings.get("key_scheduler"),
+            gate=scheduler.gate(self.email, self.api_key, priority) if scheduler is not None else None,
+        )
+        return GamebookGenerator(TextGenerator(model), fuse_action_rewrite=FUSE_ACTION_REWRITE,
+            local_ending_check=LOCAL_ENDING_CHECK, llm_ending_fallback=LLM_ENDING_FALLBACK)
+
+    def speculate(self, graph: GamebookGraph, action_ids, temperature: float, data: dict):
+        """Generates narratives for new actions in the background, with the
+        narrative options of the request, for a later generateNarrative"""
+        generator = self.make_generator(temperature, GenerationScheduler.SPECULATIVE)
+        self.speculation.speculate(generator, graph, action_ids, temperature,
+            descriptor=data.get("descriptor"), details=data.get("details"), style=data.get("style"))
+
+    async def on_message(self, json_msg):
         """
         Message received on channel
         """
@@ -53,26 +86,68 @@ class GenerateHandler(AuthBaseHandler, GenerationProgressFeedback):  # noqa
 
             req_type = msg["type"]
             data = msg["data"]
+            # clients that apply graph deltas set delta, and acknowledge the
+            # versions of job graphs they have applied
+            self.delta_sync = msg.get("delta", self.delta_sync)
+
+            if req_type == "ackGraph":
+                job = self.settings["generation_jobs"].get(data["jobId"], self.email)
+                if job is not None:
+                    job.ack(self, data["version"])
+                return
+
+            if req_type == "cancelJob":
+                # the job sends jobCancelled once it has stopped
+                if not self.settings["generation_jobs"].cancel(data["jobId"], self.email):
+                    self.send_job_not_found(data["jobId"])
+                return
+
             temperature = msg["temperature"]
+            # clients set fresh when the user explicitly asks to regenerate
+            fresh = msg.get("fresh", False)
+            # clients ask for narratives of new actions to be generated ahead
+            # of time by setting speculate
+            speculate = data.get("speculate", False)
+
+            # whole tree generation queues behind the requests a user is
+            # waiting on
+            priority = GenerationScheduler.BULK if req_type in ("generateMany", "resumeJob") \
+                else GenerationScheduler.INTERACTIVE
+            generator = self.make_generator(temperature, priority, use_cache=not fresh)
 
-            generator = GamebookGenerator(TextGenerator(GPT3Model(self.api_key, temperature=temperature)))
+            if req_type == "resumeJob":
+                await self.resume_job(data["jobId"], generator)
+                return
 
             if req_type == "initialStory":
                 initial_story_prompt = data["prompt"]
 
-                graph = generator.generate_initial_story(initial_story_prompt)    
+                graph = await generator.agenerate_initial_story(initial_story_prompt)    
+                self.store_graph(graph)
+                client_version = None
 
             else:
-                graph = GamebookGraph.from_graph_dict(data["graph"])
+                graph, client_version = self.request_graph(data)
+                if graph is None:
+                    # the client uploads the whole graph again
+                    self.write_message(json.dumps({
+                        "resType": "graphOutOfSync",
+                        "graphId": data["graphRef"]["graphId"],
+                    }))
+                    return
 
             if req_type == "generateActions":
                 node_to_expand = data["nodeToExpand"]
-                generator.generate_actions_from_narrative(graph, node_to_expand)
+                action_ids = await generator.agenerate_actions_from_narrative(graph, node_to_expand)
+                if speculate:
+                    self.speculate(graph, action_ids, temperature, data)
 
             elif req_type == "addAction":
                 node_to_expand = data["nodeToExpand"]
                 num_new_actions = data["numNewActions"]
-                generator.add_actions(graph, node_to_expand, num_new_actions=num_new_actions)
+                action_ids = await generator.aadd_actions(graph, node_to_expand, num_new_actions=num_new_actions)
+                if speculate:
+                    self.speculate(graph, action_ids, temperature, data)
 
             elif req_type == "generateNarrative":
                 node_to_expand = data["nodeToExpand"]
@@ -80,34 +155,55 @@ class GenerateHandler(AuthBaseHandler, GenerationProgressFeedback):  # noqa
                 descriptor = data["descriptor"]
                 details = data["details"]
                 style = data["style"]
+                stream = data.get("stream", False)
 
-                generator.generate_narrative_from_action(
-                    graph, 
-                    node_to_expand, 
-                    is_ending, 
-                    descriptor,
-                    details,
-                    style
-                )
+                # a narrative generated ahead of time is only used when it was
+                # made for exactly this request
+                narrative_id = None if fresh else await self.speculation.aexpand(
+                    graph, node_to_expand, temperature, is_ending, descriptor, details, style)
+                if narrative_id is not None:
+                    if stream:
+                        self.send_narrative_chunk(node_to_expand, graph.get_data(narrative_id))
+                else:
+                    await generator.agenerate_narrative_from_action(
+                        graph,
+                        node_to_expand,
+                        is_ending,
+                        descriptor,
+                        details,
+                        style,
+                        on_chunk=(lambda chunk: self.send_narrative_chunk(node_to_expand, chunk))
+                            if stream else None
+                    )
 
             elif req_type == "connectNode":
                 from_node = data["fromNode"]
                 to_node = data["toNode"]
 
-                generator.bridge_node(graph, from_node, to_node)
+                await generator.abridge_node(graph, from_node, to_node)
 
             elif req_type == "generateMany":
                 from_node: int = data["fromNode"]
                 max_depth: int = data["maxDepth"]
-                # save_to_id = msg["saveToId"]
-
-                generator.generate_many(graph, from_node, max_depth, self)
+                # partial results are checkpointed to this story while generating
+                save_to_id = msg.get("saveToId")
 
-                # TODO Save graph to id
+                options = {
+                    "batch": data.get("batch", False),
+                    "concurrency": data.get("concurrency", GENERATE_MANY_CONCURRENCY),
+                    "pipelined": data.get("pipelined", False),
+                    "node_budget": data.get("nodeBudget", GENERATE_MANY_NODE_BUDGET),
+                }
+                # runs as a job, which sends requestComplete once it finishes
+                job = GenerationJob(self.email, graph, from_node, max_depth, options, story_id=save_to_id)
+                self.start_job(job, generator, acked_version=client_version)
+                return
 
             self.write_message(json.dumps({
                 "resType": "requestComplete", 
-                "graph": graph.to_graph_dict(),
+                "graphId": self.graph_id,
+                **self.graph_payload(graph, client_version),
+                "promptTokens": generator.prompt_tokens,
             }))
 
         except OpenAIRateLimitError:
@@ -125,15 +221,142 @@ class GenerateHandler(AuthBaseHandler, GenerationProgressFeedback):  # noqa
                 "resType": "nlpParseError", 
             }))
 
-    def send_generation_update(
-        self,
-        graph: GamebookGraph,
-        num_nodes_generated: int,
-        percentage: float
-    ):
+        except GraphCycleError:
+            self.write_message(json.dumps({
+                "resType": "graphCycleError",
+            }))
+
+    def on_close(self):
+        self.settings["generation_jobs"].detach_all(self)
+        if hasattr(self, "speculation"):
+            self.speculation.cancel_all()
+            self.store_graph(None)
+
+    def store_graph(self, graph: Optional[GamebookGraph]):
+        """Makes the graph the one of the open story, replacing the previous"""
+        store = self.settings.get("graph_store")
+        if store is None:
+            return
+        if self.graph_id is not None:
+            store.remove(self.email, self.graph_id)
+        self.graph_id = store.add(self.email, graph) if graph is not None else None
+
+    def request_graph(self, data: dict) -> Tuple[Optional[GamebookGraph], Optional[int]]:
+        """The graph a request applies to, with the version of it the client
+        has. Requests upload the whole graph, or refer to a stored one by
+        graphRef, which is None when it is no longer stored or the client
+        version is not one the stored graph had."""
+        if "graph" in data:
+            graph = GamebookGraph.from_graph_dict(data["graph"])
+            self.store_graph(graph)
+            return graph, graph.version
+
+        graph_ref = data["graphRef"]
+        store = self.settings.get("graph_store")
+        graph = store.get(self.email, graph_ref["graphId"]) if store is not None else None
+        if graph is None or graph.delta_since(graph_ref["version"]) is None:
+            return None, None
+
+        if self.graph_id is not None and self.graph_id != graph_ref["graphId"]:
+            # the connection switched stories, the previous graph is released
+            store.remove(self.email, self.graph_id)
+        self.graph_id = graph_ref["graphId"]
+        return graph, graph_ref["version"]
+
+    def graph_payload(self, graph: GamebookGraph, acked_version: Optional[int]) -> dict:
+        """The whole graph, or for delta sync clients only the nodes changed
+        since the version they have, when few enough changed"""
+        if self.delta_sync and acked_version is not None:
+            delta = graph.delta_since(acked_version)
+            if delta is not None and len(delta["nodes"]) <= GRAPH_DELTA_MAX_FRACTION * len(graph.node_lookup):
+                return {"graphDelta": delta}
+        return {"graph": graph.to_graph_dict(), "graphVersion": graph.version}
+
+    def start_job(self, job: GenerationJob, generator: GamebookGenerator, acked_version: Optional[int]=None):
+        job.attach(self, acked_version)
+        self.settings["generation_jobs"].start(job, generator)
+        self.write_message(json.dumps({
+            "resType": "jobStarted",
+            "jobId": job.job_id,
+            "graphId": self.graph_id,
+        }))
+
+    async def resume_job(self, job_id: str, generator: GamebookGenerator):
+        """Reattaches to a job still known to this process, or restarts it
+        from the checkpoint saved in its story"""
+        jobs = self.settings["generation_jobs"]
+
+        job = jobs.get(job_id, self.email)
+        if job is not None:
+            job.attach(self)
+            if job.status == GenerationJob.RUNNING:
+                self.send_job_update(job, job.num_nodes_generated, job.percentage)
+            else:
+                self.send_job_finished(job)
+            return
+
+        story = await jobs.load_checkpoint(job_id, self.email)
+        if story is None:
+            self.send_job_not_found(job_id)
+            return
+
+        checkpoint = story["generationJob"]
+        job = GenerationJob(
+            self.email,
+            GamebookGraph.from_graph_dict(load_graph(story)),
+            checkpoint["fromNode"],
+            checkpoint["maxDepth"],
+            checkpoint["options"],
+            story_id=story["_id"],
+            job_id=job_id,
+            resume=True,
+        )
+        if checkpoint["status"] == GenerationJob.COMPLETED:
+            job.status = GenerationJob.COMPLETED
+            self.send_job_finished(job)
+            return
+
+        self.store_graph(job.graph)
+        self.start_job(job, generator)
+
+    def send_job_update(self, job: GenerationJob, num_nodes_generated: int, percentage: float):
         self.write_message(json.dumps({
             "resType": "progressUpdate",
-            "graph": graph.to_graph_dict(),
+            "jobId": job.job_id,
+            **self.graph_payload(job.graph, job.acked_version),
             "numNodesGenerated": num_nodes_generated,
             "percentage": percentage,
         }))
+
+    def send_job_finished(self, job: GenerationJob):
+        if job.status == GenerationJob.COMPLETED:
+            self.write_message(json.dumps({
+                "resType": "requestComplete",
+                "jobId": job.job_id,
+                **self.graph_payload(job.graph, job.acked_version),
+                "promptTokens": job.prompt_tokens,
+            }))
+        elif job.status == GenerationJob.CANCELLED:
+            self.write_message(json.dumps({
+                "resType": "jobCancelled",
+                "jobId": job.job_id,
+                **self.graph_payload(job.graph, job.acked_version),
+            }))
+        elif job.error is not None:
+            self.write_message(json.dumps({
+                "resType": job.error,
+                "jobId": job.job_id,
+            }))
+
+    def send_job_not_found(self, job_id: str):
+        self.write_message(json.dumps({
+            "resType": "jobNotFound",
+            "jobId": job_id,
+        }))
+
+    def send_narrative_chunk(self, action_node_id: int, chunk: str):
+        self.write_message(json.dumps({
+            "resType": "narrativeChunk",
+            "actionNodeId": action_node_id,
+            "chunk": chunk,
+        }))
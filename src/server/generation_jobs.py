@@ -0,0 +1,207 @@
+""" Module for generateMany jobs, which keep running when the connection that
+started them drops and can be cancelled, or resumed from their last
+checkpoint in the stories collection.
+"""
+import asyncio
+import logging
+import time
+import uuid
+from typing import Callable, Dict, Optional
+
+from src.constants import JOB_CHECKPOINT_INTERVAL_SECS, JOB_RETENTION_SECS
+from src.gamebook_generator import GamebookGenerator, GenerationProgressFeedback
+from src.graph import GamebookGraph
+from src.models.gpt3 import OpenAIRateLimitError, OpenAIUnavailableError
+from src.server.story_codec import story_update
+from src.text_generator import GenerationError
+
+
+class GenerationJobFeedback:
+    """Receives the updates of the jobs it is attached to"""
+
+    def send_job_update(self, job: "GenerationJob", num_nodes_generated: int, percentage: float):
+        pass
+
+    def send_job_finished(self, job: "GenerationJob"):
+        pass
+
+
+class GenerationJob(GenerationProgressFeedback):
+    """One generateMany run. It is the progress feedback of the generator and
+    forwards updates to whichever connection is attached at the time."""
+
+    RUNNING = "running"
+    COMPLETED = "completed"
+    CANCELLED = "cancelled"
+    FAILED = "failed"
+
+    def __init__(
+        self,
+        user_email: str,
+        graph: GamebookGraph,
+        from_node_id: int,
+        max_depth: int,
+        options: dict,
+        story_id: Optional[str]=None,
+        job_id: Optional[str]=None,
+        resume: bool=False,
+    ) -> None:
+        self.job_id = job_id or str(uuid.uuid4())
+        self.user_email = user_email
+        self.story_id = story_id
+        self.graph = graph
+        self.from_node_id = from_node_id
+        self.max_depth = max_depth
+        self.options = options
+        self.resume = resume
+
+        self.status = self.RUNNING
+        # resType sent to the client when the job failed
+        self.error: Optional[str] = None
+        self.num_nodes_generated = 0
+        self.percentage = 0.0
+        self.prompt_tokens = 0
+
+        self.feedback: Optional[GenerationJobFeedback] = None
+        # latest graph version the attached feedback has, None for none
+        self.acked_version: Optional[int] = None
+        self.task: Optional[asyncio.Task] = None
+        self.finished_at: Optional[float] = None
+        self.on_update: Optional[Callable[["GenerationJob"], None]] = None
+
+    def attach(self, feedback: GenerationJobFeedback, acked_version: Optional[int]=None) -> None:
+        self.feedback = feedback
+        self.acked_version = acked_version
+
+    def detach(self, feedback: GenerationJobFeedback) -> None:
+        if self.feedback is feedback:
+            self.feedback = None
+            self.acked_version = None
+
+    def ack(self, feedback: GenerationJobFeedback, version: int) -> None:
+        """Records that the attached feedback has applied the graph up to the
+        version, later updates to it only need what changed since"""
+        if self.feedback is feedback and 0 <= version <= self.graph.version \
+                and (self.acked_version is None or version > self.acked_version):
+            self.acked_version = version
+
+    def send_generation_update(self, graph: GamebookGraph, num_nodes_generated: int, percentage: float):
+        self.num_nodes_generated = num_nodes_generated
+        self.percentage = percentage
+        if self.feedback is not None:
+            self.feedback.send_job_update(self, num_nodes_generated, percentage)
+        if self.on_update is not None:
+            self.on_update(self)
+
+    def checkpoint(self) -> dict:
+        return {
+            "jobId": self.job_id,
+            "status": self.status,
+            "fromNode": self.from_node_id,
+            "maxDepth": self.max_depth,
+            "options": self.options,
+            "numNodesGenerated": self.num_nodes_generated,
+            "updatedAt": time.time(),
+        }
+
+
+class GenerationJobs:
+    """Jobs of this process by id. Jobs with a story id are checkpointed to
+    that story at most every checkpoint_interval_secs while running, and once
+    more when they finish."""
+
+    def __init__(
+        self,
+        db=None,
+        checkpoint_interval_secs: float=JOB_CHECKPOINT_INTERVAL_SECS,
+        retention_secs: float=JOB_RETENTION_SECS,
+        clock: Callable[[], float]=time.monotonic,
+    ) -> None:
+        self.db = db
+        self.checkpoint_interval_secs = checkpoint_interval_secs
+        self.retention_secs = retention_secs
+        self.clock = clock
+
+        self._jobs: Dict[str, GenerationJob] = {}
+        self._last_checkpoint: Dict[str, float] = {}
+        self._saving: Dict[str, asyncio.Task] = {}
+
+    def start(self, job: GenerationJob, generator: GamebookGenerator) -> GenerationJob:
+        job.on_update = self._maybe_checkpoint
+        job.task = asyncio.ensure_future(self._run(job, generator))
+        self._jobs[job.job_id] = job
+        self._last_checkpoint[job.job_id] = self.clock()
+        return job
+
+    def get(self, job_id: str, user_email: str) -> Optional[GenerationJob]:
+        job = self._jobs.get(job_id)
+        return job if job is not None and job.user_email == user_email else None
+
+    def cancel(self, job_id: str, user_email: str) -> bool:
+        job = self.get(job_id, user_email)
+        if job is None or job.status != GenerationJob.RUNNING:
+            return False
+        job.task.cancel()
+        return True
+
+    def detach_all(self, feedback: GenerationJobFeedback) -> None:
+        for job in self._jobs.values():
+            job.detach(feedback)
+
+    async def load_checkpoint(self, job_id: str, user_email: str) -> Optional[dict]:
+        """The story document holding the latest checkpoint of the job"""
+        if self.db is None:
+            return None
+        return await self.db["stories"].find_one({"user_email": user_email, "generationJob.jobId": job_id})
+
+    async def _run(self, job: GenerationJob, generator: GamebookGenerator) -> None:
+        try:
+            await generator.agenerate_many(job.graph, job.from_node_id, job.max_depth, job,
+                resume=job.resume, **job.options)
+            job.status = GenerationJob.COMPLETED
+        except asyncio.CancelledError:
+            job.status = GenerationJob.CANCELLED
+        except OpenAIRateLimitError:
+            job.status, job.error = GenerationJob.FAILED, "rateLimitError"
+        except OpenAIUnavailableError:
+            job.status, job.error = GenerationJob.FAILED, "openaiError"
+        except GenerationError:
+            job.status, job.error = GenerationJob.FAILED, "nlpParseError"
+        except Exception:
+            logging.exception("Generation job %s failed", job.job_id)
+            job.status, job.error = GenerationJob.FAILED, "generationError"
+        finally:
+            job.prompt_tokens = generator.prompt_tokens
+            job.finished_at = self.clock()
+            saving = self._saving.get(job.job_id)
+            if saving is not None:
+                await saving
+            await self.save_checkpoint(job)
+            if job.feedback is not None:
+                job.feedback.send_job_finished(job)
+            # the job and its graph are dropped once nobody can resume it
+            # from memory any more, whether or not another job starts
+            asyncio.get_running_loop().call_later(self.retention_secs, self._forget, job)
+
+    def _maybe_checkpoint(self, job: GenerationJob) -> None:
+        now = self.clock()
+        if job.job_id in self._saving or now - self._last_checkpoint[job.job_id] < self.checkpoint_interval_secs:
+            return
+        self._last_checkpoint[job.job_id] = now
+
+        task = asyncio.ensure_future(self.save_checkpoint(job))
+        self._saving[job.job_id] = task
+        task.add_done_callback(lambda _: self._saving.pop(job.job_id, None))
+
+    async def save_checkpoint(self, job: GenerationJob) -> None:
+        if self.db is None or job.story_id is None:
+            return
+        await self.db["stories"].update_one(
+            {"_id": job.story_id, "user_email": job.user_email},
+            story_update(job.graph.to_graph_dict(), set_fields={"generationJob": job.checkpoint()}),
+        )
+
+    def _forget(self, job: GenerationJob) -> None:
+        if self._jobs.get(job.job_id) is job:
+            del self._jobs[job.job_id]
+            del self._last_checkpoint[job.job_id]
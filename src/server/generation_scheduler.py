@@ -0,0 +1,185 @@
+""" Module for sharing model calls fairly between the users of the server.
+"""
+import asyncio
+import contextlib
+import functools
+import itertools
+import time
+from collections import Counter, deque
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from src.constants import (GENERATION_MAX_CONCURRENCY, GENERATION_PER_KEY_CONCURRENCY,
+    GENERATION_PER_USER_CONCURRENCY, GENERATION_PRIORITY_AGING_SECS)
+
+
+class Promotion:
+    """Raises the priority of the model calls awaited within promoted(),
+    those already queued as well as later ones"""
+
+    def __init__(self) -> None:
+        self.priority: Optional[int] = None
+
+    def promote(self, priority: int) -> None:
+        if self.priority is None or priority < self.priority:
+            self.priority = priority
+
+
+_promotion: ContextVar[Optional[Promotion]] = ContextVar("promotion", default=None)
+
+
+async def promoted(promotion: Promotion, function: Callable[..., Awaitable], *args):
+    """Awaits function(*args) with promotion applying to its model calls,
+    including those of tasks it starts. Run it as a task of its own so the
+    caller is not affected."""
+    _promotion.set(promotion)
+    return await function(*args)
+
+
+class _Waiter:
+
+    def __init__(self, user: str, api_key: Optional[str], priority: int, seq: int,
+            enqueued_at: float, future: asyncio.Future) -> None:
+        self.user = user
+        self.api_key = api_key
+        self.base_priority = priority
+        self.promotion = _promotion.get()
+        self.seq = seq
+        self.enqueued_at = enqueued_at
+        self.future = future
+
+    @property
+    def priority(self) -> int:
+        if self.promotion is None or self.promotion.priority is None:
+            return self.base_priority
+        return min(self.base_priority, self.promotion.priority)
+
+
+class GenerationScheduler:
+    """Queues model calls from every connection and lets at most
+    max_concurrency of them run at once, at most per_user for one user and
+    at most per_key on one user supplied API key.
+
+    Interactive calls go before bulk ones, and bulk ones before speculative
+    ones. A call gains a priority level for
+    every aging_secs it waits, so bulk work is delayed but never starved,
+    and between calls of the same priority the user with the fewest running
+    goes first. Calls made within promoted() go at the priority of their
+    Promotion once it is higher."""
+
+    INTERACTIVE = 0
+    BULK = 1
+    SPECULATIVE = 2
+
+    PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk", SPECULATIVE: "speculative"}
+
+    def __init__(
+        self,
+        max_concurrency: int=GENERATION_MAX_CONCURRENCY,
+        per_user: int=GENERATION_PER_USER_CONCURRENCY,
+        per_key: int=GENERATION_PER_KEY_CONCURRENCY,
+        aging_secs: float=GENERATION_PRIORITY_AGING_SECS,
+        clock: Callable[[], float]=time.monotonic,
+    ) -> None:
+        self.max_concurrency = max_concurrency
+        self.per_user = per_user
+        self.per_key = per_key
+        self.aging_secs = aging_secs
+        self.clock = clock
+
+        self._waiters: List[_Waiter] = []
+        self._seq = itertools.count()
+        self.running = 0
+        self._running_users = Counter()
+        self._running_keys = Counter()
+
+        self._granted = Counter()
+        self._wait_secs: Dict[int, deque] = {
+            priority: deque(maxlen=1000) for priority in self.PRIORITY_NAMES
+        }
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user: str, api_key: Optional[str]=None, priority: int=BULK):
+        await self._acquire(user, api_key, priority)
+        try:
+            yield
+        finally:
+            self._release(user, api_key)
+
+    def gate(self, user: str, api_key: Optional[str], priority: int) -> Callable:
+        """Slot factory for GPT3Model, every model call takes one slot"""
+        return functools.partial(self.slot, user, api_key, priority)
+
+    async def _acquire(self, user: str, api_key: Optional[str], priority: int) -> None:
+        waiter = _Waiter(user, api_key, priority, next(self._seq), self.clock(),
+            asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        self._dispatch()
+
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            elif waiter.future.done() and not waiter.future.cancelled():
+                # granted just before being cancelled, hand the slot back
+                self._release(user, api_key)
+            raise
+
+    def _release(self, user: str, api_key: Optional[str]) -> None:
+        self.running -= 1
+        self._running_users[user] -= 1
+        if api_key is not None:
+            self._running_keys[api_key] -= 1
+        self._dispatch()
+
+    def _can_run(self, waiter: _Waiter) -> bool:
+        return self._running_users[waiter.user] < self.per_user and \
+            (waiter.api_key is None or self._running_keys[waiter.api_key] < self.per_key)
+
+    def _rank(self, waiter: _Waiter, now: float):
+        aged_priority = waiter.priority - int((now - waiter.enqueued_at) // self.aging_secs)
+        return aged_priority, self._running_users[waiter.user], waiter.seq
+
+    def _dispatch(self) -> None:
+        now = self.clock()
+        while self.running < self.max_concurrency:
+            self._waiters = [waiter for waiter in self._waiters if not waiter.future.cancelled()]
+            eligible = [waiter for waiter in self._waiters if self._can_run(waiter)]
+            if not eligible:
+                return
+
+            waiter = min(eligible, key=lambda waiter: self._rank(waiter, now))
+            self._waiters.remove(waiter)
+
+            self.running += 1
+            self._running_users[waiter.user] += 1
+            if waiter.api_key is not None:
+                self._running_keys[waiter.api_key] += 1
+
+            self._granted[waiter.priority] += 1
+            self._wait_secs[waiter.priority].append(now - waiter.enqueued_at)
+            waiter.future.set_result(None)
+
+    def stats(self) -> dict:
+        def wait_stats(wait_secs: deque) -> dict:
+            ordered = sorted(wait_secs)
+            if not ordered:
+                return {"mean": 0.0, "p95": 0.0, "max": 0.0}
+            return {
+                "mean": sum(ordered) / len(ordered),
+                "p95": ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))],
+                "max": ordered[-1],
+            }
+
+        return {
+            "running": self.running,
+            "queued": {
+                name: len([waiter for waiter in self._waiters if waiter.priority == priority])
+                for priority, name in self.PRIORITY_NAMES.items()
+            },
+            "granted": {name: self._granted[priority] for priority, name in self.PRIORITY_NAMES.items()},
+            "waitSecs": {
+                name: wait_stats(self._wait_secs[priority]) for priority, name in self.PRIORITY_NAMES.items()
+            },
+        }
@@ -0,0 +1,52 @@
+""" Module for keeping the graphs of open stories in memory between requests.
+"""
+import uuid
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from src.constants import GRAPH_STORE_MAX_GRAPHS
+from src.graph import GamebookGraph
+
+
+class GraphStore:
+    """Live graphs by user and graph id, shared by all connections. Once
+    max_graphs are stored the least recently used one is dropped, and the
+    client holding it uploads the whole graph again."""
+
+    def __init__(self, max_graphs: int=GRAPH_STORE_MAX_GRAPHS) -> None:
+        self.max_graphs = max_graphs
+        self._graphs: "OrderedDict[Tuple[str, str], GamebookGraph]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def add(self, user_email: str, graph: GamebookGraph) -> str:
+        graph_id = str(uuid.uuid4())
+        self._graphs[(user_email, graph_id)] = graph
+        while len(self._graphs) > self.max_graphs:
+            self._graphs.popitem(last=False)
+            self.evictions += 1
+        return graph_id
+
+    def get(self, user_email: str, graph_id: str) -> Optional[GamebookGraph]:
+        graph = self._graphs.get((user_email, graph_id))
+        if graph is None:
+            self.misses += 1
+            return None
+
+        self._graphs.move_to_end((user_email, graph_id))
+        self.hits += 1
+        return graph
+
+    def remove(self, user_email: str, graph_id: str) -> None:
+        self._graphs.pop((user_email, graph_id), None)
+
+    def stats(self) -> dict:
+        return {
+            "graphs": len(self._graphs),
+            "nodes": sum(len(graph.node_lookup) for graph in self._graphs.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,253 @@
+""" Local stand-in for the OpenAI completion and edit endpoints used by
+GPT3Model, for benchmarking generation without network access or API quota.
+
+Point the openai client at it with
+    OPENAI_API_BASE=http://localhost:8100/v1 OPENAI_API_KEY=stand-in
+and start it with
+    python -m src.server.openai_stand_in --latency typical --rate-limit-rate 0.05
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+from typing import List
+
+import tornado
+import tornado.web
+
+WORDS = [
+    "you", "the", "door", "forest", "light", "shadow", "river", "stranger", "sword", "map",
+    "quietly", "suddenly", "ancient", "cold", "bright", "whisper", "path", "tower", "storm", "key",
+    "walk", "run", "hide", "search", "open", "follow", "climb", "listen", "wait", "call",
+]
+
+LATENCY_PRESETS = {
+    "none": "constant:0",
+    "fast": "lognormal:-1.6,0.3",
+    "typical": "lognormal:1.0,0.4",
+    "slow": "lognormal:2.0,0.5",
+}
+
+
+class LatencyProfile:
+    """Samples a request latency in seconds. Specs are a preset name or one of
+    constant:<secs>, uniform:<low>,<high> and lognormal:<mu>,<sigma>."""
+
+    def __init__(self, spec: str, rng: random.Random) -> None:
+        spec = LATENCY_PRESETS.get(spec, spec)
+        self.kind, _, args = spec.partition(":")
+        self.args = [float(arg) for arg in args.split(",") if arg]
+        self.rng = rng
+
+        if self.kind not in ("constant", "uniform", "lognormal"):
+            raise ValueError(f"Unknown latency profile {spec}")
+
+    def sample(self) -> float:
+        if self.kind == "constant":
+            return self.args[0]
+        if self.kind == "uniform":
+            return self.rng.uniform(*self.args)
+        return self.rng.lognormvariate(*self.args)
+
+
+def seeded_rng(*parts) -> random.Random:
+    digest = hashlib.sha256(json.dumps(parts).encode("utf-8")).digest()
+    return random.Random(int.from_bytes(digest[:8], "big"))
+
+
+def make_sentence(rng: random.Random, num_words: int) -> str:
+    words = [rng.choice(WORDS) for _ in range(num_words)]
+    return " ".join(words).capitalize() + "."
+
+
+def fake_completion(prompt: str, max_tokens: int) -> str:
+    """Deterministic text shaped like what TextGenerator expects for the
+    prompt, so responses parse the same way real ones do"""
+    rng = seeded_rng("completion", prompt)
+    stripped = prompt.rstrip()
+
+    num_options = re.search(r"(?:Generate|Add) (\d+) (?:different|more) choices? for action", prompt)
+    if num_options and "json list" in stripped[-40:]:
+        return json.dumps([make_sentence(rng, 6) for _ in range(int(num_options.group(1)))])
+
+    chosen = re.search(r"The reader picks the choice: (.*)", prompt)
+    if chosen and stripped.endswith("Action:"):
+        return " " + fake_edit(chosen.group(1)) + "\nContinuation:" + \
+            fake_completion(prompt[:chosen.start()], max_tokens)
+
+    if stripped.endswith("(Yes | No)?"):
+        return "Yes" if "The end." in prompt else "No"
+
+    # roughly one word per token, in sentences of 8 to 15 words
+    sentences = []
+    num_words = 0
+    while num_words < min(max_tokens, 120):
+        length = rng.randint(8, 15)
+        sentences.append(make_sentence(rng, length))
+        num_words += length
+    return " " + " ".join(sentences)
+
+
+def fake_edit(text: str) -> str:
+    return "You choose to " + text.strip().rstrip(".").lower() + "."
+
+
+class StandInStats:
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.rate_limited = 0
+        self.unavailable = 0
+        self.prompts = 0
+
+
+class StandInHandler(tornado.web.RequestHandler):  # noqa
+    """Shared fault injection and latency for the stand-in endpoints"""
+
+    def initialize(self, latency: LatencyProfile, rate_limit_rate: float,
+            unavailable_rate: float, rng: random.Random, stats: StandInStats):
+        self.latency = latency
+        self.rate_limit_rate = rate_limit_rate
+        self.unavailable_rate = unavailable_rate
+        self.rng = rng
+        self.stats = stats
+
+    def write_error_body(self, status: int, message: str) -> None:
+        self.set_status(status)
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps({
+            "error": {"message": message, "type": "stand_in", "param": None, "code": None}
+        }))
+
+    async def admit(self) -> bool:
+        """Applies latency and injected failures, False if the request failed"""
+        self.stats.requests += 1
+        await asyncio.sleep(self.latency.sample())
+
+        roll = self.rng.random()
+        if roll < self.rate_limit_rate:
+            self.stats.rate_limited += 1
+            self.write_error_body(429, "Rate limit reached (stand-in)")
+            return False
+        if roll < self.rate_limit_rate + self.unavailable_rate:
+            self.stats.unavailable += 1
+            self.write_error_body(503, "The server is overloaded (stand-in)")
+            return False
+        return True
+
+    def write_json(self, body: dict) -> None:
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps(body))
+
+
+class CompletionsHandler(StandInHandler):  # noqa
+
+    async def post(self):
+        body = json.loads(self.request.body)
+        if not await self.admit():
+            return
+
+        prompts: List[str] = body["prompt"] if isinstance(body["prompt"], list) else [body["prompt"]]
+        self.stats.prompts += len(prompts)
+        max_tokens = body.get("max_tokens", 16)
+        texts = [fake_completion(prompt, max_tokens) for prompt in prompts]
+
+        if body.get("stream"):
+            await self.stream(body["model"], texts)
+            return
+
+        self.write_json({
+            "id": "cmpl-stand-in",
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [
+                {"text": text, "index": i, "logprobs": None, "finish_reason": "stop"}
+                for i, text in enumerate(texts)
+            ],
+            "usage": {
+                "prompt_tokens": sum(len(prompt.split()) for prompt in prompts),
+                "completion_tokens": sum(len(text.split()) for text in texts),
+            },
+        })
+
+    async def stream(self, model: str, texts: List[str]):
+        self.set_header("Content-Type", "text/event-stream")
+        for i, text in enumerate(texts):
+            for word in re.findall(r"\s*\S+", text):
+                self.write("data: " + json.dumps({
+                    "id": "cmpl-stand-in",
+                    "object": "text_completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{"text": word, "index": i, "logprobs": None, "finish_reason": None}],
+                }) + "\n\n")
+                await self.flush()
+                await asyncio.sleep(0.01)
+        self.finish("data: [DONE]\n\n")
+
+
+class EditsHandler(StandInHandler):  # noqa
+
+    async def post(self):
+        body = json.loads(self.request.body)
+        if not await self.admit():
+            return
+
+        self.stats.prompts += 1
+        self.write_json({
+            "object": "edit",
+            "created": int(time.time()),
+            "choices": [{"text": fake_edit(body["input"]), "index": 0}],
+            "usage": {"prompt_tokens": len(body["input"].split())},
+        })
+
+
+class StatsHandler(tornado.web.RequestHandler):  # noqa
+
+    def initialize(self, stats: StandInStats):
+        self.stats = stats
+
+    def get(self):
+        self.write(json.dumps(vars(self.stats)))
+
+
+def make_app(latency: str="none", rate_limit_rate: float=0, unavailable_rate: float=0,
+        seed: int=0) -> tornado.web.Application:
+    rng = random.Random(seed)
+    stats = StandInStats()
+    options = {
+        "latency": LatencyProfile(latency, rng),
+        "rate_limit_rate": rate_limit_rate,
+        "unavailable_rate": unavailable_rate,
+        "rng": rng,
+        "stats": stats,
+    }
+    return tornado.web.Application([
+        (r"/v1/completions", CompletionsHandler, options),
+        (r"/v1/edits", EditsHandler, options),
+        (r"/stats", StatsHandler, {"stats": stats}),
+    ], stand_in_stats=stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", default="typical",
+        help="preset (" + ", ".join(LATENCY_PRESETS) + ") or a distribution spec")
+    parser.add_argument("--rate-limit-rate", type=float, default=0)
+    parser.add_argument("--unavailable-rate", type=float, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    app = make_app(args.latency, args.rate_limit_rate, args.unavailable_rate, args.seed)
+    app.listen(args.port)
+    print(f"OpenAI stand-in listening on http://localhost:{args.port}/v1")
+    tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == "__main__":
+    main()
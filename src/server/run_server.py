@@ -2,9 +2,18 @@ import os
 import motor
 import tornado
 
-from src.config import get_db_url
+from src import analyser
+from src.config import get_completion_cache_path, get_db_url
+from src.constants import COMPLETION_CACHE_SIZE, COMPLETION_CACHE_TTL_SECS
+from src.models.cache import CompletionCache, LRUCache, SQLiteCache
+from src.models.key_scheduler import default_key_scheduler
+from src.models.single_flight import SingleFlight
 from src.server.account_handler import APIKeyHandler, LoginHandler, LogoutHandler, SignupHandler, UserStoriesHandler
 from src.server.generate_handler import GenerateHandler
+from src.server.generation_jobs import GenerationJobs
+from src.server.generation_scheduler import GenerationScheduler
+from src.server.graph_store import GraphStore
+from src.server.status_handler import StatusHandler
 
 LISTEN_PORT = os.getenv("PORT", 8000)
 LISTEN_ADDRESS = "127.0.0.1"
@@ -12,7 +21,19 @@ LISTEN_ADDRESS = "127.0.0.1"
 client = motor.motor_tornado.MotorClient(get_db_url())
 db = client.users
 
+
+def make_completion_cache() -> CompletionCache:
+    disk_path = get_completion_cache_path()
+    return CompletionCache(
+        memory=LRUCache(COMPLETION_CACHE_SIZE, COMPLETION_CACHE_TTL_SECS),
+        disk=SQLiteCache(disk_path, COMPLETION_CACHE_TTL_SECS) if disk_path else None,
+    )
+
+
 def main():
+    # load the embedding model while the server starts accepting connections
+    analyser.warm_up()
+
     app = tornado.web.Application(
         [
             (r"/ws", GenerateHandler),
@@ -21,8 +42,15 @@ def main():
             (r"/signup", SignupHandler),
             (r"/stories", UserStoriesHandler),
             (r"/key", APIKeyHandler),
+            (r"/status", StatusHandler),
         ],
         db=db,
+        completion_cache=make_completion_cache(),
+        single_flight=SingleFlight(),
+        key_scheduler=default_key_scheduler(),
+        generation_jobs=GenerationJobs(db),
+        generation_scheduler=GenerationScheduler(),
+        graph_store=GraphStore(),
         debug=bool(os.getenv("DEV", False)),
         cookie_secret=os.getenv(
             "COOKIE_SECRET", "__TODO:_GENERATE_YOUR_OWN_RANDOM_VALUE_HERE__"
@@ -0,0 +1,151 @@
+""" Module for generating narratives ahead of time, for the action nodes a
+user is likely to expand next.
+"""
+import asyncio
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Iterable, Optional, Tuple
+
+from src.constants import SPECULATIVE_MAX_PENDING, SPECULATIVE_TOKEN_BUDGET
+from src.gamebook_generator import GamebookGenerator
+from src.graph import GamebookGraph
+from src.server.generation_scheduler import GenerationScheduler, Promotion, promoted
+
+
+def candidate_key(graph: GamebookGraph, action_id: int, temperature: float, is_ending: bool=False,
+        descriptor: str=None, details: str=None, style: str=None) -> str:
+    """Same for every request that would produce the same narrative, whatever
+    the node ids of the graph it comes with"""
+    return hashlib.sha256(json.dumps([
+        graph.get_paragraph_list(action_id),
+        graph.get_data(action_id),
+        temperature,
+        is_ending,
+        descriptor,
+        details,
+        style,
+    ]).encode()).hexdigest()
+
+
+class SpeculativeNarratives:
+    """Pending narratives of one connection. At most max_pending are kept,
+    the oldest is dropped, and cancelled if still generating, to make room
+    for a new one. Nothing more is started once token_budget prompt tokens
+    have been spent on speculation.
+
+    A pending narrative that a request waits for has its model calls promoted
+    to interactive priority, so it does not queue behind bulk work."""
+
+    def __init__(self, token_budget: int=SPECULATIVE_TOKEN_BUDGET, max_pending: int=SPECULATIVE_MAX_PENDING) -> None:
+        self.token_budget = token_budget
+        self.max_pending = max_pending
+
+        self._pending: "OrderedDict[str, Tuple[asyncio.Task, Promotion]]" = OrderedDict()
+        self.spent_tokens = 0
+
+        self.num_started = 0
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_dropped = 0
+
+    def speculate(
+        self,
+        generator: GamebookGenerator,
+        graph: GamebookGraph,
+        action_ids: Iterable[int],
+        temperature: float,
+        is_ending: bool=False,
+        descriptor: str=None,
+        details: str=None,
+        style: str=None,
+    ) -> int:
+        """Starts generating a narrative for each action in the background,
+        returns how many were started"""
+        num_started = 0
+        for action_id in action_ids:
+            if self.spent_tokens >= self.token_budget:
+                break
+
+            key = candidate_key(graph, action_id, temperature, is_ending, descriptor, details, style)
+            if key in self._pending:
+                continue
+
+            while len(self._pending) >= self.max_pending:
+                _, (dropped, _) = self._pending.popitem(last=False)
+                if not dropped.done():
+                    dropped.cancel()
+                self.num_dropped += 1
+
+            # the task reads the graph when it first runs, the handler does
+            # not change the graph after speculating
+            promotion = Promotion()
+            task = asyncio.ensure_future(promoted(promotion, generator.aspeculate_narrative,
+                graph, action_id, is_ending, descriptor, details, style))
+            task.add_done_callback(lambda task: self._spend(generator, task))
+            self._pending[key] = (task, promotion)
+            num_started += 1
+
+        self.num_started += num_started
+        return num_started
+
+    def _spend(self, generator: GamebookGenerator, task: asyncio.Task) -> None:
+        # one generator per speculate call, so its prompt tokens are all
+        # speculative, and are counted by whichever of its tasks ends first
+        self.spent_tokens += generator.prompt_tokens
+        generator.prompt_tokens = 0
+        if not task.cancelled():
+            # retrieved here so a failed speculation is never reported as unhandled
+            task.exception()
+
+    async def aexpand(
+        self,
+        graph: GamebookGraph,
+        action_id: int,
+        temperature: float,
+        is_ending: bool=False,
+        descriptor: str=None,
+        details: str=None,
+        style: str=None,
+    ) -> Optional[int]:
+        """Adds the pending narrative of the action to the graph, waiting for
+        it if it is still generating. Returns the id of the new node, or None
+        when there is no usable narrative for exactly this request."""
+        key = candidate_key(graph, action_id, temperature, is_ending, descriptor, details, style)
+        pending = self._pending.pop(key, None)
+        if pending is None:
+            self.num_misses += 1
+            return None
+
+        task, promotion = pending
+        promotion.promote(GenerationScheduler.INTERACTIVE)
+
+        try:
+            narrative = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if task.cancelled():
+                self.num_misses += 1
+                return None
+            raise
+        except Exception:
+            # generated again by the request itself, which reports the error
+            self.num_misses += 1
+            return None
+
+        self.num_hits += 1
+        return graph.make_narrative_node(parent_id=action_id, narrative=narrative, is_ending=is_ending)
+
+    def cancel_all(self) -> None:
+        for task, _ in self._pending.values():
+            task.cancel()
+        self._pending.clear()
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "started": self.num_started,
+            "hits": self.num_hits,
+            "misses": self.num_misses,
+            "dropped": self.num_dropped,
+            "spentTokens": self.spent_tokens,
+        }
@@ -0,0 +1,28 @@
+import json
+
+from src.analyser import is_model_ready
+from src.config import get_status_admins
+from src.server.account_handler import AuthBaseHandler
+
+
+class StatusHandler(AuthBaseHandler):  # noqa
+    """Http handler exposing the state of the shared generation components,
+    to the users listed in STATUS_ADMIN_EMAILS only"""
+
+    async def get(self):
+        email = await self.get_email_from_session()
+        if email is None:
+            self.set_status(401)
+            return
+        if email not in get_status_admins():
+            self.set_status(403)
+            return
+
+        self.write(json.dumps({
+            "apiKeys": self.settings["key_scheduler"].state(),
+            "completionCache": self.settings["completion_cache"].stats(),
+            "singleFlight": self.settings["single_flight"].stats(),
+            "generationScheduler": self.settings["generation_scheduler"].stats(),
+            "graphStore": self.settings["graph_store"].stats(),
+            "analyserReady": is_model_ready(),
+        }))
@@ -0,0 +1,118 @@
+""" Module for storing story graphs in the stories collection.
+
+With the raw codec the graph is stored as a nested document under "story",
+as it always was. The binary codecs store it compressed under "storyData",
+named by "storyCodec", which keeps large stories well below the 16MB
+document limit. Every codec also stores "storyMeta", so stories can be
+listed without reading their graphs. Stories are read back whichever codec
+wrote them.
+"""
+import json
+import zlib
+from typing import Optional
+
+import bson
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from src.config import get_story_codec
+from src.constants import STORY_ZLIB_LEVEL, STORY_ZSTD_LEVEL
+
+RAW = "raw"
+JSON_ZLIB = "json-zlib"
+MSGPACK_ZSTD = "msgpack-zstd"
+
+# fields of a story document holding the graph or describing it
+STORY_FIELDS = ("story", "storyData", "storyCodec", "storyMeta")
+
+
+class StoryCodecError(Exception):
+    pass
+
+
+def available_codec(codec: Optional[str]=None) -> str:
+    """The codec named by STORY_CODEC, raw unless set, or json-zlib in place
+    of msgpack-zstd when msgpack or zstandard are not installed"""
+    codec = codec or get_story_codec()
+    if codec == MSGPACK_ZSTD and (msgpack is None or zstandard is None):
+        return JSON_ZLIB
+    if codec not in (RAW, JSON_ZLIB, MSGPACK_ZSTD):
+        raise StoryCodecError(f"Unknown story codec {codec}")
+    return codec
+
+
+def encode_graph(graph: dict, codec: str) -> bytes:
+    if codec == MSGPACK_ZSTD:
+        return zstandard.ZstdCompressor(level=STORY_ZSTD_LEVEL).compress(msgpack.packb(graph))
+    if codec == JSON_ZLIB:
+        return zlib.compress(json.dumps(graph, separators=(",", ":")).encode("utf-8"), STORY_ZLIB_LEVEL)
+    raise StoryCodecError(f"Story codec {codec} is not binary")
+
+
+def decode_graph(data: bytes, codec: str) -> dict:
+    if codec == MSGPACK_ZSTD:
+        if msgpack is None or zstandard is None:
+            raise StoryCodecError("msgpack and zstandard are needed to read this story")
+        return msgpack.unpackb(zstandard.ZstdDecompressor().decompress(data))
+    if codec == JSON_ZLIB:
+        return json.loads(zlib.decompress(data))
+    raise StoryCodecError(f"Unknown story codec {codec}")
+
+
+def story_meta(graph: dict) -> dict:
+    narrative_nodes = [node for node in graph["nodes"] if node["type"] == "narrative"]
+    return {
+        "totalSections": len(narrative_nodes),
+        "firstParagraph": graph["nodes"][0]["data"] if graph["nodes"] else None,
+        "numNodes": len(graph["nodes"]),
+    }
+
+
+def story_update(graph: dict, codec: Optional[str]=None, set_fields: Optional[dict]=None) -> dict:
+    """Update writing the graph with the codec, and any other set_fields"""
+    codec = available_codec(codec)
+
+    if codec == RAW:
+        fields = {"story": graph}
+    else:
+        fields = {"storyData": bson.Binary(encode_graph(graph, codec)), "storyCodec": codec}
+    fields["storyMeta"] = story_meta(graph)
+
+    return {
+        "$set": {**fields, **(set_fields or {})},
+        "$unset": {field: "" for field in STORY_FIELDS if field not in fields},
+    }
+
+
+def story_document(graph: dict, codec: Optional[str]=None) -> dict:
+    """Fields of a new story document holding the graph"""
+    return story_update(graph, codec)["$set"]
+
+
+def load_graph(story: dict) -> dict:
+    """Graph of a story document, whichever codec wrote it"""
+    if "storyData" in story:
+        return decode_graph(story["storyData"], story["storyCodec"])
+    return story["story"]
+
+
+def load_meta(story: dict) -> dict:
+    if "storyMeta" in story:
+        return story["storyMeta"]
+    return story_meta(load_graph(story))
+
+
+def decoded_story(story: dict) -> dict:
+    """The story document as clients know it, with the graph under "story"
+    and no storage fields"""
+    decoded = {key: value for key, value in story.items() if key not in STORY_FIELDS}
+    decoded["story"] = load_graph(story)
+    return decoded
@@ -2,7 +2,7 @@ import json
 from src.constants import NUM_GENERATION_ATTEMPTS
 
 from src.models.gpt3 import GPT3Model
-from typing import List, Tuple
+from typing import AsyncIterator, Callable, List, Optional, Tuple
 import json
 
 
@@ -13,7 +13,12 @@ class GenerationError(Exception):
     pass
 
 class TextGenerator:
-    """Class for text manipulation and generation using a model"""
+    """Class for text manipulation and generation using a model.
+
+    Every generation method has an async counterpart prefixed with `a` which
+    awaits the model instead of blocking the event loop."""
+
+    SECOND_PERSON_INSTRUCTION = "Rewrite this as 'You choose ...'"
 
     def __init__(self, model: GPT3Model) -> None:
         self.model = model
@@ -23,19 +28,19 @@ class TextGenerator:
         return f'Generate {num_options} different choices for action in ' +\
             'gamebook style as a json list of strings:'
 
-    def action_to_second_person(self, action: str) -> str:
-        instruction = "Rewrite this as 'You choose ...'"
-        return self.model.edit(action, instruction)
-
-    def generate_actions(self, full_text: str, num_actions=2) -> List[str]:
-        if num_actions <= 1:
-            prompt = full_text + \
-                '\n\nGenerate only 1 choice for action in gamebook style:'
-            return [self.model.complete(prompt).strip()]
-
-        prompt = full_text + "\n\n" + self.option_prompt(num_actions)
-        generated = self.model.complete(prompt)
+    @staticmethod
+    def _parseable(parse: Callable, *args) -> Callable[[str], bool]:
+        """Whether a completion parses to something, the model only caches
+        completions that do"""
+        def accept(generated: str) -> bool:
+            try:
+                return bool(parse(generated, *args))
+            except GenerationError:
+                return False
+        return accept
 
+    @staticmethod
+    def _parse_actions(generated: str) -> List[str]:
         # try to parse a limited number of times and then raise an Exception
         for _ in range(NUM_GENERATION_ATTEMPTS):
             try:
@@ -45,27 +50,46 @@ class TextGenerator:
 
         raise GenerationError
 
-    def add_actions(self, full_text: str, existing_actions: List[str], num_new_actions=1) -> List[str]:
+    @classmethod
+    def _actions_prompt(cls, full_text: str, num_actions: int) -> str:
+        if num_actions <= 1:
+            return full_text + \
+                '\n\nGenerate only 1 choice for action in gamebook style:'
+        return full_text + "\n\n" + cls.option_prompt(num_actions)
+
+    @classmethod
+    def _parse_generated_actions(cls, generated: str, num_actions: int) -> List[str]:
+        if num_actions <= 1:
+            return [generated.strip()]
+        return cls._parse_actions(generated)
+
+    @staticmethod
+    def _add_actions_prompt(full_text: str, existing_actions: List[str], num_new_actions: int) -> str:
         connector = "\n"
         text_and_existing_actions = full_text + \
             f'\n\nYou already have the following choices for action: {connector.join(existing_actions)}'
 
         if num_new_actions <= 1:
-            prompt = text_and_existing_actions + \
+            return text_and_existing_actions + \
                 '\n\nAdd another choice for action: '
-            return [self.model.complete(prompt).strip()]
 
-        prompt = text_and_existing_actions + \
+        return text_and_existing_actions + \
             f'\n\nAdd {num_new_actions} more choice for action as a json list of string: '
-        generated = self.model.complete(prompt)
+
+    @staticmethod
+    def _parse_new_actions(generated: str, num_new_actions: int) -> List[str]:
+        if num_new_actions <= 1:
+            return [generated.strip()]
+
         try:
             actions = [item.strip() for item in json.loads(generated)]
         except:
             actions = []
         return actions
 
-    def generate_narrative(self, 
-        full_text: str, 
+    @staticmethod
+    def _narrative_prompt(
+        full_text: str,
         is_ending: bool=False,
         descriptor: str=None,
         details: str=None,
@@ -85,6 +109,98 @@ class TextGenerator:
 
         prompt += "\n\nResult: "
 
+        return prompt
+
+    @staticmethod
+    def _fused_narrative_prompt(
+        full_text: str,
+        action: str,
+        is_ending: bool=False,
+        descriptor: str=None,
+        details: str=None,
+        style: str=None
+    ) -> str:
+        part = "ending" if is_ending else "continuation"
+        if descriptor is not None:
+            part = f"{descriptor} {part}"
+
+        prompt = full_text + f"\n\nThe reader picks the choice: {action}"
+        prompt += "\n\nRewrite the choice as a sentence starting with 'You choose', " + \
+            f"then write a {part} of the story."
+
+        if details is not None:
+            prompt += f"\n\nImportant details: {details}"
+        if style is not None:
+            prompt += f"\n\nWriting style: {style}"
+
+        prompt += "\n\nAnswer in the form:\nAction: You choose ...\nContinuation: ..." + \
+            "\n\nAction:"
+
+        return prompt
+
+    @staticmethod
+    def _parse_fused_narrative(generated: str, is_ending: bool) -> Tuple[str, str]:
+        action, marker, narrative = generated.partition("Continuation:")
+        if not marker or not action.strip():
+            raise GenerationError
+
+        return action.strip(), narrative.strip() + (" The end." if is_ending else "")
+
+    @staticmethod
+    def _new_story_prompt(initial_values: List[Tuple[str, str]]) -> str:
+        description = "; ".join([f"{attribute}: \"{content}\"" for
+                (attribute, content) in initial_values])
+        return f"Write an adventure story with {description} in second person:"
+
+    def action_to_second_person(self, action: str) -> str:
+        return self.model.edit(action, self.SECOND_PERSON_INSTRUCTION)
+
+    async def aaction_to_second_person(self, action: str) -> str:
+        return await self.model.aedit(action, self.SECOND_PERSON_INSTRUCTION)
+
+    def generate_actions(self, full_text: str, num_actions=2) -> List[str]:
+        prompt = self._actions_prompt(full_text, num_actions)
+        accept = self._parseable(self._parse_generated_actions, num_actions)
+        return self._parse_generated_actions(self.model.complete(prompt, accept), num_actions)
+
+    async def agenerate_actions(self, full_text: str, num_actions=2) -> List[str]:
+        prompt = self._actions_prompt(full_text, num_actions)
+        accept = self._parseable(self._parse_generated_actions, num_actions)
+        return self._parse_generated_actions(await self.model.acomplete(prompt, accept), num_actions)
+
+    def generate_actions_batch(self, full_texts: List[str], num_actions=2) -> List[List[str]]:
+        """generate_actions for several stories in as few model requests as
+        possible"""
+        prompts = [self._actions_prompt(full_text, num_actions) for full_text in full_texts]
+        accept = self._parseable(self._parse_generated_actions, num_actions)
+        return [self._parse_generated_actions(generated, num_actions)
+            for generated in self.model.complete_batch(prompts, accept)]
+
+    async def agenerate_actions_batch(self, full_texts: List[str], num_actions=2) -> List[List[str]]:
+        prompts = [self._actions_prompt(full_text, num_actions) for full_text in full_texts]
+        accept = self._parseable(self._parse_generated_actions, num_actions)
+        return [self._parse_generated_actions(generated, num_actions)
+            for generated in await self.model.acomplete_batch(prompts, accept)]
+
+    def add_actions(self, full_text: str, existing_actions: List[str], num_new_actions=1) -> List[str]:
+        prompt = self._add_actions_prompt(full_text, existing_actions, num_new_actions)
+        accept = self._parseable(self._parse_new_actions, num_new_actions)
+        return self._parse_new_actions(self.model.complete(prompt, accept), num_new_actions)
+
+    async def aadd_actions(self, full_text: str, existing_actions: List[str], num_new_actions=1) -> List[str]:
+        prompt = self._add_actions_prompt(full_text, existing_actions, num_new_actions)
+        accept = self._parseable(self._parse_new_actions, num_new_actions)
+        return self._parse_new_actions(await self.model.acomplete(prompt, accept), num_new_actions)
+
+    def generate_narrative(self,
+        full_text: str,
+        is_ending: bool=False,
+        descriptor: str=None,
+        details: str=None,
+        style: str=None
+    ) -> str:
+        prompt = self._narrative_prompt(full_text, is_ending, descriptor, details, style)
+
         response = self.model.complete(prompt)
 
         if is_ending:
@@ -92,6 +208,142 @@ class TextGenerator:
 
         return response
 
+    async def agenerate_narrative(self,
+        full_text: str,
+        is_ending: bool=False,
+        descriptor: str=None,
+        details: str=None,
+        style: str=None
+    ) -> str:
+        prompt = self._narrative_prompt(full_text, is_ending, descriptor, details, style)
+
+        response = await self.model.acomplete(prompt)
+
+        if is_ending:
+            response += " The end."
+
+        return response
+
+    async def agenerate_narrative_stream(self,
+        full_text: str,
+        is_ending: bool=False,
+        descriptor: str=None,
+        details: str=None,
+        style: str=None
+    ) -> AsyncIterator[str]:
+        """Yields the narrative in chunks as the model produces them"""
+        prompt = self._narrative_prompt(full_text, is_ending, descriptor, details, style)
+
+        async for chunk in self.model.acomplete_stream(prompt):
+            yield chunk
+
+        if is_ending:
+            yield " The end."
+
+    def generate_narrative_batch(self, full_texts: List[str], is_endings: List[bool]) -> List[str]:
+        """generate_narrative for several prompts in as few model requests as
+        possible"""
+        prompts = [self._narrative_prompt(full_text, is_ending)
+            for full_text, is_ending in zip(full_texts, is_endings)]
+        responses = self.model.complete_batch(prompts)
+        return [response + (" The end." if is_ending else "")
+            for response, is_ending in zip(responses, is_endings)]
+
+    async def agenerate_narrative_batch(self, full_texts: List[str], is_endings: List[bool]) -> List[str]:
+        prompts = [self._narrative_prompt(full_text, is_ending)
+            for full_text, is_ending in zip(full_texts, is_endings)]
+        responses = await self.model.acomplete_batch(prompts)
+        return [response + (" The end." if is_ending else "")
+            for response, is_ending in zip(responses, is_endings)]
+
+    def generate_narrative_with_action(self,
+        full_text: str,
+        action: str,
+        is_ending: bool=False,
+        descriptor: str=None,
+        details: str=None,
+        style: str=None
+    ) -> Tuple[str, str]:
+        """Rewrites the action in second person and continues the story after
+        it in a single model request. Returns (rewritten action, narrative)
+        and raises GenerationError if the response cannot be split."""
+        prompt = self._fused_narrative_prompt(full_text, action, is_ending, descriptor, details, style)
+        accept = self._parseable(self._parse_fused_narrative, is_ending)
+        return self._parse_fused_narrative(self.model.complete(prompt, accept), is_ending)
+
+    async def agenerate_narrative_with_action(self,
+        full_text: str,
+        action: str,
+        is_ending: bool=False,
+        descriptor: str=None,
+        details: str=None,
+        style: str=None
+    ) -> Tuple[str, str]:
+        prompt = self._fused_narrative_prompt(full_text, action, is_ending, descriptor, details, style)
+        accept = self._parseable(self._parse_fused_narrative, is_ending)
+        return self._parse_fused_narrative(await self.model.acomplete(prompt, accept), is_ending)
+
+    async def agenerate_narrative_with_action_stream(self,
+        full_text: str,
+        action: str,
+        is_ending: bool=False,
+        descriptor: str=None,
+        details: str=None,
+        style: str=None
+    ) -> AsyncIterator[str]:
+        """Streaming generate_narrative_with_action. The rewritten action is
+        yielded first, followed by " " and the narrative chunks. Nothing is
+        yielded before the response is known to be parseable, so callers can
+        still fall back on GenerationError."""
+        prompt = self._fused_narrative_prompt(full_text, action, is_ending, descriptor, details, style)
+
+        buffered = ""
+        found_marker = False
+
+        accept = self._parseable(self._parse_fused_narrative, is_ending)
+        async for chunk in self.model.acomplete_stream(prompt, accept):
+            if found_marker:
+                yield chunk
+                continue
+
+            buffered += chunk
+            if "Continuation:" not in buffered:
+                continue
+
+            edited_action, _, narrative = buffered.partition("Continuation:")
+            if not edited_action.strip():
+                raise GenerationError
+            found_marker = True
+            yield edited_action.strip()
+            yield " "
+            if narrative.lstrip():
+                yield narrative.lstrip()
+
+        if not found_marker:
+            raise GenerationError
+
+        if is_ending:
+            yield " The end."
+
+    async def agenerate_narrative_with_action_batch(self,
+        full_texts: List[str],
+        actions: List[str],
+        is_endings: List[bool]
+    ) -> List[Optional[Tuple[str, str]]]:
+        """Batched generate_narrative_with_action. Responses which cannot be
+        split are returned as None."""
+        prompts = [self._fused_narrative_prompt(full_text, action, is_ending)
+            for full_text, action, is_ending in zip(full_texts, actions, is_endings)]
+
+        accept = self._parseable(self._parse_fused_narrative, False)
+        results = []
+        for generated, is_ending in zip(await self.model.acomplete_batch(prompts, accept), is_endings):
+            try:
+                results.append(self._parse_fused_narrative(generated, is_ending))
+            except GenerationError:
+                results.append(None)
+        return results
+
     def summarise(self, content: str, min_length: int = 600) -> str:
         if len(content) < min_length:
             return content
@@ -111,12 +363,26 @@ class TextGenerator:
 
         raise GenerationError
 
+    async def abridge_content(self, from_: str, to: str) -> str:
+        for _ in range(NUM_GENERATION_ATTEMPTS):
+            middle_content = await self.model.ainsert(f"{from_}\n\n", f"\n\n{to}")
+            if middle_content != "":
+                return middle_content
+
+        raise GenerationError
+
+    @staticmethod
+    def _has_story_ended_prompt(full_text: str) -> str:
+        return f"{full_text}\n\nDid the story end yet (Yes | No)?"
+
     def has_story_ended(self, full_text: str) -> bool:
-        prompt = "Did the story end yet (Yes | No)?"
-        return self.model.complete(prompt).strip() == "Yes"
-        
+        return self.model.complete(self._has_story_ended_prompt(full_text)).strip() == "Yes"
+
+    async def ahas_story_ended(self, full_text: str) -> bool:
+        return (await self.model.acomplete(self._has_story_ended_prompt(full_text))).strip() == "Yes"
+
     def new_story(self, initial_values: List[Tuple[str, str]]) -> str:
-        description = "; ".join([f"{attribute}: \"{content}\"" for
-                (attribute, content) in initial_values])
-        prompt = f"Write an adventure story with {description} in second person:"
-        return self.model.complete(prompt)
+        return self.model.complete(self._new_story_prompt(initial_values))
+
+    async def anew_story(self, initial_values: List[Tuple[str, str]]) -> str:
+        return await self.model.acomplete(self._new_story_prompt(initial_values))
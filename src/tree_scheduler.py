@@ -0,0 +1,69 @@
+""" Module for running generation as a graph of dependent tasks.
+"""
+import asyncio
+from typing import Awaitable, Set
+
+
+class TaskGraphScheduler:
+    """Runs tasks which spawn the tasks depending on them as soon as their
+    own result is ready, so no task waits on unrelated ones as it would with
+    a barrier per level. Work done inside slot() is limited to a fixed number
+    of tasks at once.
+
+    If any task fails the remaining ones are cancelled and join() raises the
+    error, and cancelling join() cancels every task too."""
+
+    def __init__(self, concurrency: int) -> None:
+        self._slots = asyncio.Semaphore(concurrency)
+        self._tasks: Set[asyncio.Task] = set()
+
+        self.num_spawned = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def spawn(self, coro: Awaitable) -> None:
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        self.num_spawned += 1
+
+    def slot(self) -> "_Slot":
+        return _Slot(self)
+
+    async def join(self) -> None:
+        """Waits until every task, including those spawned meanwhile, is done"""
+        try:
+            while self._tasks:
+                done, _ = await asyncio.wait(set(self._tasks), return_when=asyncio.FIRST_EXCEPTION)
+
+                failed = [task for task in done if not task.cancelled() and task.exception() is not None]
+                if failed:
+                    raise failed[0].exception()
+        except BaseException:
+            await self.cancel()
+            raise
+
+    async def cancel(self) -> None:
+        # a task finishing while the others are cancelled may still have
+        # spawned its children, so repeat until none are left
+        while self._tasks:
+            tasks = set(self._tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class _Slot:
+    """One of the scheduler's concurrency slots, held for an async with block"""
+
+    def __init__(self, scheduler: TaskGraphScheduler) -> None:
+        self.scheduler = scheduler
+
+    async def __aenter__(self) -> None:
+        await self.scheduler._slots.acquire()
+        self.scheduler.in_flight += 1
+        self.scheduler.max_in_flight = max(self.scheduler.max_in_flight, self.scheduler.in_flight)
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.scheduler.in_flight -= 1
+        self.scheduler._slots.release()
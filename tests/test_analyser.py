@@ -1,6 +1,12 @@
+from unittest.mock import patch
+
+import numpy as np
 import pytest
 
-from src.analyser import is_duplicate
+import src.analyser
+
+from src.analyser import (classify_ending, duplicate_pairs, encode_sentences, has_duplicate_pair,
+    have_duplicate_pairs, is_duplicate, last_sentences)
 
 
 @pytest.mark.parametrize(
@@ -51,3 +57,80 @@ def test_duplicate_strings_are_being_flagged_correctly(
     first_text: str, second_text: str, expected_result: bool
 ):
     assert is_duplicate(first_text, second_text) == expected_result
+
+
+def test_last_sentences():
+    assert last_sentences("One. Two! Three?") == ["Two!", "Three?"]
+    assert last_sentences("") == []
+
+
+@pytest.mark.parametrize(
+    "text, expected_result",
+    [
+        (
+            "You fall to the ground as the arrow strikes. The light fades from your eyes. The end.",
+            True,
+        ),
+        (
+            "You reach the crossroads. One path leads to the mountains and the other to the sea. "
+            "Which way will you go?",
+            False,
+        ),
+    ],
+)
+def test_endings_are_classified_correctly(text: str, expected_result: bool):
+    assert classify_ending(text) == expected_result
+
+
+def test_encode_sentences_only_encodes_uncached_sentences():
+    with patch("src.analyser.get_model") as mock_get_model:
+        mock_model = mock_get_model.return_value
+        mock_model.encode.side_effect = lambda sentences: np.ones((len(sentences), 4))
+        encode_sentences(["You run north", "You hide in the cellar"])
+        encode_sentences(["You run north", "You wait by the door"])
+
+    assert [["You run north", "You hide in the cellar"], ["You wait by the door"]] == \
+        [call.args[0] for call in mock_model.encode.call_args_list]
+
+
+def test_has_duplicate_pair():
+    assert has_duplicate_pair([
+        "Stay in bed and hope it goes away.",
+        "Try to fight off the attacker.",
+        "Stay in bed and hope it will go away.",
+    ])
+    assert not has_duplicate_pair([
+        "Try to fight off the attacker.",
+        "Give in and let the attacker take you.",
+        "Try to fight off the attacker.",
+    ])
+
+
+def test_duplicate_pairs():
+    assert [(0, 2)] == duplicate_pairs([
+        "You ignore the noise and try to sleep.",
+        "Try to fight off the attacker.",
+        "You can continue to try to ignore the noise and go back to sleep.",
+    ])
+
+
+def test_have_duplicate_pairs_encodes_all_paths_at_once():
+    with patch("src.analyser.get_model") as mock_get_model:
+        mock_model = mock_get_model.return_value
+        mock_model.encode.side_effect = lambda sentences: np.eye(8)[:len(sentences)]
+        result = have_duplicate_pairs([["Climb the tower", "Open the gate"], ["Climb the tower", "Swim"], []])
+
+    assert [False, False, False] == result
+    mock_model.encode.assert_called_once()
+
+
+def test_model_is_loaded_once_on_first_use():
+    with patch.object(src.analyser, "_model", None), \
+            patch.object(src.analyser, "model_ready", src.analyser.threading.Event()), \
+            patch("src.analyser.make_embedding_backend") as mock_make_backend:
+        assert not src.analyser.is_model_ready()
+        src.analyser.warm_up().join()
+
+        assert src.analyser.is_model_ready()
+        assert src.analyser.get_model() is mock_make_backend.return_value
+        mock_make_backend.assert_called_once_with()
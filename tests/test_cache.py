@@ -0,0 +1,79 @@
+import os
+import tempfile
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+from src.models.cache import CompletionCache, LRUCache, SQLiteCache, request_key
+
+
+class RequestKeyTest(TestCase):
+
+    def test_key_ignores_param_order(self):
+        self.assertEqual(
+            request_key("Completion", {"prompt": "P", "temperature": 0.5}),
+            request_key("Completion", {"temperature": 0.5, "prompt": "P"}),
+        )
+
+    def test_key_depends_on_every_param(self):
+        self.assertNotEqual(
+            request_key("Completion", {"prompt": "P", "temperature": 0.5}),
+            request_key("Completion", {"prompt": "P", "temperature": 0.6}),
+        )
+        self.assertNotEqual(
+            request_key("Completion", {"prompt": "P"}),
+            request_key("Edit", {"prompt": "P"}),
+        )
+
+
+class LRUCacheTest(TestCase):
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = LRUCache(max_size=2)
+        cache.set("a", "A")
+        cache.set("b", "B")
+        cache.get("a")
+        cache.set("c", "C")
+
+        self.assertEqual("A", cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual("C", cache.get("c"))
+
+    @patch("src.models.cache.time.monotonic")
+    def test_expired_entry_is_missing(self, mock_monotonic):
+        cache = LRUCache(ttl_secs=10)
+        mock_monotonic.return_value = 100
+        cache.set("a", "A")
+
+        mock_monotonic.return_value = 105
+        self.assertEqual("A", cache.get("a"))
+        mock_monotonic.return_value = 111
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(0, len(cache))
+
+
+class CompletionCacheTest(TestCase):
+
+    def setUp(self) -> None:
+        handle, self.path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(handle)
+
+    def tearDown(self) -> None:
+        os.remove(self.path)
+
+    def test_disk_tier_survives_new_memory_tier(self):
+        CompletionCache(disk=SQLiteCache(self.path)).set("a", "A")
+
+        cache = CompletionCache(disk=SQLiteCache(self.path))
+        self.assertEqual("A", cache.get("a"))
+        self.assertEqual("A", cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+
+        self.assertEqual(
+            {"memoryHits": 1, "diskHits": 1, "misses": 1, "memorySize": 1},
+            cache.stats(),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
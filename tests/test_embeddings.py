@@ -0,0 +1,38 @@
+import subprocess
+import sys
+import unittest
+from unittest import TestCase
+
+import numpy as np
+
+from src.models.embeddings import EmbeddingBackendError, OnnxEmbeddingBackend, make_embedding_backend, mean_pool
+
+
+class EmbeddingsTest(TestCase):
+
+    def test_mean_pool_ignores_padding(self):
+        token_embeddings = np.array([
+            [[1.0, 2.0], [3.0, 4.0], [100.0, 100.0]],
+            [[5.0, 5.0], [100.0, 100.0], [100.0, 100.0]],
+        ])
+        attention_mask = np.array([[1, 1, 0], [1, 0, 0]])
+
+        np.testing.assert_allclose([[2.0, 3.0], [5.0, 5.0]], mean_pool(token_embeddings, attention_mask))
+
+    def test_unknown_backend_is_rejected(self):
+        with self.assertRaises(EmbeddingBackendError):
+            make_embedding_backend("tensorflow")
+
+    def test_onnx_backend_needs_an_exported_model(self):
+        with self.assertRaises(EmbeddingBackendError):
+            OnnxEmbeddingBackend("/nonexistent")
+
+    def test_importing_the_analyser_does_not_load_onnxruntime(self):
+        result = subprocess.run([sys.executable, "-c",
+            "import sys, src.analyser; print('onnxruntime' in sys.modules)"],
+            capture_output=True, text=True, check=True)
+        self.assertEqual("False", result.stdout.strip())
+
+
+if __name__ == "__main__":
+    unittest.main()
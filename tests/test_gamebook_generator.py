@@ -1,11 +1,18 @@
+import asyncio
+import threading
 import unittest
-from unittest import TestCase
-from unittest.mock import Mock
-from unittest.mock import call
+from unittest import IsolatedAsyncioTestCase, TestCase
+from unittest.mock import AsyncMock, Mock
+from unittest.mock import call, patch
+
+from src.gamebook_generator import GamebookGenerator, GenerationProgressFeedback
+from src.text_generator import GenerationError, TextGenerator
+from src.graph import GamebookGraph, GraphCycleError
+
+
+def no_duplicate_paths(paths):
+    return [False] * len(paths)
 
-from src.gamebook_generator import GamebookGenerator
-from src.text_generator import TextGenerator
-from src.graph import GamebookGraph
 
 class GamebookGeneratorTest(TestCase):
 
@@ -78,5 +85,284 @@ class GamebookGeneratorTest(TestCase):
         self.mock_graph.connect_nodes.assert_called_once_with(bridge_id, self.example_id_alt)
 
 
+class AsyncGamebookGeneratorTest(IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        # the embedding model is never needed with the analyser patched
+        await_model = patch("src.gamebook_generator.await_model", new_callable=AsyncMock)
+        self.mock_await_model = await_model.start()
+        self.addCleanup(await_model.stop)
+
+        self.mock_text_generator = Mock(TextGenerator)
+        self.mock_graph = Mock(GamebookGraph)
+        self.generator = GamebookGenerator(self.mock_text_generator)
+
+    async def test_agenerate_narrative_from_action(self):
+        self.mock_text_generator.agenerate_narrative.return_value = "Sample narrative."
+        self.mock_text_generator.aaction_to_second_person.return_value = "Sample action."
+        self.mock_graph.is_narrative.return_value = False
+        self.mock_graph.get_paragraph_list.return_value = ["Paragraph.", "Other."]
+
+        await self.generator.agenerate_narrative_from_action(self.mock_graph, 3)
+
+        self.mock_text_generator.agenerate_narrative.assert_awaited_once()
+        self.mock_graph.make_narrative_node.assert_called_once_with(
+            parent_id=3,
+            narrative="Sample action. Sample narrative.",
+            is_ending=False)
+
+    async def test_aspeculate_narrative_leaves_graph_unchanged(self):
+        self.mock_text_generator.agenerate_narrative.return_value = "Sample narrative."
+        self.mock_text_generator.aaction_to_second_person.return_value = "Sample action."
+        self.mock_graph.is_narrative.return_value = False
+        self.mock_graph.get_paragraph_list.return_value = ["Paragraph."]
+
+        narrative = await self.generator.aspeculate_narrative(self.mock_graph, 3)
+
+        self.assertEqual("Sample action. Sample narrative.", narrative)
+        self.mock_graph.make_narrative_node.assert_not_called()
+
+    async def test_fused_narrative_from_action_makes_one_call(self):
+        self.generator.fuse_action_rewrite = True
+        self.mock_text_generator.agenerate_narrative_with_action.return_value = \
+            ("Sample action.", "Sample narrative.")
+        self.mock_graph.is_narrative.return_value = False
+        self.mock_graph.get_paragraph_list.return_value = ["Paragraph."]
+
+        await self.generator.agenerate_narrative_from_action(self.mock_graph, 3)
+
+        self.mock_text_generator.aaction_to_second_person.assert_not_called()
+        self.mock_graph.make_narrative_node.assert_called_once_with(
+            parent_id=3,
+            narrative="Sample action. Sample narrative.",
+            is_ending=False)
+
+    async def test_fused_narrative_falls_back_on_parse_error(self):
+        self.generator.fuse_action_rewrite = True
+        self.mock_text_generator.agenerate_narrative_with_action.side_effect = GenerationError
+        self.mock_text_generator.aaction_to_second_person.return_value = "Sample action."
+        self.mock_text_generator.agenerate_narrative.return_value = "Sample narrative."
+        self.mock_graph.is_narrative.return_value = False
+        self.mock_graph.get_paragraph_list.return_value = ["Paragraph."]
+
+        await self.generator.agenerate_narrative_from_action(self.mock_graph, 3)
+
+        self.mock_graph.make_narrative_node.assert_called_once_with(
+            parent_id=3,
+            narrative="Sample action. Sample narrative.",
+            is_ending=False)
+
+    async def test_agenerate_narrative_from_action_streams_chunks(self):
+        async def stream(*args, **kwargs):
+            yield "Sample "
+            yield "narrative."
+
+        self.mock_text_generator.agenerate_narrative_stream = stream
+        self.mock_text_generator.aaction_to_second_person.return_value = "Sample action."
+        self.mock_graph.is_narrative.return_value = False
+        self.mock_graph.get_paragraph_list.return_value = ["Paragraph."]
+        chunks = []
+
+        await self.generator.agenerate_narrative_from_action(
+            self.mock_graph, 3, on_chunk=chunks.append)
+
+        self.assertEqual(["Sample action. ", "Sample ", "narrative."], chunks)
+        self.mock_graph.make_narrative_node.assert_called_once_with(
+            parent_id=3,
+            narrative="Sample action. Sample narrative.",
+            is_ending=False)
+
+    async def test_abridge_node_rejects_cycle_before_generating(self):
+        graph = GamebookGraph.from_graph_dict({"nodes": [
+            {"type": "narrative", "nodeId": 0, "data": "N0", "childrenIds": [1], "isEnding": False},
+            {"type": "action", "nodeId": 1, "data": "A1", "childrenIds": [2]},
+            {"type": "narrative", "nodeId": 2, "data": "N2", "childrenIds": [], "isEnding": False},
+        ]})
+        version = graph.version
+
+        with self.assertRaises(GraphCycleError):
+            await self.generator.abridge_node(graph, 2, 0)
+
+        self.mock_text_generator.abridge_content.assert_not_called()
+        self.assertEqual(3, len(graph.node_lookup))
+        self.assertEqual(version, graph.version)
+
+    async def test_agenerate_many_expands_each_level(self):
+        graph = GamebookGraph.from_graph_dict({"nodes": [
+            {"type": "narrative", "nodeId": 0, "data": "N0", "childrenIds": [], "isEnding": False}
+        ]})
+        self.mock_text_generator.ahas_story_ended.return_value = False
+        self.mock_text_generator.agenerate_actions.return_value = ["A", "B"]
+        self.mock_text_generator.aaction_to_second_person.return_value = "You choose."
+        self.mock_text_generator.agenerate_narrative.return_value = "Narrative."
+        feedback = Mock(GenerationProgressFeedback)
+
+        with patch("src.gamebook_generator.have_duplicate_pairs", side_effect=no_duplicate_paths), \
+                patch("src.gamebook_generator.random.random", return_value=1):
+            await self.generator.agenerate_many(graph, 0, 1, feedback)
+
+        self.assertEqual(5, len(graph.node_lookup))
+        self.assertEqual(3, feedback.send_generation_update.call_count)
+
+    async def test_agenerate_many_batched_expands_level_in_one_request(self):
+        graph = GamebookGraph.from_graph_dict({"nodes": [
+            {"type": "narrative", "nodeId": 0, "data": "N0", "childrenIds": [], "isEnding": False}
+        ]})
+        self.mock_text_generator.ahas_story_ended.return_value = False
+        self.mock_text_generator.agenerate_actions_batch.return_value = [["A", "B"]]
+        self.mock_text_generator.aaction_to_second_person.return_value = "You choose."
+        self.mock_text_generator.agenerate_narrative_batch.return_value = ["One.", "Two."]
+        feedback = Mock(GenerationProgressFeedback)
+
+        with patch("src.gamebook_generator.have_duplicate_pairs", side_effect=no_duplicate_paths), \
+                patch("src.gamebook_generator.random.random", return_value=1):
+            await self.generator.agenerate_many(graph, 0, 1, feedback, batch=True)
+
+        self.mock_text_generator.agenerate_narrative_batch.assert_awaited_once()
+        self.assertEqual("You choose. One.", graph.get_data(3))
+        self.assertEqual("You choose. Two.", graph.get_data(4))
+        self.assertEqual(3, feedback.send_generation_update.call_count)
+
+    async def test_agenerate_many_concurrent_matches_sequential_ids(self):
+        def make_graph():
+            return GamebookGraph.from_graph_dict({"nodes": [
+                {"type": "narrative", "nodeId": 0, "data": "N0", "childrenIds": [], "isEnding": False}
+            ]})
+
+        async def narrative(previous_text, **kwargs):
+            # later prompts finish first
+            await asyncio.sleep(0.01 if previous_text.endswith("A ") else 0)
+            return "After " + previous_text[-2:].strip() + "."
+
+        self.mock_text_generator.ahas_story_ended.return_value = False
+        self.mock_text_generator.agenerate_actions.return_value = ["A", "B"]
+        self.mock_text_generator.aaction_to_second_person.side_effect = lambda action: action
+        self.mock_text_generator.agenerate_narrative.side_effect = narrative
+        feedback = Mock(GenerationProgressFeedback)
+
+        sequential_graph = make_graph()
+        concurrent_graph = make_graph()
+        with patch("src.gamebook_generator.have_duplicate_pairs", side_effect=no_duplicate_paths), \
+                patch("src.gamebook_generator.random.random", return_value=1):
+            await self.generator.agenerate_many(sequential_graph, 0, 2, feedback)
+            feedback.reset_mock()
+            await self.generator.agenerate_many(concurrent_graph, 0, 2, feedback, concurrency=4)
+
+        by_id = lambda graph: sorted(graph.to_graph_dict()["nodes"], key=lambda node: node["nodeId"])
+        self.assertEqual(by_id(sequential_graph), by_id(concurrent_graph))
+        self.assertEqual(13, len(concurrent_graph.node_lookup))
+        self.assertEqual("A After A.", concurrent_graph.get_data(3))
+        self.assertEqual(12, feedback.send_generation_update.call_args.args[1])
+
+    async def test_agenerate_many_pipelined_stays_within_node_budget(self):
+        graph = GamebookGraph.from_graph_dict({"nodes": [
+            {"type": "narrative", "nodeId": 0, "data": "N0", "childrenIds": [], "isEnding": False}
+        ]})
+        self.mock_text_generator.ahas_story_ended.return_value = False
+        self.mock_text_generator.agenerate_actions.return_value = ["A", "B"]
+        self.mock_text_generator.aaction_to_second_person.return_value = "You choose."
+        self.mock_text_generator.agenerate_narrative.return_value = "Narrative."
+        feedback = Mock(GenerationProgressFeedback)
+
+        with patch("src.gamebook_generator.have_duplicate_pairs", side_effect=no_duplicate_paths), \
+                patch("src.gamebook_generator.random.random", return_value=1):
+            await self.generator.agenerate_many(
+                graph, 0, 3, feedback, concurrency=4, pipelined=True, node_budget=10)
+
+        self.assertEqual(11, len(graph.node_lookup))
+        for node_id in graph.node_lookup:
+            if not graph.is_narrative(node_id):
+                self.assertEqual(1, len(graph.node_lookup[node_id].children_ids))
+        self.assertEqual(100, feedback.send_generation_update.call_args.args[2])
+
+    async def test_agenerate_many_pipelined_asks_for_no_actions_past_budget(self):
+        graph = GamebookGraph.from_graph_dict({"nodes": [
+            {"type": "narrative", "nodeId": 0, "data": "N0", "childrenIds": [], "isEnding": False}
+        ]})
+        self.mock_text_generator.ahas_story_ended.return_value = False
+        self.mock_text_generator.agenerate_actions.return_value = ["A", "B"]
+        self.mock_text_generator.aaction_to_second_person.return_value = "You choose."
+        self.mock_text_generator.agenerate_narrative.return_value = "Narrative."
+
+        with patch("src.gamebook_generator.have_duplicate_pairs", side_effect=no_duplicate_paths), \
+                patch("src.gamebook_generator.random.random", return_value=1):
+            await self.generator.agenerate_many(graph, 0, 8, Mock(GenerationProgressFeedback),
+                concurrency=4, pipelined=True, node_budget=20)
+
+        # every call adds two actions and their narratives
+        self.assertEqual(21, len(graph.node_lookup))
+        self.assertEqual(5, self.mock_text_generator.agenerate_actions.await_count)
+        self.assertEqual(5, self.mock_text_generator.ahas_story_ended.await_count)
+
+    async def test_agenerate_many_resumes_partial_tree(self):
+        # N0 -> A1 -> N3 (expanded), N0 -> A2 without a narrative
+        graph = GamebookGraph.from_graph_dict({"nodes": [
+            {"type": "narrative", "nodeId": 0, "data": "N0", "childrenIds": [1, 2], "isEnding": False},
+            {"type": "action", "nodeId": 1, "data": "A1", "childrenIds": [3]},
+            {"type": "action", "nodeId": 2, "data": "A2", "childrenIds": []},
+            {"type": "narrative", "nodeId": 3, "data": "N3", "childrenIds": [], "isEnding": False},
+        ]})
+        self.mock_text_generator.ahas_story_ended.return_value = False
+        self.mock_text_generator.agenerate_actions.return_value = ["A", "B"]
+        self.mock_text_generator.aaction_to_second_person.return_value = "You choose."
+        self.mock_text_generator.agenerate_narrative.return_value = "Narrative."
+        feedback = Mock(GenerationProgressFeedback)
+
+        self.assertEqual(({1: [3]}, [(2, 0)]), self.generator._pending_nodes(graph, 0, 2))
+
+        with patch("src.gamebook_generator.have_duplicate_pairs", side_effect=no_duplicate_paths), \
+                patch("src.gamebook_generator.random.random", return_value=1):
+            await self.generator.agenerate_many(graph, 0, 2, feedback, resume=True)
+
+        # A2 gets its narrative, then N3 and that narrative get two choices each
+        self.assertEqual([1, 2], graph.get_children(0))
+        self.assertEqual(1, len(graph.get_children(2)))
+        self.assertEqual(2, len(graph.get_children(3)))
+        self.assertEqual(2, len(graph.get_children(graph.get_children(2)[0])))
+        self.assertEqual(13, len(graph.node_lookup))
+
+    async def test_agenerate_many_without_checks_does_not_load_model(self):
+        graph = GamebookGraph.from_graph_dict({"nodes": [
+            {"type": "narrative", "nodeId": 0, "data": "N0", "childrenIds": [], "isEnding": True}
+        ]})
+        self.mock_text_generator.ahas_story_ended.return_value = True
+
+        await self.generator.agenerate_many(graph, 0, 2, Mock(GenerationProgressFeedback))
+
+        self.mock_await_model.assert_not_awaited()
+
+    async def test_local_ending_check_skips_model_call(self):
+        self.generator.local_ending_check = True
+
+        with patch("src.gamebook_generator.classify_ending", return_value=True):
+            self.assertTrue(await self.generator._ahas_story_ended("The end."))
+
+        self.mock_text_generator.ahas_story_ended.assert_not_called()
+
+    async def test_local_ending_check_runs_off_the_event_loop(self):
+        self.generator.local_ending_check = True
+        threads = []
+
+        def classify_ending(text):
+            threads.append(threading.current_thread())
+            return True
+
+        with patch("src.gamebook_generator.classify_ending", side_effect=classify_ending):
+            await self.generator._ahas_story_ended("The end.")
+
+        self.assertIsNot(threading.main_thread(), threads[0])
+
+    async def test_inconclusive_local_ending_check_falls_back_to_model(self):
+        self.generator.local_ending_check = True
+        self.mock_text_generator.ahas_story_ended.return_value = True
+
+        with patch("src.gamebook_generator.classify_ending", return_value=None):
+            self.assertTrue(await self.generator._ahas_story_ended("Maybe."))
+            self.generator.llm_ending_fallback = False
+            self.assertFalse(await self.generator._ahas_story_ended("Maybe."))
+
+        self.mock_text_generator.ahas_story_ended.assert_awaited_once_with("Maybe.")
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,187 @@
+import asyncio
+import json
+import unittest
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import AsyncMock, MagicMock, Mock
+
+import tornado.web
+
+from src.gamebook_generator import GamebookGenerator
+from src.graph import GamebookGraph
+from src.server.generate_handler import GenerateHandler
+from src.server.generation_jobs import GenerationJobs
+from src.server.graph_store import GraphStore
+from src.text_generator import TextGenerator
+
+
+def story_graph(num_actions: int=0) -> dict:
+    graph = GamebookGraph.from_graph_dict({"nodes": [
+        {"type": "narrative", "nodeId": 0, "data": "N0", "childrenIds": [], "isEnding": False}
+    ]})
+    for i in range(num_actions):
+        graph.make_narrative_node(graph.make_action_node(0, f"A{i}"), f"N{i}")
+    return graph.to_graph_dict()
+
+
+class GenerateHandlerTest(IsolatedAsyncioTestCase):
+    """Messages of one websocket connection, with the model mocked out"""
+
+    async def asyncSetUp(self) -> None:
+        self.db = {"login_credentials": MagicMock(), "stories": MagicMock()}
+        self.db["login_credentials"].find_one = AsyncMock(
+            return_value={"email": "user@example.com", "api_key": ""})
+        self.db["stories"].update_one = AsyncMock()
+        self.db["stories"].find_one = AsyncMock(return_value=None)
+        self.jobs = GenerationJobs(self.db)
+        self.store = GraphStore()
+
+        self.text_generator = Mock(TextGenerator)
+        self.text_generator.agenerate_actions.return_value = ["Go left.", "Go right."]
+
+        self.handler = self.connect()
+        await self.handler.open()
+
+    def connect(self) -> GenerateHandler:
+        app = tornado.web.Application(db=self.db, generation_jobs=self.jobs, graph_store=self.store,
+            cookie_secret="secret")
+        handler = GenerateHandler(app, Mock())
+        handler.get_secure_cookie = Mock(return_value=b"session")
+        handler.make_generator = Mock(side_effect=lambda *args, **kwargs:
+            GamebookGenerator(self.text_generator))
+        handler.sent = []
+        handler.write_message = lambda message: handler.sent.append(json.loads(message))
+        return handler
+
+    async def send(self, req_type: str, data: dict, **msg) -> dict:
+        await self.handler.on_message(json.dumps({"type": req_type, "data": data, "temperature": 0.5, **msg}))
+        return self.handler.sent[-1]
+
+    async def test_graph_ref_applies_to_the_stored_graph(self):
+        reply = await self.send("generateActions", {"graph": story_graph(), "nodeToExpand": 0})
+        self.assertEqual("requestComplete", reply["resType"])
+        self.assertEqual(3, len(reply["graph"]["nodes"]))
+
+        reply = await self.send("addAction", {
+            "graphRef": {"graphId": reply["graphId"], "version": reply["graphVersion"]},
+            "nodeToExpand": 0, "numNewActions": 1,
+        })
+        self.text_generator.aadd_actions.assert_awaited_once()
+        self.assertEqual("requestComplete", reply["resType"])
+        self.assertEqual(1, self.store.stats()["graphs"])
+
+    async def test_unknown_or_stale_graph_ref_is_out_of_sync(self):
+        reply = await self.send("generateActions", {"graph": story_graph(), "nodeToExpand": 0})
+        graph_id, version = reply["graphId"], reply["graphVersion"]
+
+        for graph_ref in [{"graphId": "unknown", "version": 0}, {"graphId": graph_id, "version": version + 1}]:
+            reply = await self.send("generateActions", {"graphRef": graph_ref, "nodeToExpand": 0})
+            self.assertEqual({"resType": "graphOutOfSync", "graphId": graph_ref["graphId"]}, reply)
+        self.assertEqual(1, self.text_generator.agenerate_actions.await_count)
+
+    async def test_switching_stories_releases_the_previous_graph(self):
+        reply = await self.send("generateActions", {"graph": story_graph(), "nodeToExpand": 0})
+        first_id = reply["graphId"]
+        other = GamebookGraph.from_graph_dict(story_graph(1))
+        other_id = self.store.add("user@example.com", other)
+
+        await self.send("generateActions", {"graphRef": {"graphId": other_id, "version": other.version},
+            "nodeToExpand": 0})
+
+        self.assertIsNone(self.store.get("user@example.com", first_id))
+        self.handler.on_close()
+        self.assertEqual(0, self.store.stats()["graphs"])
+
+    async def start_job(self, blocked: bool, data: dict=None, **msg) -> dict:
+        self.waiting, self.release = asyncio.Event(), asyncio.Event()
+        if not blocked:
+            self.release.set()
+
+        async def has_story_ended(text: str) -> bool:
+            self.waiting.set()
+            await self.release.wait()
+            return True
+
+        self.text_generator.ahas_story_ended.side_effect = has_story_ended
+        reply = await self.send("generateMany", {"fromNode": 0, "maxDepth": 2, **(data or {"graph": story_graph()})},
+            **msg)
+        self.assertEqual("jobStarted", reply["resType"])
+        return reply
+
+    async def test_cancel_job_sends_job_cancelled(self):
+        reply = await self.send("cancelJob", {"jobId": "unknown"})
+        self.assertEqual({"resType": "jobNotFound", "jobId": "unknown"}, reply)
+
+        job_id = (await self.start_job(blocked=True))["jobId"]
+        await self.waiting.wait()
+        await self.send("cancelJob", {"jobId": job_id})
+        await self.jobs.get(job_id, "user@example.com").task
+
+        self.assertEqual("jobCancelled", self.handler.sent[-1]["resType"])
+        self.assertEqual(job_id, self.handler.sent[-1]["jobId"])
+
+    async def test_resume_job_on_a_new_connection(self):
+        job_id = (await self.start_job(blocked=False))["jobId"]
+        await self.jobs.get(job_id, "user@example.com").task
+        self.assertEqual("requestComplete", self.handler.sent[-1]["resType"])
+
+        self.handler.on_close()
+        self.handler = self.connect()
+        await self.handler.open()
+
+        reply = await self.send("resumeJob", {"jobId": job_id})
+        self.assertEqual("requestComplete", reply["resType"])
+        self.assertEqual(job_id, reply["jobId"])
+
+        reply = await self.send("resumeJob", {"jobId": "unknown"})
+        self.assertEqual({"resType": "jobNotFound", "jobId": "unknown"}, reply)
+
+    async def test_delta_clients_get_the_nodes_changed_since_their_version(self):
+        reply = await self.send("generateActions", {"graph": story_graph(2), "nodeToExpand": 0})
+        graph_ref = {"graphId": reply["graphId"], "version": reply["graphVersion"]}
+
+        reply = await self.send("generateActions", {"graphRef": graph_ref, "nodeToExpand": 2}, delta=True)
+
+        self.assertNotIn("graph", reply)
+        self.assertEqual(graph_ref["version"], reply["graphDelta"]["fromVersion"])
+        self.assertEqual({2, 7, 8}, {node["nodeId"] for node in reply["graphDelta"]["nodes"]})
+
+    async def test_ack_graph_ignores_stale_versions(self):
+        reply = await self.send("generateActions", {"graph": story_graph(), "nodeToExpand": 0})
+        graph_id, version = reply["graphId"], reply["graphVersion"]
+        job_id = (await self.start_job(True, {"graphRef": {"graphId": graph_id, "version": version - 1}},
+            delta=True))["jobId"]
+        job = self.jobs.get(job_id, "user@example.com")
+
+        for acked in [version, version + 1, version - 1]:
+            await self.send("ackGraph", {"jobId": job_id, "version": acked})
+        self.assertEqual(version, job.acked_version)
+
+        self.release.set()
+        await job.task
+        reply = self.handler.sent[-1]
+        self.assertEqual("requestComplete", reply["resType"])
+        self.assertEqual(version, reply["graphDelta"]["fromVersion"])
+
+    async def test_streamed_narrative_is_sent_in_chunks(self):
+        graph = GamebookGraph.from_graph_dict(story_graph())
+        action_id = graph.make_action_node(0, "Open the door.")
+
+        async def narrative_stream(prompt: str, **kwargs):
+            for chunk in ["It ", "creaks."]:
+                yield chunk
+
+        self.text_generator.aaction_to_second_person.return_value = "You open the door."
+        self.text_generator.agenerate_narrative_stream.side_effect = narrative_stream
+        await self.send("generateNarrative", {"graph": graph.to_graph_dict(), "nodeToExpand": action_id,
+            "isEnding": False, "descriptor": None, "details": None, "style": None, "stream": True})
+
+        *chunks, reply = self.handler.sent
+        self.assertEqual([{"resType": "narrativeChunk", "actionNodeId": action_id, "chunk": chunk}
+            for chunk in ["You open the door. ", "It ", "creaks."]], chunks)
+        self.assertEqual("requestComplete", reply["resType"])
+        narrative = next(node for node in reply["graph"]["nodes"] if node["nodeId"] == action_id + 1)
+        self.assertEqual("You open the door. It creaks.", narrative["data"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,184 @@
+import asyncio
+import functools
+import unittest
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import AsyncMock, MagicMock, Mock, patch
+
+from src.gamebook_generator import GamebookGenerator
+from src.graph import GamebookGraph
+from src.models.gpt3 import OpenAIRateLimitError
+from src.server.generation_jobs import GenerationJob, GenerationJobFeedback, GenerationJobs
+from src.server.story_codec import load_graph
+from src.text_generator import TextGenerator
+
+
+class FakeClock:
+
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class GenerationJobsTest(IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        self.db = MagicMock()
+        self.db["stories"].update_one = AsyncMock()
+        self.clock = FakeClock()
+        self.jobs = GenerationJobs(self.db, checkpoint_interval_secs=5, clock=self.clock)
+
+        self.generator = Mock(GamebookGenerator)
+        self.generator.prompt_tokens = 12
+        self.feedback = Mock(GenerationJobFeedback)
+
+        self.graph = GamebookGraph.from_graph_dict({"nodes": [
+            {"type": "narrative", "nodeId": 0, "data": "N0", "childrenIds": [], "isEnding": False}
+        ]})
+        self.job = GenerationJob("user@example.com", self.graph, 0, 2, {"batch": True}, story_id="story")
+        self.job.attach(self.feedback)
+
+    async def test_completed_job_is_checkpointed_and_reported(self):
+        async def generate(graph, from_node_id, max_depth, progress_feedback, **options):
+            progress_feedback.send_generation_update(graph, 2, 50)
+
+        self.generator.agenerate_many.side_effect = generate
+
+        await self.jobs.start(self.job, self.generator).task
+
+        self.assertEqual(GenerationJob.COMPLETED, self.job.status)
+        self.assertEqual(12, self.job.prompt_tokens)
+        self.feedback.send_job_update.assert_called_once_with(self.job, 2, 50)
+        self.feedback.send_job_finished.assert_called_once_with(self.job)
+        self.generator.agenerate_many.assert_awaited_once_with(
+            self.graph, 0, 2, self.job, resume=False, batch=True)
+
+        query, update = self.db["stories"].update_one.await_args.args
+        self.assertEqual({"_id": "story", "user_email": "user@example.com"}, query)
+        self.assertEqual("completed", update["$set"]["generationJob"]["status"])
+        self.assertEqual(self.graph.to_graph_dict(), load_graph(update["$set"]))
+
+    async def test_updates_are_checkpointed_at_most_once_per_interval(self):
+        async def generate(graph, from_node_id, max_depth, progress_feedback, **options):
+            for num_nodes in range(1, 4):
+                self.clock.now += 3
+                progress_feedback.send_generation_update(graph, num_nodes, 10 * num_nodes)
+                await asyncio.sleep(0)
+
+        self.generator.agenerate_many.side_effect = generate
+
+        await self.jobs.start(self.job, self.generator).task
+
+        # one checkpoint at 6 seconds, then the final one
+        statuses = [call.args[1]["$set"]["generationJob"]["status"]
+            for call in self.db["stories"].update_one.await_args_list]
+        self.assertEqual(["running", "completed"], statuses)
+
+    async def test_cancelled_job_keeps_its_partial_graph(self):
+        async def generate(*args, **kwargs):
+            await asyncio.sleep(10)
+
+        self.generator.agenerate_many.side_effect = generate
+        self.jobs.start(self.job, self.generator)
+        await asyncio.sleep(0)
+
+        self.assertFalse(self.jobs.cancel(self.job.job_id, "someone@example.com"))
+        self.assertTrue(self.jobs.cancel(self.job.job_id, "user@example.com"))
+        await self.job.task
+
+        self.assertEqual(GenerationJob.CANCELLED, self.job.status)
+        self.feedback.send_job_finished.assert_called_once_with(self.job)
+        self.db["stories"].update_one.assert_awaited_once()
+
+    async def test_cancelled_pipelined_job_stops_generating(self):
+        text_generator = Mock(TextGenerator)
+        calls = []
+
+        async def model_call(result, *args, **kwargs):
+            calls.append(result)
+            await asyncio.sleep(0.01)
+            return result
+
+        text_generator.ahas_story_ended.side_effect = functools.partial(model_call, False)
+        text_generator.agenerate_actions.side_effect = functools.partial(model_call, ["A", "B"])
+        text_generator.aaction_to_second_person.side_effect = functools.partial(model_call, "You choose.")
+        text_generator.agenerate_narrative.side_effect = functools.partial(model_call, "Narrative.")
+        job = GenerationJob("user@example.com", self.graph, 0, 6, {"concurrency": 4, "pipelined": True},
+            story_id="story")
+        job.attach(self.feedback)
+
+        with patch("src.gamebook_generator.await_model", new_callable=AsyncMock), \
+                patch("src.gamebook_generator.have_duplicate_pairs", side_effect=lambda paths: [False] * len(paths)), \
+                patch("src.gamebook_generator.random.random", return_value=1):
+            self.jobs.start(job, GamebookGenerator(text_generator))
+            while len(self.graph.node_lookup) < 4:
+                await asyncio.sleep(0.01)
+            self.assertTrue(self.jobs.cancel(job.job_id, "user@example.com"))
+            await job.task
+
+            self.assertEqual(GenerationJob.CANCELLED, job.status)
+            self.feedback.send_job_finished.assert_called_once_with(job)
+            num_calls, num_nodes = len(calls), len(self.graph.node_lookup)
+
+            await asyncio.sleep(0.1)
+            self.assertEqual(num_calls, len(calls))
+            self.assertEqual(num_nodes, len(self.graph.node_lookup))
+
+    async def test_failed_job_reports_error(self):
+        self.generator.agenerate_many.side_effect = OpenAIRateLimitError
+        self.job.detach(self.feedback)
+
+        await self.jobs.start(self.job, self.generator).task
+
+        self.assertEqual(GenerationJob.FAILED, self.job.status)
+        self.assertEqual("rateLimitError", self.job.error)
+        self.feedback.send_job_finished.assert_not_called()
+
+    async def test_unexpected_error_fails_the_job_and_is_reported(self):
+        self.generator.agenerate_many.side_effect = KeyError("nodeId")
+
+        with self.assertLogs(level="ERROR"):
+            await self.jobs.start(self.job, self.generator).task
+
+        self.assertEqual(GenerationJob.FAILED, self.job.status)
+        self.assertEqual("generationError", self.job.error)
+        self.feedback.send_job_finished.assert_called_once_with(self.job)
+        update = self.db["stories"].update_one.await_args.args[1]
+        self.assertEqual("failed", update["$set"]["generationJob"]["status"])
+
+    async def test_jobs_are_only_visible_to_their_user(self):
+        self.generator.agenerate_many.return_value = None
+        await self.jobs.start(self.job, self.generator).task
+
+        self.assertIs(self.job, self.jobs.get(self.job.job_id, "user@example.com"))
+        self.assertIsNone(self.jobs.get(self.job.job_id, "someone@example.com"))
+
+
+    async def test_finished_jobs_are_dropped_after_retention(self):
+        jobs = GenerationJobs(self.db, retention_secs=0.01)
+        self.generator.agenerate_many.return_value = None
+        await jobs.start(self.job, self.generator).task
+        self.assertIs(self.job, jobs.get(self.job.job_id, "user@example.com"))
+
+        await asyncio.sleep(0.05)
+        self.assertIsNone(jobs.get(self.job.job_id, "user@example.com"))
+
+    def test_only_the_attached_feedback_acknowledges_versions(self):
+        self.graph.make_action_node(0, "A1")
+        self.graph.make_action_node(0, "A2")
+
+        self.job.ack(Mock(GenerationJobFeedback), 1)
+        self.assertIsNone(self.job.acked_version)
+
+        self.job.ack(self.feedback, 2)
+        self.job.ack(self.feedback, 1)
+        self.job.ack(self.feedback, 100)
+        self.assertEqual(2, self.job.acked_version)
+
+        self.job.detach(self.feedback)
+        self.assertIsNone(self.job.acked_version)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import asyncio
+import unittest
+from unittest import IsolatedAsyncioTestCase
+
+from src.server.generation_scheduler import GenerationScheduler
+
+
+class FakeClock:
+
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class GenerationSchedulerTest(IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+        self.scheduler = GenerationScheduler(max_concurrency=1, per_user=1, per_key=1,
+            aging_secs=10, clock=self.clock)
+        self.order = []
+
+    async def hold(self, user, api_key=None, priority=GenerationScheduler.BULK, release=None):
+        async with self.scheduler.slot(user, api_key, priority):
+            self.order.append(user)
+            if release is not None:
+                await release.wait()
+
+    async def start(self, *args, **kwargs) -> asyncio.Task:
+        task = asyncio.ensure_future(self.hold(*args, **kwargs))
+        await asyncio.sleep(0)
+        return task
+
+    async def test_interactive_goes_before_bulk(self):
+        release = asyncio.Event()
+        first = await self.start("a", release=release)
+        bulk = await self.start("b", priority=GenerationScheduler.BULK)
+        interactive = await self.start("c", priority=GenerationScheduler.INTERACTIVE)
+
+        self.assertEqual({"interactive": 1, "bulk": 1, "speculative": 0}, self.scheduler.stats()["queued"])
+        release.set()
+        await asyncio.gather(first, bulk, interactive)
+
+        self.assertEqual(["a", "c", "b"], self.order)
+
+    async def test_waiting_bulk_calls_age_past_new_interactive_ones(self):
+        release = asyncio.Event()
+        first = await self.start("a", release=release)
+        bulk = await self.start("b", priority=GenerationScheduler.BULK)
+        self.clock.now += 25
+        interactive = await self.start("c", priority=GenerationScheduler.INTERACTIVE)
+
+        release.set()
+        await asyncio.gather(first, bulk, interactive)
+
+        self.assertEqual(["a", "b", "c"], self.order)
+        self.assertEqual(25, self.scheduler.stats()["waitSecs"]["bulk"]["max"])
+
+    async def test_per_user_and_per_key_caps(self):
+        self.scheduler.max_concurrency = 3
+        release = asyncio.Event()
+        tasks = [
+            await self.start("a", release=release),
+            await self.start("a", release=release),
+            await self.start("b", api_key="key", release=release),
+            await self.start("c", api_key="key", release=release),
+            await self.start("d", release=release),
+        ]
+
+        # the second call of a waits for a, the call of c for the key
+        self.assertEqual(["a", "b", "d"], self.order)
+        self.assertEqual(3, self.scheduler.running)
+
+        release.set()
+        await asyncio.gather(*tasks)
+        self.assertEqual(0, self.scheduler.running)
+        self.assertEqual(["a", "b", "d", "a", "c"], self.order)
+
+    async def test_user_with_fewest_running_goes_first(self):
+        self.scheduler.max_concurrency = 2
+        self.scheduler.per_user = 2
+        release_a, release_b = asyncio.Event(), asyncio.Event()
+        tasks = [
+            await self.start("a", release=release_a),
+            await self.start("b", release=release_b),
+            await self.start("a"),
+            await self.start("c"),
+        ]
+
+        # a queued first, but still has a call running when b finishes
+        release_b.set()
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        self.assertEqual(["a", "b", "c"], self.order)
+
+        release_a.set()
+        await asyncio.gather(*tasks)
+        self.assertEqual(["a", "b", "c", "a"], self.order)
+
+    async def test_cancelled_waiter_leaves_the_queue(self):
+        release = asyncio.Event()
+        first = await self.start("a", release=release)
+        waiting = await self.start("b")
+
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        self.assertEqual({"interactive": 0, "bulk": 0, "speculative": 0}, self.scheduler.stats()["queued"])
+
+        release.set()
+        await first
+        self.assertEqual(0, self.scheduler.running)
+        self.assertEqual(["a"], self.order)
+
+
+if __name__ == "__main__":
+    unittest.main()
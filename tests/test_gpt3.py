@@ -0,0 +1,153 @@
+import unittest
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import AsyncMock, Mock, patch
+
+import openai
+
+from src.models.cache import CompletionCache
+from src.models.gpt3 import GPT3Model, OpenAIRateLimitError, OpenAIUnavailableError
+from src.models.key_scheduler import APIKeyScheduler
+from src.server.generation_scheduler import GenerationScheduler
+from src.text_generator import GenerationError, TextGenerator
+from src.constants import MAX_RATE_LIMIT_ERRORS
+
+
+class AsyncGPT3ModelTest(IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        self.key_scheduler = APIKeyScheduler(["key-one", "key-two"])
+        self.model = GPT3Model(key_scheduler=self.key_scheduler)
+        self.response = Mock(choices=[Mock(text="Sample response.", index=0)])
+
+    @patch("src.models.gpt3.asyncio.sleep", new_callable=AsyncMock)
+    @patch("openai.Completion.create")
+    async def test_acomplete_retries_rate_limit_without_blocking(self, mock_create, mock_sleep):
+        mock_create.side_effect = [openai.error.RateLimitError("limited"), self.response]
+
+        self.assertEqual("Sample response.", await self.model.acomplete("Prompt"))
+        self.assertEqual(2, mock_create.call_count)
+        # the retry goes straight to the other, healthy key
+        mock_sleep.assert_awaited_once_with(0)
+        first_key = mock_create.call_args_list[0].kwargs["api_key"]
+        second_key = mock_create.call_args_list[1].kwargs["api_key"]
+        self.assertNotEqual(first_key, second_key)
+
+    @patch("src.models.gpt3.asyncio.sleep", new_callable=AsyncMock)
+    @patch("openai.Completion.create")
+    async def test_acomplete_gives_up_after_max_rate_limit_errors(self, mock_create, mock_sleep):
+        mock_create.side_effect = openai.error.RateLimitError("limited")
+
+        with self.assertRaises(OpenAIRateLimitError):
+            await self.model.acomplete("Prompt")
+        self.assertEqual(MAX_RATE_LIMIT_ERRORS + 1, mock_create.call_count)
+
+    @patch("src.models.gpt3.asyncio.sleep", new_callable=AsyncMock)
+    @patch("openai.Completion.create")
+    async def test_own_key_is_used_again_after_rate_limit_recovers(self, mock_create, mock_sleep):
+        mock_create.side_effect = [openai.error.RateLimitError("limited"), self.response, self.response]
+        model = GPT3Model(api_key="own-key", key_scheduler=self.key_scheduler)
+
+        await model.acomplete("Prompt")
+        self.assertFalse(model.rate_limited)
+        await model.acomplete("Other prompt")
+
+        keys = [call.kwargs["api_key"] for call in mock_create.call_args_list]
+        self.assertEqual("own-key", keys[0])
+        self.assertIn(keys[1], ["key-one", "key-two"])
+        self.assertEqual("own-key", keys[2])
+
+    @patch("openai.Edit.create")
+    async def test_aedit_maps_service_errors(self, mock_create):
+        mock_create.side_effect = openai.error.ServiceUnavailableError("down")
+
+        with self.assertRaises(OpenAIUnavailableError):
+            await self.model.aedit("Text", "Instruction")
+
+    @patch("openai.Completion.create")
+    async def test_cached_completion_skips_request(self, mock_create):
+        mock_create.return_value = self.response
+        cache = CompletionCache()
+
+        model = GPT3Model(cache=cache, key_scheduler=self.key_scheduler)
+        self.assertEqual("Sample response.", await model.acomplete("Prompt"))
+        self.assertEqual("Sample response.", model.complete("Prompt"))
+        self.assertEqual(1, mock_create.call_count)
+
+        fresh_model = GPT3Model(cache=cache, use_cache=False, key_scheduler=self.key_scheduler)
+        await fresh_model.acomplete("Prompt")
+        self.assertEqual(2, mock_create.call_count)
+
+    @patch("openai.Completion.create")
+    async def test_bridge_retry_after_empty_completion_asks_the_model_again(self, mock_create):
+        mock_create.side_effect = [
+            Mock(choices=[Mock(text="", index=0)]), Mock(choices=[Mock(text="Middle.", index=0)])
+        ]
+        generator = TextGenerator(GPT3Model(cache=CompletionCache(), key_scheduler=self.key_scheduler))
+
+        self.assertEqual("Middle.", await generator.abridge_content("Start.", "End."))
+        self.assertEqual(2, mock_create.call_count)
+
+    @patch("openai.Completion.create")
+    async def test_unparseable_completion_is_not_cached(self, mock_create):
+        mock_create.side_effect = [
+            Mock(choices=[Mock(text="Run or fight.", index=0)]),
+            Mock(choices=[Mock(text='["Run.", "Fight."]', index=0)]),
+        ]
+        generator = TextGenerator(GPT3Model(cache=CompletionCache(), key_scheduler=self.key_scheduler))
+
+        with self.assertRaises(GenerationError):
+            await generator.agenerate_actions("Sample text.")
+        self.assertEqual(["Run.", "Fight."], await generator.agenerate_actions("Sample text."))
+        self.assertEqual(["Run.", "Fight."], await generator.agenerate_actions("Sample text."))
+        self.assertEqual(2, mock_create.call_count)
+
+    @patch("openai.Completion.create")
+    async def test_acomplete_batch_sends_only_cache_misses(self, mock_create):
+        cache = CompletionCache()
+        model = GPT3Model(cache=cache, key_scheduler=self.key_scheduler)
+        mock_create.return_value = self.response
+        await model.acomplete("Cached")
+
+        mock_create.return_value = Mock(choices=[
+            Mock(text="Second.", index=1), Mock(text="First.", index=0)
+        ])
+        results = await model.acomplete_batch(["One", "Cached", "Two"])
+
+        self.assertEqual(["First.", "Sample response.", "Second."], results)
+        self.assertEqual(["One", "Two"], mock_create.call_args.kwargs["prompt"])
+        self.assertEqual("Second.", model.complete("Two"))
+        self.assertEqual(2, mock_create.call_count)
+
+    @patch("openai.Completion.create")
+    async def test_acomplete_stream_yields_chunks_and_caches_text(self, mock_create):
+        mock_create.return_value = iter([
+            Mock(choices=[Mock(text="Once ")]), Mock(choices=[Mock(text="upon.")])
+        ])
+        model = GPT3Model(cache=CompletionCache(), key_scheduler=self.key_scheduler)
+
+        chunks = [chunk async for chunk in model.acomplete_stream("Prompt")]
+
+        self.assertEqual(["Once ", "upon."], chunks)
+        self.assertTrue(mock_create.call_args.kwargs["stream"])
+        self.assertEqual("Once upon.", await model.acomplete("Prompt"))
+        self.assertEqual(1, mock_create.call_count)
+
+    @patch("openai.Completion.create")
+    async def test_requests_hold_a_gate_slot(self, mock_create):
+        scheduler = GenerationScheduler(max_concurrency=1)
+        model = GPT3Model(use_cache=False, key_scheduler=self.key_scheduler,
+            gate=scheduler.gate("user@example.com", None, GenerationScheduler.INTERACTIVE))
+
+        def create(**kwargs):
+            self.assertEqual(1, scheduler.running)
+            return self.response
+
+        mock_create.side_effect = create
+
+        self.assertEqual("Sample response.", await model.acomplete("Prompt"))
+        self.assertEqual(0, scheduler.running)
+        self.assertEqual(1, scheduler.stats()["granted"]["interactive"])
+
+
+if __name__ == "__main__":
+    unittest.main()
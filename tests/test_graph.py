@@ -1,7 +1,7 @@
 import unittest
 from unittest import TestCase
 
-from src.graph import GamebookGraph
+from src.graph import ActionNodeData, GamebookGraph, GraphCycleError, NarrativeNodeData
 
 class GamebookGraphTest(TestCase):
 
@@ -59,6 +59,17 @@ class GamebookGraphTest(TestCase):
             self.example_node_data
         )
     
+    def test_node_data_defaults_and_copies(self):
+        narrative = NarrativeNodeData.from_dict({"nodeId": 7, "data": "N7"})
+        self.assertEqual(NarrativeNodeData(7, "N7", [], False, "narrative"), narrative)
+        action = ActionNodeData.from_dict({"nodeId": 8, "data": "A8", "childrenIds": [9], "unknown": 1})
+        self.assertEqual(ActionNodeData(8, "A8", [9], "action"), action)
+
+        serialized = action.to_dict()
+        serialized["childrenIds"].append(10)
+        self.assertEqual([9], action.children_ids)
+        self.assertFalse(hasattr(action, "__dict__"))
+
     def test_make_action_node(self):
         parent_id = 0
         node_id = self.gamebook_graph.make_action_node(0, self.example_action)
@@ -91,6 +102,16 @@ class GamebookGraphTest(TestCase):
         self.assertEqual([3, 5], self.gamebook_graph.node_lookup[parent_id].children_ids)
         self.assertTrue(node.is_ending)
 
+    def test_make_nodes_with_reserved_ids(self):
+        reserved_ids = self.gamebook_graph.reserve_node_ids(2)
+        self.assertEqual([5, 6], reserved_ids)
+
+        self.gamebook_graph.make_narrative_node(1, "Second", node_id=6)
+        self.gamebook_graph.make_narrative_node(2, "First", node_id=5)
+        self.assertEqual("First", self.gamebook_graph.get_data(5))
+        self.assertEqual([3, 6], self.gamebook_graph.node_lookup[1].children_ids)
+        self.assertEqual(7, self.gamebook_graph.make_action_node(5, self.example_action))
+
     def test_set_ending_narrative(self):
         self.gamebook_graph.set_ending_narrative(4, is_ending=True)
         self.assertTrue(self.gamebook_graph.node_lookup[4].is_ending)
@@ -116,6 +137,102 @@ class GamebookGraphTest(TestCase):
         expected = ["N0", "N3"]
         self.assertEqual(expected, self.gamebook_graph.get_paragraph_list(3))
 
+    def test_get_actions_list(self):
+        node_id = self.gamebook_graph.make_action_node(3, "A5")
+        self.assertEqual(["A5", "A1"], self.gamebook_graph.get_actions_list(node_id))
+
+    def test_paths_extend_from_parent_and_follow_edits(self):
+        self.assertEqual(["N0", "N3"], self.gamebook_graph.get_paragraph_list(3))
+        action_id = self.gamebook_graph.make_action_node(3, "A5")
+        narrative_id = self.gamebook_graph.make_narrative_node(action_id, "N6")
+        self.assertEqual(["N0", "N3", "N6"], self.gamebook_graph.get_paragraph_list(narrative_id))
+
+        self.gamebook_graph.set_data(3, "Edited")
+        self.gamebook_graph.set_data(action_id, "Edited action")
+        self.assertEqual(["N0", "Edited", "N6"], self.gamebook_graph.get_paragraph_list(narrative_id))
+        self.assertEqual(["Edited action", "A1"], self.gamebook_graph.get_actions_list(narrative_id))
+        # siblings keep their path
+        self.assertEqual(["N0", "N4"], self.gamebook_graph.get_paragraph_list(4))
+
+    def test_paths_follow_first_parent_of_connected_nodes(self):
+        self.gamebook_graph.connect_nodes(3, 4)
+        self.assertEqual(["N0", "N4"], self.gamebook_graph.get_paragraph_list(4))
+
+        orphan = GamebookGraph.from_graph_dict({"nodes": [
+            {"type": "narrative", "nodeId": 0, "data": "N0", "childrenIds": [], "isEnding": False},
+            {"type": "action", "nodeId": 1, "data": "A1", "childrenIds": []},
+        ]})
+        self.assertEqual([], orphan.get_paragraph_list(1))
+        orphan.connect_nodes(0, 1)
+        self.assertEqual(["N0"], orphan.get_paragraph_list(1))
+
+    def test_delta_since_has_nodes_changed_after_version(self):
+        self.assertEqual({"fromVersion": 0, "version": 0, "nodes": []}, self.gamebook_graph.delta_since(0))
+
+        action_id = self.gamebook_graph.make_action_node(4, "A5")
+        version = self.gamebook_graph.version
+        self.gamebook_graph.set_data(1, "Edited")
+        self.gamebook_graph.set_ending_narrative(4, True)
+
+        delta = self.gamebook_graph.delta_since(0)
+        self.assertEqual([action_id, 1, 4], [node["nodeId"] for node in delta["nodes"]])
+        self.assertEqual([action_id], delta["nodes"][2]["childrenIds"])
+        self.assertTrue(delta["nodes"][2]["isEnding"])
+
+        delta = self.gamebook_graph.delta_since(version)
+        self.assertEqual(version, delta["fromVersion"])
+        self.assertEqual([1, 4], [node["nodeId"] for node in delta["nodes"]])
+
+        self.assertIsNone(self.gamebook_graph.delta_since(self.gamebook_graph.version + 1))
+        self.assertIsNone(self.gamebook_graph.delta_since(-1))
+
+    def test_structural_index(self):
+        self.assertEqual(2, self.gamebook_graph.get_depth(3))
+        self.assertEqual({3, 4}, self.gamebook_graph.get_leaves())
+        self.assertEqual({4}, self.gamebook_graph.get_open_leaves())
+        self.assertEqual(1, self.gamebook_graph.count_endings_below(0))
+
+        action_id = self.gamebook_graph.make_action_node(4, "A5")
+        narrative_id = self.gamebook_graph.make_narrative_node(action_id, "N6", is_ending=True)
+        self.assertEqual(4, self.gamebook_graph.get_depth(narrative_id))
+        self.assertEqual({3, narrative_id}, self.gamebook_graph.get_leaves())
+        self.assertEqual(set(), self.gamebook_graph.get_open_leaves())
+        self.assertEqual(2, self.gamebook_graph.count_endings_below(0))
+        self.assertEqual(1, self.gamebook_graph.count_endings_below(2))
+
+        self.gamebook_graph.set_ending_narrative(3, False)
+        self.assertEqual({3}, self.gamebook_graph.get_open_leaves())
+        self.assertEqual(1, self.gamebook_graph.count_endings_below(0))
+        self.assertEqual(0, self.gamebook_graph.count_endings_below(1))
+
+    def test_connecting_a_root_moves_its_subtree(self):
+        graph = GamebookGraph.from_graph_dict({"nodes": [
+            {"type": "narrative", "nodeId": 0, "data": "N0", "childrenIds": [], "isEnding": False},
+            {"type": "action", "nodeId": 1, "data": "A1", "childrenIds": [2]},
+            {"type": "narrative", "nodeId": 2, "data": "N2", "childrenIds": [], "isEnding": True},
+        ]})
+        self.assertEqual(1, graph.get_depth(2))
+
+        graph.connect_nodes(0, 1)
+        self.assertEqual(0, graph.get_parent(1))
+        self.assertEqual(2, graph.get_depth(2))
+        self.assertEqual(1, graph.count_endings_below(0))
+        self.assertEqual({2}, graph.get_leaves())
+
+    def test_cycles_are_rejected(self):
+        with self.assertRaises(GraphCycleError):
+            self.gamebook_graph.connect_nodes(3, 0)
+        with self.assertRaises(GraphCycleError):
+            self.gamebook_graph.connect_nodes(3, 3)
+        self.assertEqual([], self.gamebook_graph.get_children(3))
+        self.assertEqual(0, self.gamebook_graph.version)
+
+        cyclic = dict(self.example_node_data)
+        cyclic["nodes"] = [dict(node) for node in self.example_node_data["nodes"]]
+        cyclic["nodes"][2]["childrenIds"] = [2]
+        with self.assertRaises(GraphCycleError):
+            GamebookGraph.from_graph_dict(cyclic)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+from unittest import TestCase
+
+from src.graph import GamebookGraph
+from src.server.graph_store import GraphStore
+
+
+def make_graph() -> GamebookGraph:
+    return GamebookGraph.from_graph_dict({"nodes": [
+        {"type": "narrative", "nodeId": 0, "data": "N0", "childrenIds": [], "isEnding": False}
+    ]})
+
+
+class GraphStoreTest(TestCase):
+
+    def setUp(self) -> None:
+        self.store = GraphStore(max_graphs=2)
+
+    def test_graphs_are_only_visible_to_their_user(self):
+        graph = make_graph()
+        graph_id = self.store.add("user@example.com", graph)
+
+        self.assertIs(graph, self.store.get("user@example.com", graph_id))
+        self.assertIsNone(self.store.get("someone@example.com", graph_id))
+
+        self.store.remove("user@example.com", graph_id)
+        self.assertIsNone(self.store.get("user@example.com", graph_id))
+
+    def test_least_recently_used_graph_is_dropped(self):
+        first = self.store.add("user@example.com", make_graph())
+        second = self.store.add("user@example.com", make_graph())
+        self.store.get("user@example.com", first)
+        third = self.store.add("someone@example.com", make_graph())
+
+        self.assertIsNotNone(self.store.get("user@example.com", first))
+        self.assertIsNone(self.store.get("user@example.com", second))
+        self.assertIsNotNone(self.store.get("someone@example.com", third))
+        self.assertEqual({"graphs": 2, "nodes": 2, "hits": 3, "misses": 1, "evictions": 1}, self.store.stats())
+
+
+if __name__ == "__main__":
+    unittest.main()
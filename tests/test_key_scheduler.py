@@ -0,0 +1,83 @@
+import unittest
+from unittest import TestCase
+
+from src.models.key_scheduler import APIKeyScheduler, TokenBucket
+
+
+class FakeClock:
+
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TokenBucketTest(TestCase):
+
+    def test_bucket_refills_up_to_capacity(self):
+        clock = FakeClock()
+        bucket = TokenBucket(10, 1, clock)
+        bucket.consume(8)
+        self.assertEqual(2, bucket.available())
+
+        clock.now = 5
+        self.assertEqual(7, bucket.available())
+        clock.now = 100
+        self.assertEqual(10, bucket.available())
+
+
+class APIKeySchedulerTest(TestCase):
+
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+        self.scheduler = APIKeyScheduler(
+            ["key-one", "key-two"],
+            requests_per_min=60,
+            tokens_per_min=6000,
+            cooldown_secs=10,
+            clock=self.clock,
+        )
+
+    def test_key_with_most_headroom_is_chosen(self):
+        first = self.scheduler.acquire(estimated_tokens=3000)
+        second = self.scheduler.acquire(estimated_tokens=100)
+        third = self.scheduler.acquire(estimated_tokens=100)
+
+        self.assertNotEqual(first, second)
+        self.assertEqual(second, third)
+
+    def test_rate_limited_key_cools_down(self):
+        self.scheduler.report_rate_limited("key-one")
+
+        self.assertEqual(["key-two"] * 3, [self.scheduler.acquire() for _ in range(3)])
+        self.assertEqual(0, self.scheduler.seconds_until_available())
+
+        self.clock.now = 11
+        self.assertIn("key-one", [self.scheduler.acquire() for _ in range(3)])
+
+    def test_repeated_rate_limits_back_off_exponentially(self):
+        self.scheduler.report_rate_limited("key-one")
+        self.scheduler.report_rate_limited("key-one")
+        self.scheduler.report_rate_limited("key-two")
+
+        self.assertEqual(10, self.scheduler.seconds_until_available())
+        self.assertEqual("key-two", self.scheduler.acquire())
+
+        self.clock.now = 15
+        self.assertEqual(0, self.scheduler.seconds_until_available())
+        state = {entry["key"]: entry for entry in self.scheduler.state()}
+        self.assertEqual(5, state["...-one"]["cooldownSecs"])
+
+    def test_success_resets_backoff(self):
+        self.scheduler.report_rate_limited("key-one")
+        self.scheduler.report_success("key-one")
+        self.scheduler.report_rate_limited("key-one")
+
+        state = {entry["key"]: entry for entry in self.scheduler.state()}
+        self.assertEqual(10, state["...-one"]["cooldownSecs"])
+        self.assertEqual(2, state["...-one"]["numRateLimits"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import json
+import unittest
+from unittest import IsolatedAsyncioTestCase, TestCase
+from unittest.mock import patch
+
+import openai
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+
+from src.models.gpt3 import GPT3Model, OpenAIRateLimitError
+from src.models.key_scheduler import APIKeyScheduler
+from src.server.openai_stand_in import LatencyProfile, fake_completion, make_app
+from src.text_generator import TextGenerator
+
+
+class FakeResponsesTest(TestCase):
+
+    def test_completion_is_deterministic(self):
+        self.assertEqual(fake_completion("Prompt", 64), fake_completion("Prompt", 64))
+        self.assertNotEqual(fake_completion("Prompt", 64), fake_completion("Other", 64))
+
+    def test_action_prompts_get_json_lists(self):
+        prompt = "Story.\n\n" + TextGenerator.option_prompt(3)
+        self.assertEqual(3, len(json.loads(fake_completion(prompt, 256))))
+
+    def test_unknown_latency_profile_is_rejected(self):
+        with self.assertRaises(ValueError):
+            LatencyProfile("gaussian:1", None)
+
+
+class StandInServerTest(IsolatedAsyncioTestCase):
+
+    def serve(self, **options):
+        sock, port = bind_unused_port()
+        server = HTTPServer(make_app(**options))
+        server.add_sockets([sock])
+        self.addCleanup(server.stop)
+        patcher = patch.object(openai, "api_base", f"http://127.0.0.1:{port}/v1")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def model(self):
+        return GPT3Model(key_scheduler=APIKeyScheduler(["stand-in"]))
+
+    async def test_generate_actions_through_stand_in(self):
+        self.serve()
+        actions = await TextGenerator(self.model()).agenerate_actions("Story.", 2)
+        self.assertEqual(2, len(actions))
+
+    async def test_batch_and_stream_through_stand_in(self):
+        self.serve()
+        model = self.model()
+
+        batch = await model.acomplete_batch(["One", "Two"])
+        streamed = "".join([chunk async for chunk in model.acomplete_stream("Two")])
+
+        self.assertEqual(fake_completion("Two", 256), batch[1])
+        self.assertEqual(batch[1], streamed)
+
+    @patch("src.models.gpt3.asyncio.sleep")
+    async def test_injected_rate_limits_surface_as_errors(self, mock_sleep):
+        self.serve(rate_limit_rate=1)
+        with self.assertRaises(OpenAIRateLimitError):
+            await self.model().aedit("Run away.", "Rewrite")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+from unittest import TestCase
+
+from src.prompt_builder import ApproximateTokenCounter, PromptBuilder
+
+
+class PromptBuilderTest(TestCase):
+
+    def setUp(self) -> None:
+        # 4 characters per token, so 40 characters are 10 tokens
+        self.builder = PromptBuilder(
+            budgets={"narrative": 25, "actions": 1000},
+            counter=ApproximateTokenCounter(),
+        )
+        self.old = "First old sentence. Second old sentence ends here now."
+        self.middle = "M" * 40
+        self.recent = "R" * 40
+
+    def test_short_story_is_kept_whole(self):
+        prompt = self.builder.build([self.old, self.middle, self.recent], "actions")
+
+        self.assertEqual(" ".join([self.old, self.middle, self.recent]), prompt.text)
+        self.assertEqual(0, prompt.num_dropped)
+        self.assertEqual(3, prompt.num_paragraphs)
+
+    def test_recent_paragraphs_are_kept_and_old_ones_dropped(self):
+        prompt = self.builder.build([self.old, self.middle, self.recent], "narrative")
+
+        self.assertEqual(self.middle + " " + self.recent, prompt.text)
+        self.assertEqual(1, prompt.num_dropped)
+        self.assertLessEqual(prompt.num_tokens, 25)
+
+    def test_oversized_latest_paragraph_is_trimmed_at_sentence(self):
+        builder = PromptBuilder(budgets={"narrative": 10}, counter=ApproximateTokenCounter())
+
+        prompt = builder.build([self.old], "narrative")
+
+        self.assertEqual("Second old sentence ends here now.", prompt.text)
+        self.assertLessEqual(prompt.num_tokens, 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import asyncio
+import unittest
+from unittest import IsolatedAsyncioTestCase
+
+from src.models.single_flight import SingleFlight
+
+
+class SingleFlightTest(IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        self.single_flight = SingleFlight()
+        self.num_requests = 0
+
+    async def slow_request(self):
+        self.num_requests += 1
+        await asyncio.sleep(0.01)
+        return "Result"
+
+    async def test_concurrent_identical_calls_share_one_request(self):
+        results = await asyncio.gather(*[
+            self.single_flight.do("key", self.slow_request) for _ in range(3)
+        ])
+
+        self.assertEqual(["Result"] * 3, results)
+        self.assertEqual(1, self.num_requests)
+        self.assertEqual({"calls": 1, "coalesced": 2, "inFlight": 0}, self.single_flight.stats())
+
+    async def test_different_keys_are_not_coalesced(self):
+        await asyncio.gather(
+            self.single_flight.do("one", self.slow_request),
+            self.single_flight.do("two", self.slow_request),
+        )
+
+        self.assertEqual(2, self.num_requests)
+
+    async def test_sequential_calls_make_new_requests(self):
+        await self.single_flight.do("key", self.slow_request)
+        await self.single_flight.do("key", self.slow_request)
+
+        self.assertEqual(2, self.num_requests)
+
+    async def test_errors_reach_every_waiter(self):
+        async def failing_request():
+            await asyncio.sleep(0.01)
+            raise ValueError
+
+        results = await asyncio.gather(
+            self.single_flight.do("key", failing_request),
+            self.single_flight.do("key", failing_request),
+            return_exceptions=True,
+        )
+
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+    async def test_cancelled_waiter_does_not_cancel_others(self):
+        first = asyncio.ensure_future(self.single_flight.do("key", self.slow_request))
+        second = asyncio.ensure_future(self.single_flight.do("key", self.slow_request))
+        await asyncio.sleep(0)
+        first.cancel()
+
+        self.assertEqual("Result", await second)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import asyncio
+import unittest
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import Mock
+
+from src.gamebook_generator import GamebookGenerator
+from src.graph import GamebookGraph
+from src.server.generation_scheduler import GenerationScheduler
+from src.server.speculation import SpeculativeNarratives
+
+
+class SpeculativeNarrativesTest(IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        self.graph = GamebookGraph.from_graph_dict({"nodes": [
+            {"type": "narrative", "nodeId": 0, "data": "N0", "childrenIds": [1, 2], "isEnding": False},
+            {"type": "action", "nodeId": 1, "data": "Go left.", "childrenIds": []},
+            {"type": "action", "nodeId": 2, "data": "Go right.", "childrenIds": []},
+        ]})
+        self.speculation = SpeculativeNarratives(token_budget=100, max_pending=2)
+        self.release = asyncio.Event()
+
+    def make_generator(self, prompt_tokens: int=10) -> Mock:
+        generator = Mock(GamebookGenerator)
+        generator.prompt_tokens = prompt_tokens
+
+        async def speculate_narrative(graph, action_id, *args):
+            await self.release.wait()
+            return f"Narrative of {graph.get_data(action_id)}"
+
+        generator.aspeculate_narrative.side_effect = speculate_narrative
+        return generator
+
+    async def test_matching_request_gets_the_pending_narrative(self):
+        self.speculation.speculate(self.make_generator(), self.graph, [1, 2], 0.5, style="Gothic")
+        self.release.set()
+
+        # a copy with the same text, as sent back by the client
+        graph = GamebookGraph.from_graph_dict(self.graph.to_graph_dict())
+        narrative_id = await self.speculation.aexpand(graph, 2, 0.5, style="Gothic")
+
+        self.assertEqual("Narrative of Go right.", graph.get_data(narrative_id))
+        self.assertEqual([narrative_id], graph.get_children(2))
+        self.assertEqual(1, self.speculation.stats()["hits"])
+
+    async def test_different_options_miss(self):
+        self.speculation.speculate(self.make_generator(), self.graph, [1], 0.5)
+        self.release.set()
+
+        self.assertIsNone(await self.speculation.aexpand(self.graph, 1, 0.9))
+        self.assertIsNone(await self.speculation.aexpand(self.graph, 1, 0.5, is_ending=True))
+        self.assertIsNotNone(await self.speculation.aexpand(self.graph, 1, 0.5))
+        # each candidate is used once
+        self.assertIsNone(await self.speculation.aexpand(self.graph, 1, 0.5))
+
+    async def test_failed_speculation_misses(self):
+        generator = self.make_generator()
+        generator.aspeculate_narrative.side_effect = RuntimeError
+        self.speculation.speculate(generator, self.graph, [1], 0.5)
+
+        self.assertIsNone(await self.speculation.aexpand(self.graph, 1, 0.5))
+        self.assertEqual(1, self.speculation.stats()["misses"])
+
+    async def test_oldest_candidate_is_dropped_and_cancelled(self):
+        self.graph.make_action_node(0, "Wait.")
+        self.speculation.speculate(self.make_generator(), self.graph, [1, 2, 3], 0.5)
+        await asyncio.sleep(0)
+
+        self.assertEqual({"pending": 2, "started": 3, "dropped": 1},
+            {key: self.speculation.stats()[key] for key in ("pending", "started", "dropped")})
+        self.assertIsNone(await self.speculation.aexpand(self.graph, 1, 0.5))
+
+        self.speculation.cancel_all()
+        self.assertEqual(0, self.speculation.stats()["pending"])
+
+    async def test_awaited_narrative_is_promoted_past_bulk_work(self):
+        scheduler = GenerationScheduler(max_concurrency=1)
+        release_gate = asyncio.Event()
+        order = []
+
+        async def model_call(user, priority):
+            async with scheduler.slot(user, None, priority):
+                order.append(user)
+                await release_gate.wait()
+
+        async def speculate_narrative(graph, action_id, *args):
+            # as with single flight, the call runs in a task of its own
+            await asyncio.ensure_future(model_call("speculative", GenerationScheduler.SPECULATIVE))
+            return "Narrative."
+
+        generator = self.make_generator()
+        generator.aspeculate_narrative.side_effect = speculate_narrative
+
+        running = asyncio.ensure_future(model_call("running", GenerationScheduler.BULK))
+        await asyncio.sleep(0)
+        self.speculation.speculate(generator, self.graph, [1], 0.5)
+        bulk = asyncio.ensure_future(model_call("bulk", GenerationScheduler.BULK))
+        await asyncio.sleep(0)
+
+        expand = asyncio.ensure_future(self.speculation.aexpand(self.graph, 1, 0.5))
+        await asyncio.sleep(0)
+        release_gate.set()
+        await asyncio.gather(running, bulk, expand)
+
+        self.assertEqual(["running", "speculative", "bulk"], order)
+        self.assertEqual(1, scheduler.stats()["granted"]["interactive"])
+
+    async def test_nothing_starts_once_budget_is_spent(self):
+        self.release.set()
+        self.speculation.speculate(self.make_generator(prompt_tokens=100), self.graph, [1], 0.5)
+        await self.speculation.aexpand(self.graph, 1, 0.5)
+        await asyncio.sleep(0)
+
+        self.assertEqual(100, self.speculation.stats()["spentTokens"])
+        self.assertEqual(0, self.speculation.speculate(self.make_generator(), self.graph, [2], 0.5))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+from src.server import story_codec
+from src.server.story_codec import (JSON_ZLIB, MSGPACK_ZSTD, RAW, StoryCodecError, available_codec,
+    decoded_story, load_graph, load_meta, story_document, story_update)
+
+
+class StoryCodecTest(TestCase):
+
+    def setUp(self) -> None:
+        self.graph = {"nodes": [
+            {"nodeId": 0, "data": "Once upon a time. " * 50, "childrenIds": [1], "isEnding": False, "type": "narrative"},
+            {"nodeId": 1, "data": "Go on.", "childrenIds": [], "type": "action"},
+        ]}
+
+    def test_every_codec_round_trips(self):
+        for codec in (RAW, JSON_ZLIB, MSGPACK_ZSTD):
+            with self.subTest(codec=codec):
+                stored = story_document(self.graph, available_codec(codec))
+                self.assertEqual(self.graph, load_graph(stored))
+                self.assertEqual({"totalSections": 1, "firstParagraph": self.graph["nodes"][0]["data"],
+                    "numNodes": 2}, load_meta(stored))
+
+    def test_binary_codecs_compress_and_replace_the_raw_story(self):
+        update = story_update(self.graph, JSON_ZLIB, set_fields={"generationJob": {"jobId": "job"}})
+
+        self.assertNotIn("story", update["$set"])
+        self.assertEqual({"story": ""}, update["$unset"])
+        self.assertEqual({"jobId": "job"}, update["$set"]["generationJob"])
+        self.assertLess(len(update["$set"]["storyData"]), len(self.graph["nodes"][0]["data"]) / 4)
+
+        self.assertEqual({"storyData": "", "storyCodec": ""}, story_update(self.graph, RAW)["$unset"])
+
+    def test_documents_written_before_codecs_are_read(self):
+        stored = {"_id": "story", "name": "Story", "user_email": "user@example.com", "story": self.graph}
+
+        self.assertEqual(2, load_meta(stored)["numNodes"])
+        self.assertEqual(stored, decoded_story(stored))
+
+    def test_decoded_story_has_no_storage_fields(self):
+        stored = {"name": "Story", **story_document(self.graph, JSON_ZLIB)}
+        self.assertEqual({"name": "Story", "story": self.graph}, decoded_story(stored))
+
+    def test_missing_libraries_fall_back_to_zlib(self):
+        with patch.object(story_codec, "zstandard", None):
+            self.assertEqual(JSON_ZLIB, available_codec(MSGPACK_ZSTD))
+        with self.assertRaises(StoryCodecError):
+            available_codec("lz4")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,9 @@
 import unittest
-from unittest import TestCase
+from unittest import IsolatedAsyncioTestCase, TestCase
 from unittest.mock import Mock
 from parameterized import parameterized
 
-from src.text_generator import TextGenerator
+from src.text_generator import GenerationError, TextGenerator
 from src.models.gpt3 import GPT3Model
 
 
@@ -127,5 +127,76 @@ class TextGeneratorTest(TestCase):
         self.mock_model.complete.assert_called_once_with(expected_prompt)
         self.assertEqual(self.sample_response, story)
 
+    def test_has_story_ended_includes_story_text(self):
+        self.mock_model.complete.return_value = " Yes"
+        self.assertTrue(self.generator.has_story_ended(self.sample_text))
+        self.mock_model.complete.assert_called_once_with(
+            self.sample_text + "\n\nDid the story end yet (Yes | No)?")
+
+
+class AsyncTextGeneratorTest(IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.mock_model = Mock(GPT3Model)
+        self.generator = TextGenerator(self.mock_model)
+
+    async def test_agenerate_narrative(self):
+        self.mock_model.acomplete.return_value = "Sample response."
+        paragraph = await self.generator.agenerate_narrative("Sample text.", is_ending=True)
+        self.mock_model.acomplete.assert_awaited_once_with(
+            "Sample text.\n\nGenerate an ending.\n\nResult: ")
+        self.assertEqual("Sample response. The end.", paragraph)
+
+    async def test_agenerate_narrative_stream(self):
+        async def stream(prompt, accept=None):
+            yield "Sample "
+            yield "response."
+
+        self.mock_model.acomplete_stream = stream
+        chunks = [chunk async for chunk in
+            self.generator.agenerate_narrative_stream("Sample text.", is_ending=True)]
+        self.assertEqual(["Sample ", "response.", " The end."], chunks)
+
+    async def test_agenerate_narrative_with_action(self):
+        self.mock_model.acomplete.return_value = " You choose to run.\nContinuation: You run. "
+        edited_action, narrative = await self.generator.agenerate_narrative_with_action(
+            "Sample text.", "Run", is_ending=True)
+        self.mock_model.acomplete.assert_awaited_once()
+        self.assertEqual("You choose to run.", edited_action)
+        self.assertEqual("You run. The end.", narrative)
+
+    async def test_agenerate_narrative_with_action_rejects_unsplittable_response(self):
+        self.mock_model.acomplete.return_value = "You run."
+        with self.assertRaises(GenerationError):
+            await self.generator.agenerate_narrative_with_action("Sample text.", "Run")
+
+    async def test_agenerate_narrative_with_action_stream(self):
+        async def stream(prompt, accept=None):
+            for chunk in [" You choose", " to run.\nCont", "inuation: You", " run."]:
+                yield chunk
+
+        self.mock_model.acomplete_stream = stream
+        chunks = [chunk async for chunk in
+            self.generator.agenerate_narrative_with_action_stream("Sample text.", "Run")]
+        self.assertEqual(["You choose to run.", " ", "You", " run."], chunks)
+
+    async def test_agenerate_actions(self):
+        self.mock_model.acomplete.return_value = '[" Run away. ", "Fight."]'
+        actions = await self.generator.agenerate_actions("Sample text.")
+        self.assertEqual(["Run away.", "Fight."], actions)
+
+    async def test_agenerate_narrative_batch(self):
+        self.mock_model.acomplete_batch.return_value = ["First.", "Second."]
+        paragraphs = await self.generator.agenerate_narrative_batch(
+            ["One.", "Two."], [False, True])
+        self.mock_model.acomplete_batch.assert_awaited_once_with([
+            "One.\n\nResult: ", "Two.\n\nGenerate an ending.\n\nResult: "])
+        self.assertEqual(["First.", "Second. The end."], paragraphs)
+
+    async def test_agenerate_actions_batch(self):
+        self.mock_model.acomplete_batch.return_value = ['["A", "B"]', '["C", "D"]']
+        actions = await self.generator.agenerate_actions_batch(["One.", "Two."])
+        self.assertEqual([["A", "B"], ["C", "D"]], actions)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,68 @@
+import asyncio
+import unittest
+from unittest import IsolatedAsyncioTestCase
+
+from src.tree_scheduler import TaskGraphScheduler
+
+
+class TaskGraphSchedulerTest(IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        self.scheduler = TaskGraphScheduler(concurrency=2)
+        self.finished = []
+
+    async def node(self, name, delay, children=()):
+        async with self.scheduler.slot():
+            await asyncio.sleep(delay)
+        self.finished.append(name)
+        for child in children:
+            self.scheduler.spawn(self.node(*child))
+
+    async def test_join_waits_for_spawned_tasks(self):
+        self.scheduler.spawn(self.node("root", 0, [("a", 0, [("a1", 0)]), ("b", 0)]))
+        await self.scheduler.join()
+
+        self.assertCountEqual(["root", "a", "b", "a1"], self.finished)
+        self.assertEqual(4, self.scheduler.num_spawned)
+
+    async def test_children_do_not_wait_for_slow_siblings(self):
+        self.scheduler.spawn(self.node("slow", 0.05))
+        self.scheduler.spawn(self.node("fast", 0, [("fast child", 0)]))
+        await self.scheduler.join()
+
+        self.assertEqual(["fast", "fast child", "slow"], self.finished)
+
+    async def test_concurrency_is_limited(self):
+        for i in range(5):
+            self.scheduler.spawn(self.node(i, 0.01))
+        await self.scheduler.join()
+
+        self.assertEqual(2, self.scheduler.max_in_flight)
+
+    async def test_failure_cancels_remaining_tasks(self):
+        async def fail():
+            raise ValueError
+
+        self.scheduler.spawn(self.node("slow", 1))
+        self.scheduler.spawn(fail())
+
+        with self.assertRaises(ValueError):
+            await self.scheduler.join()
+        self.assertEqual([], self.finished)
+
+    async def test_cancelling_join_cancels_spawned_tasks(self):
+        self.scheduler.spawn(self.node("root", 0.01, [("child", 0.01)]))
+        self.scheduler.spawn(self.node("slow", 0.05))
+
+        join = asyncio.ensure_future(self.scheduler.join())
+        await asyncio.sleep(0)
+        join.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await join
+
+        await asyncio.sleep(0.1)
+        self.assertEqual([], self.finished)
+
+
+if __name__ == "__main__":
+    unittest.main()